@@ -0,0 +1,329 @@
+# coding: utf8
+
+"""
+本地的端到端压测：
++ 在子进程中启动RpcServer，只监听127.0.0.1，不需要ZooKeeper；
++ 服务端把注册项通过管道发给父进程，客户端使用StaticRegistry发现服务；
++ 多个线程通过Refer调用echo方法，统计吞吐量和延迟的分位数
+
+python benchmark.py --concurrency 16 --payload-size 1024 \
+    --serializer msgpack --transport record --connection shared
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import sys
+import threading
+
+import tornado.gen as gen
+
+from summerrpc.helper import ServerSocketBuilder, perf_counter
+from summerrpc.exporter import Exporter
+from summerrpc.rpc_server import RpcServerBuilder
+from summerrpc.registry import StaticRegistry, RegisterEntrySet
+from summerrpc.stub import Stub
+from summerrpc.cluster import RandomCluster
+from summerrpc.invoker import RpcInvoker
+from summerrpc.protocol import Protocol
+from summerrpc.refer_argument import ReferArgument
+from summerrpc.connection import (
+        SharedBlockingConnection,
+        SimpleBlockingConnection,
+        ReactorConnection)
+from summerrpc.connection_pool import (
+        SharedLRUConnectionPool,
+        DedicateLRUConnectionPool)
+from summerrpc.transport import RecordTransport, BlockingRecordTransport
+from summerrpc.serializer import PickleSerializer
+from summerrpc.extension.json_serializer import JsonSerializer
+from summerrpc.extension.msgpack_serializer import MsgpackSerializer
+from summerrpc.extension.http_transport import (
+        HTTPTransport,
+        SimpleBlockingHTTPTransport)
+
+LOGGER = logging.getLogger(__name__)
+
+SERIALIZERS = {
+    "pickle": PickleSerializer,
+    "json": JsonSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+# 传输协议 -> (服务端的Transport, 客户端的Transport)
+TRANSPORTS = {
+    "record": (RecordTransport, BlockingRecordTransport),
+    "http": (HTTPTransport, SimpleBlockingHTTPTransport),
+}
+
+# 连接类型 -> (连接类, 连接池类)
+CONNECTIONS = {
+    "shared": (SharedBlockingConnection, SharedLRUConnectionPool),
+    "simple": (SimpleBlockingConnection, DedicateLRUConnectionPool),
+    "reactor": (ReactorConnection, SharedLRUConnectionPool),
+}
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class BenchmarkService(object):
+    # 在工作线程池中执行
+    def echo(self, payload):
+        return payload
+
+    # 在IOLoop线程中执行，不经过线程池
+    @gen.coroutine
+    def echo_async(self, payload):
+        raise gen.Return(payload)
+
+
+class _PipeRegistry(StaticRegistry):
+    """注册的同时把注册项发给父进程"""
+
+    def __init__(self, pipe):
+        super(_PipeRegistry, self).__init__()
+        self._pipe = pipe
+
+    def register(self, register_entry_set, delete_if_exists=True):
+        super(_PipeRegistry, self).register(
+            register_entry_set, delete_if_exists)
+        self._pipe.send(list(register_entry_set.iter_entry()))
+
+
+def run_server(options, pipe):
+    server_socket = ServerSocketBuilder() \
+        .with_host("127.0.0.1") \
+        .with_port(0) \
+        .with_non_blocking() \
+        .with_tcp_no_delay() \
+        .with_backlog(128) \
+        .build()
+
+    builder = RpcServerBuilder() \
+        .with_server_socket(server_socket) \
+        .with_exporter(Exporter().export(BenchmarkService)) \
+        .with_transport(TRANSPORTS[options.transport][0]()) \
+        .with_serializer(SERIALIZERS[options.serializer]()) \
+        .with_registry(_PipeRegistry(pipe)) \
+        .with_max_idle_time(3600) \
+        .with_concurrent_request_per_connection(
+            max(100, options.concurrency))
+    if options.server_threads is not None:
+        builder.with_thread_pool_size(options.server_threads)
+    builder.build().start()
+
+
+def make_payload(size, serializer):
+    # json只能序列化文本，所以统一使用可打印的ASCII字符
+    if serializer == "json":
+        return u"x" * size
+    return "x" * size
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.
+    index = int(round(len(sorted_values) * percent / 100.)) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+class Worker(threading.Thread):
+    def __init__(self, refer, method_name, payload, start_event,
+                 measure_at, stop_at, max_requests):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self._method = getattr(refer, method_name)
+        self._payload = payload
+        self._start_event = start_event
+        self._measure_at = measure_at
+        self._stop_at = stop_at
+        self._max_requests = max_requests
+        # 只保存预热之后的延迟，单位是秒
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        self._start_event.wait()
+        latencies = self.latencies
+        method, payload = self._method, self._payload
+        while len(latencies) < self._max_requests:
+            start = perf_counter()
+            if start >= self._stop_at:
+                break
+            try:
+                method(payload)
+            except BaseException as ex:
+                self.errors = self.errors + 1
+                if self.errors == 1:
+                    LOGGER.error("invoke failed, because %s: %s" %
+                                 (type(ex).__name__, ex))
+                continue
+            if start >= self._measure_at:
+                latencies.append(perf_counter() - start)
+
+
+def build_refer(options, registry):
+    connection_class, pool_class = CONNECTIONS[options.connection]
+    stub = Stub() \
+        .set_cluster(RandomCluster(registry)) \
+        .set_protocol(Protocol().set_invoker(RpcInvoker())) \
+        .set_transport(TRANSPORTS[options.transport][1]()) \
+        .set_serializer(SERIALIZERS[options.serializer]())
+
+    # 独占的连接需要和并发数一样多，否则线程会在连接池上排队
+    connections_per_key = options.connections_per_key
+    if connections_per_key is None:
+        connections_per_key = options.concurrency \
+            if options.connection == "simple" else 1
+    refer_argument = ReferArgument() \
+        .set_connection_class(connection_class) \
+        .set_connection_pool_class(pool_class) \
+        .set_connections_per_key(connections_per_key) \
+        .set_client_socket_timeout(options.timeout) \
+        .set_read_timeout(options.timeout) \
+        .set_write_timeout(options.timeout)
+    return stub, stub.refer(BenchmarkService, refer_argument)
+
+
+def run_benchmark(options, register_entries):
+    entry_set = RegisterEntrySet()
+    for url, data in register_entries:
+        entry_set.with_entry(url, data)
+    registry = StaticRegistry()
+    registry.register(entry_set)
+    registry.discovery()
+
+    stub, refer = build_refer(options, registry)
+    payload = make_payload(options.payload_size, options.serializer)
+    # 先调用一次，确认服务端可用，并建立第一个连接
+    if getattr(refer, options.method)(payload) != payload:
+        raise RuntimeError("echo returned unexpected payload")
+
+    start_event = threading.Event()
+    now = perf_counter()
+    measure_at = now + options.warmup
+    stop_at = measure_at + options.duration
+    max_requests = options.requests or sys.maxint
+    workers = [Worker(refer, options.method, payload, start_event,
+                      measure_at, stop_at, max_requests)
+               for _ in range(options.concurrency)]
+    for worker in workers:
+        worker.start()
+    start_event.set()
+    for worker in workers:
+        worker.join()
+    # 达到请求数量时可能提前结束，按实际的测量时间计算吞吐量
+    elapsed = min(perf_counter(), stop_at) - measure_at
+
+    refer.refer_close()
+    stub.close()
+    registry.close()
+
+    latencies = []
+    for worker in workers:
+        latencies.extend(worker.latencies)
+    latencies.sort()
+    report = {
+        "transport": options.transport,
+        "serializer": options.serializer,
+        "connection": options.connection,
+        "method": options.method,
+        "concurrency": options.concurrency,
+        "payload_size": options.payload_size,
+        "requests": len(latencies),
+        "errors": sum(worker.errors for worker in workers),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.,
+        "mean": sum(latencies) / len(latencies) if latencies else 0.,
+        "max": latencies[-1] if latencies else 0.,
+    }
+    for percent in PERCENTILES:
+        report["p%s" % str(percent).replace(".", "")] = \
+            percentile(latencies, percent)
+    return report
+
+
+def print_report(report):
+    print("transport=%(transport)s serializer=%(serializer)s "
+          "connection=%(connection)s method=%(method)s "
+          "concurrency=%(concurrency)d payload_size=%(payload_size)d" % report)
+    print("requests=%(requests)d errors=%(errors)d elapsed=%(elapsed).3fs "
+          "throughput=%(throughput).1f/s" % report)
+    print("latency(ms): mean=%.3f p50=%.3f p90=%.3f p99=%.3f p999=%.3f "
+          "max=%.3f" % tuple(report[key] * 1000 for key in
+                             ("mean", "p50", "p90", "p99", "p999", "max")))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="summerrpc end-to-end benchmark on loopback")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of client threads")
+    parser.add_argument("--duration", type=float, default=10.,
+                        help="seconds to measure, after warmup")
+    parser.add_argument("--warmup", type=float, default=2.,
+                        help="seconds to run before measuring")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="stop after this many requests per thread")
+    parser.add_argument("--payload-size", type=int, default=128,
+                        help="size of the echoed payload in bytes")
+    parser.add_argument("--serializer", choices=sorted(SERIALIZERS),
+                        default="pickle")
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS),
+                        default="record")
+    parser.add_argument("--connection", choices=sorted(CONNECTIONS),
+                        default="shared")
+    parser.add_argument("--connections-per-key", type=int, default=None,
+                        help="default: concurrency for simple, otherwise 1")
+    parser.add_argument("--method", choices=["echo", "echo_async"],
+                        default="echo",
+                        help="echo runs in the server thread pool, "
+                             "echo_async runs on the IOLoop")
+    parser.add_argument("--server-threads", type=int, default=None,
+                        help="server thread pool size")
+    parser.add_argument("--timeout", type=float, default=10.)
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    options = parser.parse_args(argv)
+
+    # HTTP请求不能在一个连接上交错，ReactorConnection只支持record
+    if options.transport == "http" and options.connection != "simple":
+        parser.error("http transport only works with --connection simple")
+    if options.concurrency <= 0:
+        parser.error("--concurrency should be more than 0")
+    if options.duration <= 0 or options.warmup < 0:
+        parser.error("--duration should be more than 0 and "
+                     "--warmup should not be negative")
+    return options
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    logging.basicConfig(
+        level=getattr(logging, options.log_level.upper()),
+        format='%(asctime)s %(filename)s[line:%(lineno)d] '
+               '%(levelname)s %(message)s')
+
+    parent_pipe, child_pipe = mp.Pipe()
+    server = mp.Process(target=run_server, args=(options, child_pipe))
+    server.daemon = True
+    server.start()
+    try:
+        if not parent_pipe.poll(options.timeout):
+            raise RuntimeError("server does not start in %ss" %
+                               options.timeout)
+        report = run_benchmark(options, parent_pipe.recv())
+    finally:
+        server.terminate()
+        server.join()
+
+    if options.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
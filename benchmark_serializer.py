@@ -0,0 +1,88 @@
+# coding: utf8
+
+"""
+序列化请求的微基准测试，比较每个请求的耗时：
++ uncached：每次调用都创建新的JSONEncoder/Packer，即json.dumps(default=...)和msgpack.packb()；
++ dumps：BaseSerializer.dumps()，复用同一个JSONEncoder/Packer
+
+python benchmark_serializer.py --payload-size 100
+"""
+
+import argparse
+import json
+import timeit
+
+import msgpack
+
+from summerrpc.request import Request
+from summerrpc.extension.json_serializer import JsonSerializer
+from summerrpc.extension.msgpack_serializer import MsgpackSerializer
+
+
+def _default(obj):
+    raise TypeError
+
+
+def _to_dict(request):
+    return {"class_name": request.class_name,
+            "method_name": request.method_name,
+            "args": request.args,
+            "kwargs": request.kwargs,
+            "meta": request.meta,
+            "is_request": True}
+
+
+UNCACHED = {
+    "json": lambda request: json.dumps(_to_dict(request), default=_default),
+    "msgpack": lambda request: msgpack.packb(_to_dict(request),
+                                             default=_default),
+}
+
+SERIALIZERS = {
+    "json": JsonSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+def make_request(payload_size):
+    request = Request()
+    request.class_name = "BenchmarkService"
+    request.method_name = "echo"
+    request.args = (u"x" * payload_size, )
+    request.kwargs = {}
+    request.meta = {"trace_id": "0123456789abcdef",
+                    "span_id": "fedcba9876543210",
+                    "sampled": True}
+    return request
+
+
+def measure(func, number, repeat):
+    # 返回每次调用的最小耗时，单位是微秒
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / \
+        number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="micro benchmark of request serialization")
+    parser.add_argument("--payload-size", type=int, default=100)
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args(argv)
+
+    request = make_request(options.payload_size)
+    for name in sorted(SERIALIZERS):
+        serializer = SERIALIZERS[name]()
+        uncached = UNCACHED[name]
+        results = [
+            ("uncached", measure(lambda: uncached(request),
+                                 options.number, options.repeat)),
+            ("dumps", measure(lambda: serializer.dumps(request),
+                              options.number, options.repeat)),
+        ]
+        print("%-8s %s" % (name, " ".join(
+            "%s=%.2fus" % (label, elapsed) for label, elapsed in results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,136 @@
 # coding: utf8
 
-__all__ = ["Cluster", "AbstractCluster", "RandomCluster"]
+__all__ = ["Cluster", "AbstractCluster", "RandomCluster",
+           "RoundRobinCluster", "LeastActiveCluster", "P2CEWMACluster",
+           "ConsistentHashCluster"]
 __authors__ = ["Tim Chow"]
 
 from abc import ABCMeta, abstractmethod
 import random
+import threading
+
+from .helper import AtomicInteger, HashRing
+from .remote_stats import RemoteStats
+
+
+def _exclude(remotes, excluded):
+    # 没有需要排除的remote时，返回原来的对象，ConsistentHashCluster依赖它的标识
+    if not excluded:
+        return remotes
+    return tuple(remote for remote in remotes if remote not in excluded)
 
 
 class Cluster(object):
     __metaclass__ = ABCMeta
 
+    # hash_key：从请求参数中提取的路由键，只有一致性哈希等策略会使用它
     @abstractmethod
-    def get_remote(self, class_name, method_name, transport, serializer):
+    def get_remote(self, class_name, method_name, transport, serializer,
+                   hash_key=None):
+        pass
+
+    # key：由make_key生成，调用方可以缓存它，避免每次调用都重新生成
+    def make_key(self, class_name, method_name, transport, serializer):
+        return (transport, "/%s/%s" % (class_name, method_name), serializer)
+
+    # excluded：不能选择的remote，比如刚刚拒绝了请求的remote；
+    # + 除了它们之外没有其他remote时，返回None
+    def get_remote_by_key(self, key, hash_key=None, excluded=()):
+        transport, path, serializer = key
+        _, class_name, method_name = path.split("/", 2)
+        remote = self.get_remote(class_name, method_name,
+                                 transport, serializer, hash_key)
+        if remote in excluded:
+            return None
+        return remote
+
+    # 在调用remote之前、之后被调用，用于收集remote的统计信息
+    def begin_invoke(self, remote):
+        pass
+
+    # failed：调用是否因为连接、传输层面的原因而失败；
+    # + rejected：请求是否在执行之前被服务端拒绝，比如过载、限流
+    def end_invoke(self, remote, elapsed, failed=False, rejected=False):
+        pass
+
+    # 订阅服务发现的变化，listener的方法参考RegistryListener
+    def add_listener(self, listener, replay=False):
+        pass
+
+    def remove_listener(self, listener):
         pass
 
 
 class AbstractCluster(Cluster):
     def __init__(self, registry):
         self._registry = registry
+        self._remote_stats = RemoteStats()
+        # 订阅服务发现的变化
+        self._registry.add_listener(self)
+
+    def get_remote(self, class_name, method_name, transport, serializer,
+                   hash_key=None):
+        return self.get_remote_by_key(
+            self.make_key(class_name, method_name, transport, serializer),
+            hash_key)
 
-    def get_remote(self, class_name, method_name, transport, serializer):
-        remotes = self._registry.get_remotes(
-                        class_name,
-                        method_name,
-                        transport,
-                        serializer)
+    def make_key(self, class_name, method_name, transport, serializer):
+        return self._registry.make_key(
+            class_name, method_name, transport, serializer)
+
+    def get_remote_by_key(self, key, hash_key=None, excluded=()):
+        # 跳过熔断器打开的remote
+        remotes = self._remote_stats.filter_available(_exclude(
+            self._registry.get_remotes_by_key(key), excluded))
         if len(remotes) == 0:
             return None
 
         # 按照负载均衡算法选择一个remote
-        remote = self.choice_remote(remotes)
-        return remote
+        return self._choice_allowed_remote(remotes)
+
+    def _choice_allowed_remote(self, remotes, remote=None):
+        # 选中的remote处于半开状态、并且探测请求已经被其他调用占用时，
+        # + 从剩下的remote中重新选择；都不允许时仍然返回最后选中的remote
+        while True:
+            if remote is None:
+                remote = self.choice_remote(remotes)
+            if self._remote_stats.allow_request(remote):
+                return remote
+            remotes = [r for r in remotes if r != remote]
+            if not remotes:
+                return remote
+            remote = None
+
+    def begin_invoke(self, remote):
+        self._remote_stats.begin_invoke(remote)
+
+    def end_invoke(self, remote, elapsed, failed=False, rejected=False):
+        if rejected:
+            elapsed = self._get_rejected_elapsed(elapsed)
+        self._remote_stats.end_invoke(remote, elapsed, failed, rejected)
+
+    def _get_rejected_elapsed(self, elapsed):
+        # 被拒绝的请求很快返回，它的耗时不能反映remote的负载，默认不记录
+        return None
+
+    def add_listener(self, listener, replay=False):
+        self._registry.add_listener(listener, replay)
+
+    def remove_listener(self, listener):
+        self._registry.remove_listener(listener)
+
+    def on_remotes_changed(self, key, remotes):
+        pass
+
+    def on_remote_added(self, remote):
+        pass
+
+    def on_remote_removed(self, remote):
+        # remote下线之后，丢弃它的统计信息
+        self._remote_stats.remove(remote)
 
     def close(self):
+        self._registry.remove_listener(self)
         self._registry.close()
 
     def choice_remote(self, remotes):
@@ -44,3 +142,119 @@ class RandomCluster(AbstractCluster):
         # 从remotes中随机选择一个
         return random.choice(remotes)
 
+
+class RoundRobinCluster(AbstractCluster):
+    def __init__(self, registry):
+        super(RoundRobinCluster, self).__init__(registry)
+        self._counter = AtomicInteger(0)
+
+    def choice_remote(self, remotes):
+        return remotes[self._counter.increase(1) % len(remotes)]
+
+
+class LeastActiveCluster(AbstractCluster):
+    def choice_remote(self, remotes):
+        # 选择正在进行的调用数最少的remote，数量相同时随机选择
+        least_active = None
+        candidates = []
+        for remote in remotes:
+            active = self._remote_stats.get(remote).active
+            if least_active is None or active < least_active:
+                least_active = active
+                candidates = [remote]
+            elif active == least_active:
+                candidates.append(remote)
+        return random.choice(candidates)
+
+
+class P2CEWMACluster(AbstractCluster):
+    def __init__(self, registry, default_latency=1., rejected_latency=None):
+        super(P2CEWMACluster, self).__init__(registry)
+        # 还没有完成过调用的remote，使用default_latency作为正在进行的调用的耗时，
+        # + 否则新加入或者卡住的remote的负载永远是0，会一直被选中
+        self._default_latency = default_latency
+        # 请求被拒绝时，至少按照rejected_latency记录耗时，使流量离开正在卸载的remote
+        self._rejected_latency = default_latency if rejected_latency is None \
+            else rejected_latency
+
+    def choice_remote(self, remotes):
+        if len(remotes) == 1:
+            return remotes[0]
+        # 随机选择两个remote，取负载较低的那个
+        first, second = random.sample(remotes, 2)
+        if self._get_load(first) <= self._get_load(second):
+            return first
+        return second
+
+    def _get_rejected_elapsed(self, elapsed):
+        return max(elapsed, self._rejected_latency)
+
+    def _get_load(self, remote):
+        stat = self._remote_stats.get(remote)
+        if stat.ewma == 0:
+            return self._default_latency * stat.active
+        return stat.ewma * (stat.active + 1)
+
+
+class ConsistentHashCluster(AbstractCluster):
+    def __init__(self, registry, replicas=160):
+        super(ConsistentHashCluster, self).__init__(registry)
+        self._replicas = replicas
+        # key -> (remotes, HashRing)
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def get_remote_by_key(self, key, hash_key=None, excluded=()):
+        remotes = self._registry.get_remotes_by_key(key)
+        candidates = _exclude(remotes, excluded)
+        if len(candidates) == 0:
+            return None
+        available = self._remote_stats.filter_available(candidates)
+        # 没有路由键时，退化成随机选择
+        if hash_key is None:
+            return self._choice_allowed_remote(available)
+
+        remote = self._get_ring(key, remotes).get_node(hash_key)
+        # 熔断器打开或者remote被排除时，临时路由到其他remote，而不是修改哈希环
+        if available is not remotes and remote not in available:
+            return self._choice_allowed_remote(available)
+        return self._choice_allowed_remote(available, remote)
+
+    def _get_ring(self, key, remotes):
+        # Registry在成员变化时才会生成新的remotes对象，
+        # + 因此remotes没有变化时，只需要比较对象的标识
+        entry = self._rings.get(key)
+        if entry is not None and entry[0] is remotes:
+            return entry[1]
+
+        with self._lock:
+            entry = self._rings.get(key)
+            if entry is not None and entry[0] is remotes:
+                return entry[1]
+            # 其他线程可能正在读取旧的哈希环，因此在副本上修改
+            ring = HashRing(replicas=self._replicas) if entry is None \
+                else entry[1].copy()
+            self._update_ring(ring, remotes)
+            self._rings[key] = (remotes, ring)
+            return ring
+
+    def on_remotes_changed(self, key, remotes):
+        # 成员变化时立即更新哈希环，而不是等到下一次调用
+        if remotes:
+            self._get_ring(key, remotes)
+        else:
+            with self._lock:
+                self._rings.pop(key, None)
+
+    @staticmethod
+    def _update_ring(ring, remotes):
+        # 增量地更新哈希环：只增删发生变化的节点
+        current = ring.nodes
+        latest = frozenset(remotes)
+        for remote in current - latest:
+            ring.remove_node(remote)
+        for remote in latest - current:
+            ring.add_node(remote)
+
+    def choice_remote(self, remotes):
+        return random.choice(remotes)
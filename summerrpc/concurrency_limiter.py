@@ -0,0 +1,88 @@
+# coding: utf8
+
+"""
+并发限制：限制服务端正在处理的请求的总数，超过上限的请求会被直接拒绝
+"""
+
+__all__ = ["ConcurrencyLimiter", "AIMDConcurrencyLimiter"]
+__authors__ = ["Tim Chow"]
+
+from abc import ABCMeta, abstractmethod, abstractproperty
+import threading
+
+
+class ConcurrencyLimiter(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def acquire(self):
+        """获取一个并发名额，获取失败时返回False"""
+        pass
+
+    @abstractmethod
+    def release(self, latency):
+        """归还并发名额，latency是请求的处理耗时（秒）"""
+        pass
+
+    @abstractproperty
+    def limit(self):
+        pass
+
+    @abstractproperty
+    def in_flight(self):
+        pass
+
+
+class AIMDConcurrencyLimiter(ConcurrencyLimiter):
+    """
+    加性增、乘性减：
+    + 请求的处理耗时超过latency_threshold时，将上限乘以backoff_ratio；
+    + 否则，在名额被充分使用时，每个请求将上限增加1/limit，
+    + 也就是大约每处理完一个窗口的请求，上限增加1
+    """
+
+    def __init__(self,
+                 initial_limit=20,
+                 min_limit=1,
+                 max_limit=1000,
+                 latency_threshold=0.1,
+                 backoff_ratio=0.9):
+        if min_limit <= 0 or min_limit > max_limit:
+            raise ValueError("expect 0 < min_limit <= max_limit")
+        if not 0 < backoff_ratio < 1:
+            raise ValueError("backoff_ratio should be in (0, 1)")
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._latency_threshold = latency_threshold
+        self._backoff_ratio = backoff_ratio
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                return False
+            self._in_flight = self._in_flight + 1
+            return True
+
+    def release(self, latency):
+        with self._lock:
+            in_flight = self._in_flight
+            self._in_flight = max(in_flight - 1, 0)
+
+            if latency > self._latency_threshold:
+                self._limit = max(self._min_limit,
+                                  self._limit * self._backoff_ratio)
+            # 名额没有被充分使用时不增加上限，防止空闲时上限无限增长
+            elif in_flight * 2 >= self._limit:
+                self._limit = min(self._max_limit,
+                                  self._limit + 1. / self._limit)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
@@ -1,3 +1,4 @@
 from .interface import *
 from .zookeeper_configuration_center import *
-
+from .memory_configuration_center import *
+from .snapshot_configuration_center import *
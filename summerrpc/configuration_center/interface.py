@@ -1,24 +1,34 @@
 # coding: utf8
 
-__all__ = ["ConfigurationCenter"]
+__all__ = ["ConfigurationCenter", "ConfigurationListener",
+           "AbstractConfigurationCenter"]
 __authors__ = ["Tim Chow"]
 
 import abc
+import json
+import logging
+import traceback
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# 解析失败的结果也会被缓存，直到值发生变化
+_PARSE_FAILED = object()
 
 
 class ConfigurationCenter(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def start(self, key):
+    def start(self):
         pass
 
     @abc.abstractmethod
-    def close(self, key, value):
+    def close(self):
         pass
 
     @abc.abstractmethod
-    def get_key(self, key):
+    def get_key(self, key, default=None):
         pass
 
     @abc.abstractproperty
@@ -33,3 +43,212 @@ class ConfigurationCenter(object):
     def iteritems(self):
         pass
 
+
+class ConfigurationListener(object):
+    """配置发生变化时，ConfigurationCenter会调用listener的这个方法"""
+
+    # value是变化之后的值，为None时表示key被删除了
+    def on_key_changed(self, key, value):
+        pass
+
+    # 全量加载配置之后调用，即使没有任何key发生变化
+    def on_reloaded(self, main_version):
+        pass
+
+
+def _parse_bool(value):
+    lowered = value.strip().lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off", ""):
+        return False
+    raise ValueError("invalid bool: %r" % value)
+
+
+class AbstractConfigurationCenter(ConfigurationCenter):
+    """
+    保存配置的本地缓存，并提供：
+    + 带类型的访问方法，每个值只在发生变化之后解析一次；
+    + 按key订阅变化的listener
+    子类通过_update()、_remove()、_replace_all()更新本地缓存
+    """
+    def __init__(self):
+        # key -> (value, version)，只在更新线程中修改，读取时不需要加锁
+        self._local_cache = None
+        self._main_version = None
+        # (key, parser) -> (value, parsed)
+        # 读取线程也会写入，修改时需要持有_update_lock
+        self._parsed_cache = {}
+        # 使用tuple保存(listener, key)，添加、删除时整体替换
+        self._listeners = ()
+        # 串行化更新，保证listener按照变化的顺序收到通知
+        self._update_lock = threading.RLock()
+        # 是否正在全量加载配置
+        self._reloading = False
+
+    def get_key(self, key, default=None):
+        entry = (self._local_cache or {}).get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def get_version(self, key):
+        entry = (self._local_cache or {}).get(key)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def get_typed(self, key, parser, default=None):
+        """
+        使用parser解析key的值，解析结果会被缓存，直到值发生变化；
+        key不存在或解析失败时返回default
+        """
+        value = self.get_key(key)
+        if value is None:
+            return default
+        cached = self._parsed_cache.get((key, parser))
+        if cached is not None and cached[0] is value:
+            parsed = cached[1]
+        else:
+            try:
+                parsed = parser(value)
+            except (ValueError, TypeError):
+                LOGGER.error("parse %s=%r with %r failed" %
+                             (key, value, parser))
+                parsed = _PARSE_FAILED
+            with self._update_lock:
+                self._parsed_cache[(key, parser)] = (value, parsed)
+        if parsed is _PARSE_FAILED:
+            return default
+        return parsed
+
+    def get_int(self, key, default=None):
+        return self.get_typed(key, int, default)
+
+    def get_float(self, key, default=None):
+        return self.get_typed(key, float, default)
+
+    def get_bool(self, key, default=None):
+        return self.get_typed(key, _parse_bool, default)
+
+    # 注意：返回的对象是共享的，调用方不应该修改它
+    def get_json(self, key, default=None):
+        return self.get_typed(key, json.loads, default)
+
+    @property
+    def success(self):
+        return self._local_cache is not None
+
+    @property
+    def main_version(self):
+        return self._main_version
+
+    # 全量加载时，listener会在on_reloaded()之前收到每个变化的key
+    @property
+    def reloading(self):
+        return self._reloading
+
+    def iteritems(self):
+        if self._local_cache is None:
+            raise RuntimeError("configuration is not loaded yet")
+
+        for k, (v, _) in self._local_cache.items():
+            yield k, v
+
+    # key为None时，listener会收到所有key的变化
+    def add_listener(self, listener, key=None):
+        self._listeners = self._listeners + ((listener, key), )
+        return self
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(entry for entry in self._listeners
+                                if entry[0] is not listener)
+        return self
+
+    def _fire(self, key, value):
+        for listener, watched_key in self._listeners:
+            if watched_key is not None and watched_key != key:
+                continue
+            try:
+                listener.on_key_changed(key, value)
+            except BaseException:
+                LOGGER.error("listener %r raised while handling %s" %
+                             (listener, key))
+                LOGGER.error(traceback.format_exc())
+
+    def _update(self, key, value, version=None):
+        # 忽略过期的版本，值没有变化时不通知listener
+        with self._update_lock:
+            cache = self._local_cache or {}
+            entry = cache.get(key)
+            if entry is not None:
+                if version is not None and entry[1] is not None and \
+                        version < entry[1]:
+                    return False
+                if entry[0] == value:
+                    if version != entry[1]:
+                        self._set_entries({key: (entry[0], version)})
+                    return False
+            # 缓存的解析结果会因为值的标识不同而失效
+            self._set_entries({key: (value, version)})
+            self._fire(key, value)
+            return True
+
+    def _remove(self, key):
+        with self._update_lock:
+            cache = self._local_cache or {}
+            if key not in cache:
+                return False
+            new_cache = dict(cache)
+            new_cache.pop(key)
+            self._local_cache = new_cache
+            self._drop_parsed(key)
+            self._fire(key, None)
+            return True
+
+    def _replace_all(self, entries, main_version=None):
+        # entries：key -> (value, version)，只通知发生变化的key
+        with self._update_lock:
+            cache = self._local_cache or {}
+            changed = [key for key, entry in entries.iteritems()
+                       if key not in cache or cache[key][0] != entry[0]]
+            removed = [key for key in cache if key not in entries]
+            self._local_cache = dict(entries)
+            if main_version is not None:
+                self._main_version = main_version
+            for key in removed:
+                self._drop_parsed(key)
+            self._reloading = True
+            try:
+                for key in changed:
+                    self._fire(key, entries[key][0])
+                for key in removed:
+                    self._fire(key, None)
+            finally:
+                self._reloading = False
+            self._fire_reloaded()
+
+    def _fire_reloaded(self):
+        for listener, watched_key in self._listeners:
+            on_reloaded = getattr(listener, "on_reloaded", None)
+            if watched_key is not None or on_reloaded is None:
+                continue
+            try:
+                on_reloaded(self._main_version)
+            except BaseException:
+                LOGGER.error("listener %r raised while handling reload" %
+                             listener)
+                LOGGER.error(traceback.format_exc())
+
+    def _set_entries(self, entries):
+        # 复制之后再替换，读取线程不会看到修改了一半的dict
+        new_cache = dict(self._local_cache or {})
+        new_cache.update(entries)
+        self._local_cache = new_cache
+
+    def _drop_parsed(self, key):
+        with self._update_lock:
+            for cache_key in self._parsed_cache.keys():
+                if cache_key[0] != key:
+                    continue
+                self._parsed_cache.pop(cache_key, None)
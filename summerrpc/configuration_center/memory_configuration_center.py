@@ -0,0 +1,47 @@
+# coding: utf8
+
+__all__ = ["MemoryConfigurationCenter"]
+__authors__ = ["Tim Chow"]
+
+from .interface import AbstractConfigurationCenter
+
+
+class MemoryConfigurationCenter(AbstractConfigurationCenter):
+    """配置只保存在内存中，通过set()、delete()修改，主要用于测试"""
+    def __init__(self, initial=None):
+        super(MemoryConfigurationCenter, self).__init__()
+        self._initial = dict(initial or {})
+
+    def start(self):
+        if not self.success:
+            self.load(self._initial)
+
+    def load(self, entries, main_version=None):
+        # 全量替换配置，entries：key -> value
+        with self._update_lock:
+            self._replace_all(
+                dict((key, (value, self._next_version(key)))
+                     for key, value in entries.iteritems()),
+                main_version if main_version is not None
+                else (self._main_version or 0) + 1)
+
+    def set(self, key, value):
+        with self._update_lock:
+            self._update(key, value, self._next_version(key))
+
+    def delete(self, key):
+        self._remove(key)
+
+    def _next_version(self, key):
+        version = self.get_version(key)
+        return 0 if version is None else version + 1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_typ, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
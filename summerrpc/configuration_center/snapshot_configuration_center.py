@@ -0,0 +1,110 @@
+# coding: utf8
+
+__all__ = ["SnapshotConfigurationCenter"]
+__authors__ = ["Tim Chow"]
+
+import os
+import json
+import tempfile
+import logging
+
+from .interface import AbstractConfigurationCenter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SnapshotConfigurationCenter(AbstractConfigurationCenter):
+    """
+    为其他的配置中心增加本地快照：
+    + start()时先加载快照，不需要等待配置中心返回，就可以读取配置；
+    + 配置中心的配置发生变化后，同步到本地，并原子地写入快照文件；
+    + 配置中心不可用时，继续使用最后一次的配置
+    """
+    def __init__(self, configuration_center, snapshot_path):
+        super(SnapshotConfigurationCenter, self).__init__()
+        if not isinstance(configuration_center, AbstractConfigurationCenter):
+            raise TypeError("expect AbstractConfigurationCenter, not %s" %
+                            type(configuration_center).__name__)
+        self._configuration_center = configuration_center
+        self._snapshot_path = snapshot_path
+        self._started = False
+
+    @property
+    def configuration_center(self):
+        return self._configuration_center
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        if not self.success:
+            self._load_snapshot()
+        self._configuration_center.add_listener(self)
+        self._configuration_center.start()
+
+    def _load_snapshot(self):
+        if not os.path.exists(self._snapshot_path):
+            return
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+            entries = dict((key, (value, version)) for key, (value, version)
+                           in snapshot["entries"].iteritems())
+            self._replace_all(entries, snapshot.get("main_version"))
+            LOGGER.info("load %d keys from snapshot: %s" %
+                        (len(entries), self._snapshot_path))
+        except (IOError, OSError, ValueError, KeyError, TypeError) as ex:
+            LOGGER.error("load snapshot %s failed, because %s: %s" %
+                         (self._snapshot_path, type(ex).__name__, ex))
+
+    def _write_snapshot(self):
+        # 先写临时文件再rename，不会留下写了一半的快照
+        snapshot = {"main_version": self._main_version,
+                    "entries": dict((key, list(entry)) for key, entry
+                                    in (self._local_cache or {}).items())}
+        directory = os.path.dirname(os.path.abspath(self._snapshot_path))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(snapshot, f, indent=2, sort_keys=True)
+                os.rename(temp_path, self._snapshot_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError) as ex:
+            LOGGER.error("write snapshot %s failed, because %s: %s" %
+                         (self._snapshot_path, type(ex).__name__, ex))
+
+    def on_key_changed(self, key, value):
+        # 全量加载时，等到on_reloaded()再同步，避免多次写快照
+        center = self._configuration_center
+        with self._update_lock:
+            if value is None:
+                changed = self._remove(key)
+            else:
+                changed = self._update(key, value, center.get_version(key))
+            if changed and not center.reloading:
+                self._main_version = center.main_version
+                self._write_snapshot()
+
+    def on_reloaded(self, main_version):
+        # 以配置中心为准，删除快照中多余的key
+        center = self._configuration_center
+        with self._update_lock:
+            self._replace_all(
+                dict((key, (value, center.get_version(key)))
+                     for key, value in center.iteritems()),
+                main_version)
+            self._write_snapshot()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_typ, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._configuration_center.remove_listener(self)
+        self._configuration_center.close()
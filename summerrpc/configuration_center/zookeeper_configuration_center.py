@@ -1,23 +1,28 @@
 # coding: utf8
 
 __all__ = ["ZookeeperConfigurationCenter"]
-__authors__ = ["Tim Chow"] 
+__authors__ = ["Tim Chow"]
 
 import logging
 import zookeeper
-from .interface import ConfigurationCenter
+from .interface import AbstractConfigurationCenter
 
 LOGGER = logging.getLogger(__name__)
 
 
-class ZookeeperConfigurationCenter(ConfigurationCenter):
+class ZookeeperConfigurationCenter(AbstractConfigurationCenter):
+    """
+    base_znode的每个子节点是一个key，子节点的数据是value：
+    + 每个key都有自己的watch，一个key变化时只重新拉取这个key；
+    + 子节点列表变化时，只拉取新增的key，删除消失的key；
+    + base_znode的版本作为main_version
+    """
     def __init__(self, hosts, base_znode, log_level=zookeeper.LOG_LEVEL_ERROR):
+        super(ZookeeperConfigurationCenter, self).__init__()
         self._hosts = hosts
         self._base_znode = base_znode
         zookeeper.set_debug_level(log_level)
         self._handler = None
-        self._local_cache = None
-        self._main_version = None
 
     def start(self):
         if self._handler is None:
@@ -38,22 +43,76 @@ class ZookeeperConfigurationCenter(ConfigurationCenter):
             LOGGER.info("connect or reconnect successfully, "
                 "handler is: %s" % handler)
             # 拉取配置
-            self._real_start(handler, type_, state, self._base_znode)
+            self._real_start(handler)
 
-    def _real_start(self, handler, type_, state, path):
-        znode = zookeeper.get(handler, path, self._real_start)
-        main_version = znode[1]["version"]
-        LOGGER.info("main version is: %s" % main_version)
+    def _real_start(self, handler):
+        # 重连之后拉取全部的配置，并重新设置watch
+        self._main_version = self._get_main_version(handler)
+        LOGGER.info("main version is: %s" % self._main_version)
 
-        tmp_cache = {}
-        children = zookeeper.get_children(handler, path)
+        entries = {}
+        children = zookeeper.get_children(handler, self._base_znode,
+                                          self._children_watcher)
         for child in children:
-            znode = zookeeper.get(handler, path + "/" + child)
-            tmp_cache[child] = znode[0]
-            LOGGER.info("key=%s, value=%s, version=%s" %
-                (child, znode[0], znode[1]["version"]))
-        self._local_cache = tmp_cache
-        self._main_version = main_version
+            entry = self._get_child(handler, child)
+            if entry is not None:
+                entries[child] = entry
+        self._replace_all(entries)
+
+    def _get_main_version(self, handler):
+        znode = zookeeper.get(handler, self._base_znode, self._main_watcher)
+        return znode[1]["version"]
+
+    def _get_child(self, handler, child):
+        try:
+            znode = zookeeper.get(handler, self._get_path(child),
+                                  self._key_watcher)
+        except zookeeper.NoNodeException:
+            return None
+        LOGGER.info("key=%s, value=%s, version=%s" %
+                    (child, znode[0], znode[1]["version"]))
+        return znode[0], znode[1]["version"]
+
+    def _get_path(self, child):
+        if self._base_znode == "/":
+            return "/" + child
+        return self._base_znode + "/" + child
+
+    def _main_watcher(self, handler, type_, state, path):
+        if type_ != zookeeper.CHANGED_EVENT:
+            return
+        self._main_version = self._get_main_version(handler)
+        LOGGER.info("main version is: %s" % self._main_version)
+
+    def _children_watcher(self, handler, type_, state, path):
+        if type_ != zookeeper.CHILD_EVENT:
+            return
+        children = set(zookeeper.get_children(handler, self._base_znode,
+                                              self._children_watcher))
+        cache = self._local_cache or {}
+        # 已有的key由各自的watch负责更新，这里只处理增删
+        for child in children:
+            if child in cache:
+                continue
+            entry = self._get_child(handler, child)
+            if entry is not None:
+                self._update(child, entry[0], entry[1])
+        for child in cache.keys():
+            if child not in children:
+                LOGGER.info("key=%s is deleted" % child)
+                self._remove(child)
+
+    def _key_watcher(self, handler, type_, state, path):
+        child = path[len(self._base_znode):].lstrip("/")
+        if type_ == zookeeper.CHANGED_EVENT:
+            entry = self._get_child(handler, child)
+            if entry is None:
+                self._remove(child)
+            else:
+                self._update(child, entry[0], entry[1])
+        elif type_ == zookeeper.DELETED_EVENT:
+            LOGGER.info("key=%s is deleted" % child)
+            self._remove(child)
 
     def __enter__(self):
         self.start()
@@ -68,22 +127,3 @@ class ZookeeperConfigurationCenter(ConfigurationCenter):
                 zookeeper.close(self._handler)
             finally:
                 self._handler = None
-
-    def get_key(self, key):
-        return self._local_cache.get(key)
-
-    @property
-    def success(self):
-        return self._local_cache is not None
-
-    @property
-    def main_version(self):
-        return self._main_version
-
-    def iteritems(self):
-        if self._local_cache is None:
-            raise RuntimeError
-
-        for k, v in self._local_cache.iteritems():
-            yield k, v
-
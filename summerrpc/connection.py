@@ -1,6 +1,7 @@
 # coding: utf8
 
-__all__ = ["Connection", "SharedBlockingConnection", "SimpleBlockingConnection"]
+__all__ = ["Connection", "SharedBlockingConnection", "SimpleBlockingConnection",
+           "ReactorConnection"]
 __authors__ = ["Tim Chow"]
 
 from abc import ABCMeta, abstractmethod, abstractproperty
@@ -12,9 +13,14 @@ import logging
 import traceback
 
 from concurrent.futures import Future
+import tornado.gen as gen
+from tornado.iostream import IOStream, StreamClosedError
 
 from .helper import *
 from .exception import *
+from .transport import RecordTransport
+from .reactor import ReactorPool
+from .heartbeat import HeartbeatScheduler
 
 LOGGER = logging.getLogger(__name__)
 
@@ -49,6 +55,23 @@ class Connection(object):
         """closing为True标识：Connection正在关闭，但尚未完成"""
         pass
 
+    @property
+    def in_flight(self):
+        """正在进行的读、写的数量，连接池据此选择连接"""
+        return 0
+
+    _remote_address = None
+
+    @property
+    def remote_address(self):
+        """对端的地址，第一次访问时从底层socket获取，获取失败时返回None"""
+        if self._remote_address is None:
+            try:
+                self._remote_address = self._socket.getpeername()
+            except (socket.error, AttributeError):
+                return None
+        return self._remote_address
+
 
 class SharedBlockingConnection(Connection):
     def __init__(self,
@@ -91,6 +114,11 @@ class SharedBlockingConnection(Connection):
         self._async_read_thread.start()
         self._async_write_thread.start()
 
+        if self._heartbeat_func is not None and \
+                self._heartbeat_interval is not None:
+            HeartbeatScheduler.default().schedule(self,
+                                                  self._heartbeat_interval)
+
     def _update_pending_writes(self, buff, timeout):
         f = Future()
         transaction_id = self._id_generator()
@@ -141,82 +169,66 @@ class SharedBlockingConnection(Connection):
         finally:
             self._read_condition.release()
 
-    def _precheck_before_writing(self, missing_too_many_heartbeats,
-                need_to_wakeup_read_thread):
-        # 如果丢失了过多的心跳，则认为连接断开了，会关闭连接
-        if missing_too_many_heartbeats:
-            self.close()
-            missing_too_many_heartbeats = False
-            return None
-
-        # 在插入心跳之后，需要唤醒读线程
-        if need_to_wakeup_read_thread:
-            LOGGER.debug("wake up read thread, because there is new heartbeat")
-            with self._read_condition:
-                self._read_condition.notify_all()
-            need_to_wakeup_read_thread = False
-
+    def _precheck_before_writing(self):
         # 获取底层锁
         self._write_condition.acquire()
-        if self._closing or self._closed:
+        try:
+            # 如果没有写操作，那么写线程进入等待状态；
+            # + 心跳由HeartbeatScheduler插入，写线程不需要定时醒来
+            while not self._closing and \
+                    not self._closed and \
+                    self._pending_writes.size == 0:
+                with time_used("write condition wait", 0.01):
+                    self._write_condition.wait()
+                LOGGER.debug("async write thread has been waken up")
+            if self._closing or self._closed:
+                return None
+            # 弹出一个写操作
+            return self._pending_writes.pop_left()
+        finally:
             self._write_condition.release()
-            return None
 
-        # 如果没有写操作，那么写线程进入等待状态
-        if self._pending_writes.size == 0:
-            buff, future, transaction_id, timestamp, timeout = \
-                None, None, None, None, None
-            time_to_wait = None if self._heartbeat_interval is None \
-                        else self._heartbeat_interval / 2.
-            with time_used("write condition wait", 0.01):
-                self._write_condition.wait(time_to_wait)
-            LOGGER.debug("async write thread has been waken up")
-            # 在写线程被唤醒或等待到超时之后，
-            # + 需要判断是否应该插入心跳
-            if not self._closing and \
-                    not self._closed and \
-                    self._pending_writes.size == 0 and \
-                    self._heartbeat_func is not None and \
-                    self._heartbeat_interval is not None:
-                # 检查是否丢失heartbeat
-                with self._heartbeat_lock:
-                    # 如果丢失的心跳在可接受范围内，则：
-                    if self._heartbeats.current_size < \
-                                self._heartbeats.max_size:
-                        # + 插入heartbeat
-                        f, transaction_id = self._update_pending_writes(
-                                self._heartbeat_func(),
-                                self._heartbeat_interval)
-                        self._heartbeats[transaction_id] = f
-                        need_to_wakeup_read_thread = True
-                    # 如果丢失了太多的心跳回复，则：
-                    else:
-                        LOGGER.error("missing too many heartbeats, closing connection")
-                        # + 设置missing_too_many_heartbeats标记，之后会关闭连接
-                        missing_too_many_heartbeats = True
-        else:
-            # 如果存在写操作，则弹出一个
-            buff, future, transaction_id, timestamp, timeout = \
-                self._pending_writes.pop_left()
+    def send_heartbeat(self):
+        # 由HeartbeatScheduler调用，返回False表示不再需要发送心跳
+        if self._closing or self._closed:
+            return False
 
-        self._write_condition.release()
-        return missing_too_many_heartbeats, need_to_wakeup_read_thread, \
-            buff, future, transaction_id, timestamp, timeout
+        with self._heartbeat_lock:
+            missing_too_many_heartbeats = \
+                self._heartbeats.current_size >= self._heartbeats.max_size
+        # 如果丢失了过多的心跳，则认为连接断开了，会关闭连接
+        if missing_too_many_heartbeats:
+            LOGGER.error("missing too many heartbeats, closing connection")
+            self.close()
+            return False
+
+        with self._write_condition:
+            if self._closing or self._closed:
+                return False
+            # 有待发送的数据时，不需要插入心跳
+            if self._pending_writes.size > 0:
+                return True
+            with self._heartbeat_lock:
+                f, transaction_id = self._update_pending_writes(
+                        self._heartbeat_func(),
+                        self._heartbeat_interval)
+                self._heartbeats[transaction_id] = f
+            self._write_condition.notify_all()
+
+        # 在插入心跳之后，需要唤醒读线程
+        LOGGER.debug("wake up read thread, because there is new heartbeat")
+        with self._read_condition:
+            self._read_condition.notify_all()
+        return True
 
     # 写线程
     def _async_write(self):
-        missing_too_many_heartbeats = False
-        need_to_wakeup_read_thread = False
         while True:
             with time_used("Connection._precheck_before_writing", 0.005):
-                ret = self._precheck_before_writing(missing_too_many_heartbeats,
-                            need_to_wakeup_read_thread)
+                ret = self._precheck_before_writing()
                 if ret is None:
                     break
-                missing_too_many_heartbeats, need_to_wakeup_read_thread, \
-                    buff, future, transaction_id, timestamp, timeout = ret
-                if buff is None:
-                    continue
+                buff, future, transaction_id, timestamp, timeout = ret
 
             # 判断是否到达了超时时间
             if timeout is not None and timestamp + timeout <= time.time():
@@ -345,6 +357,19 @@ class SharedBlockingConnection(Connection):
     def closing(self):
         return self._closing
 
+    # 不加锁读取，结果是近似值
+    @property
+    def pending_writes(self):
+        return self._pending_writes.size
+
+    @property
+    def pending_reads(self):
+        return self._pending_reads.current_size
+
+    @property
+    def in_flight(self):
+        return self.pending_writes + self.pending_reads
+
 
 class SimpleBlockingConnection(Connection):
     def __init__(self, underlying_socket, transport, *a, **kw):
@@ -410,3 +435,222 @@ class SimpleBlockingConnection(Connection):
     def closing(self):
         return self._closing
 
+
+
+class ReactorConnection(Connection):
+    """
+    在Reactor线程中以非阻塞的方式读写socket，
+    + 调用方通过Future等待结果，连接本身不占用线程；
+    + 目前只支持record传输协议
+    """
+
+    def __init__(self,
+                 underlying_socket,
+                 transport,
+                 max_pending_writes=None,
+                 max_pending_reads=None,
+                 max_pooling_reads=None,
+                 write_timeout=60,
+                 heartbeat_interval=None,
+                 heartbeat_func=None,
+                 reactor=None,
+                 *a,
+                 **kw):
+        if transport.get_name() != RecordTransport().get_name():
+            raise ValueError("ReactorConnection only supports %s transport" %
+                             RecordTransport().get_name())
+        self._socket = underlying_socket
+        self._transport = RecordTransport()
+        self._reactor = reactor or ReactorPool.default().choice()
+        self._stream = None
+
+        # 保护下面的状态，读写线程与Reactor线程都会访问它们
+        self._lock = threading.Lock()
+        self._max_pending_writes = max_pending_writes or 65535
+        self._pending_writes = 0
+        self._pending_reads = LRUCache(max_pending_reads or 65535)
+        self._pooling_reads = LRUCache(max_pooling_reads or 65535)
+
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_func = heartbeat_func
+        self._heartbeats = LRUCache(4)
+
+        self._id_generator = partial(AtomicInteger(0).increase, 1)
+        self._close_lock = threading.Lock()
+        self._closing = False
+        self._closed = False
+
+        self._socket.setblocking(False)
+        self._reactor.add_callback(self._start)
+
+    def _start(self):
+        if self._closing or self._closed:
+            self._socket.close()
+            return
+        # IOStream需要在Reactor线程中创建
+        self._stream = IOStream(self._socket)
+        self._stream.set_close_callback(self.close)
+        self._read_loop()
+        if self._heartbeat_func is not None and \
+                self._heartbeat_interval is not None:
+            HeartbeatScheduler.default().schedule(self,
+                                                  self._heartbeat_interval)
+
+    def write(self, buff, timeout=None):
+        with self._lock:
+            if self._closing or self._closed:
+                raise ConnectionAbortError("write abort")
+            if self._pending_writes >= self._max_pending_writes:
+                raise MaxPendingWritesReachedError("max pending writes reached")
+            self._pending_writes = self._pending_writes + 1
+
+        f = Future()
+        transaction_id = self._id_generator()
+        self._reactor.add_callback(self._write, transaction_id, buff, f)
+        return transaction_id, f
+
+    def _write(self, transaction_id, buff, future):
+        if self._stream is None or self._stream.closed():
+            self._on_written(transaction_id, future, None)
+            return
+        try:
+            write_future = self._stream.write(
+                self._transport.generate_packet(transaction_id, buff))
+        except StreamClosedError:
+            self._on_written(transaction_id, future, None)
+            return
+        self._reactor.ioloop.add_future(
+            write_future,
+            partial(self._on_written, transaction_id, future))
+
+    def _on_written(self, transaction_id, future, write_future):
+        with self._lock:
+            self._pending_writes = self._pending_writes - 1
+        if write_future is None or write_future.exception() is not None:
+            future.set_exception(ConnectionAbortError("write abort"))
+            self.close()
+        else:
+            future.set_result(transaction_id)
+
+    def read(self, transaction_id, timeout=None):
+        with self._lock:
+            if self._closing or self._closed:
+                raise ConnectionAbortError("read abort")
+
+            if transaction_id in self._pooling_reads:
+                f = self._pooling_reads[transaction_id]
+                del self._pooling_reads[transaction_id]
+                return f
+
+            if transaction_id in self._pending_reads:
+                return self._pending_reads[transaction_id]
+
+            entry = self._pending_reads.will_be_kicked_out()
+            if entry is not None:
+                entry.value.set_exception(MaxPendingReadsReachedError(
+                            "max pending reads reached"))
+            f = Future()
+            self._pending_reads[transaction_id] = f
+            return f
+
+    @gen.coroutine
+    def _read_loop(self):
+        while True:
+            try:
+                transaction_id, buff = yield self._transport.read(self._stream)
+            except BaseException:
+                if not (self._closing or self._closed):
+                    LOGGER.error("stream already closed")
+                self.close()
+                break
+            self._on_response(transaction_id, buff)
+
+    def _on_response(self, transaction_id, buff):
+        with self._lock:
+            if self._closing or self._closed:
+                return
+            # 如果收到的是心跳回复
+            if transaction_id in self._heartbeats:
+                LOGGER.debug("accept heartbeat response, transaction_id is: %s" %
+                             transaction_id)
+                del self._heartbeats[transaction_id]
+                return
+            # 如果收到的是正常的响应
+            if transaction_id in self._pending_reads:
+                f = self._pending_reads[transaction_id]
+                del self._pending_reads[transaction_id]
+            else:
+                entry = self._pooling_reads.will_be_kicked_out()
+                if entry is not None:
+                    LOGGER.error("transaction_id: %s hasn't been consumed" %
+                                 entry.key)
+                f = Future()
+                self._pooling_reads[transaction_id] = f
+        f.set_result(buff)
+
+    def send_heartbeat(self):
+        # 由HeartbeatScheduler调用，返回False表示不再需要发送心跳
+        with self._lock:
+            if self._closing or self._closed:
+                return False
+            # 如果丢失了过多的心跳，则认为连接断开了
+            missing_too_many_heartbeats = \
+                self._heartbeats.current_size >= self._heartbeats.max_size
+            if not missing_too_many_heartbeats:
+                transaction_id = self._id_generator()
+                self._heartbeats[transaction_id] = None
+        if missing_too_many_heartbeats:
+            LOGGER.error("missing too many heartbeats, closing connection")
+            self.close()
+            return False
+        self._reactor.add_callback(self._write_heartbeat, transaction_id,
+                                   self._heartbeat_func())
+        return True
+
+    def _write_heartbeat(self, transaction_id, buff):
+        if self._stream is None or self._stream.closed():
+            return
+        try:
+            self._stream.write(self._transport.generate_packet(
+                transaction_id, buff))
+        except StreamClosedError:
+            self.close()
+
+    def close(self):
+        if self._closed or self._closing:
+            return
+        with self._close_lock:
+            if self._closed or self._closing:
+                return
+            self._closing = True
+
+        with self._lock:
+            pending_reads = [item for item in self._pending_reads.iteritems()]
+            self._pending_reads.clear()
+            self._pooling_reads.clear()
+            self._heartbeats.clear()
+        for transaction_id, future in pending_reads:
+            future.set_exception(ConnectionAbortError("read abort"))
+            LOGGER.info("closing read: transaction_id: %d" % transaction_id)
+        self._reactor.add_callback(self._close_stream)
+
+        self._closed = True
+        self._closing = False
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+        else:
+            self._socket.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def closing(self):
+        return self._closing
+
+    @property
+    def in_flight(self):
+        return self._pending_writes + self._pending_reads.current_size
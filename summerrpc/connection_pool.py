@@ -2,7 +2,8 @@
 
 __all__ = ["ConnectionPool", "LRUConnectionPool",
             "DedicateLRUConnectionPool", "SharedLRUConnectionPool",
-            "get_connection_from_pool"]
+            "ConnectionHealth", "get_connection_from_pool",
+            "is_connection_failure"]
 __authors__ = ["Tim Chow"]
 
 import abc
@@ -10,6 +11,12 @@ import threading
 from Queue import Queue, Empty
 from contextlib import contextmanager
 import logging
+import traceback
+import time
+import socket
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
 
 from .helper import *
 from .exception import *
@@ -17,6 +24,15 @@ from .exception import *
 LOGGER = logging.getLogger(__name__)
 
 
+def is_connection_failure(exc):
+    # 连接、传输层面的失败；业务异常以及并发写、读达到上限不算
+    if isinstance(exc, (MaxPendingWritesReachedError,
+                        MaxPendingReadsReachedError)):
+        return False
+    return isinstance(exc, (ConnectionError, TransportError,
+                            CreateConnectionError, socket.error))
+
+
 @contextmanager
 def get_connection_from_pool(pool,
         key,
@@ -27,9 +43,17 @@ def get_connection_from_pool(pool,
         connection_factory,
         block,
         timeout)
+    start_time = time.time()
+    failed = False
     try:
         yield connection
+    except BaseException as ex:
+        failed = is_connection_failure(ex)
+        raise
     finally:
+        # 先汇报连接的健康状况，再把连接放回连接池
+        pool.report_connection(key, connection,
+                               time.time() - start_time, failed)
         pool.release_connection(key, connection)
 
 
@@ -55,15 +79,85 @@ class ConnectionPool(object):
         """关闭连接池及其维护的所有连接"""
         pass
 
+    def warm_up(self, key, connection_factory, delay=0):
+        """在后台预先建立连接，默认不做任何事情"""
+        pass
+
+    def evict(self, key):
+        """关闭并移除key对应的连接，默认不做任何事情"""
+        pass
+
+    def report_connection(self, key, connection, elapsed, failed):
+        """汇报一次使用连接的结果，默认不做任何事情"""
+        pass
+
+
+class ConnectionHealth(object):
+    """
+    连接的健康状况：错误率和耗时的指数加权移动平均，以及连续失败的次数
+    """
+
+    def __init__(self, alpha=0.1):
+        self._alpha = alpha
+        self._error_rate = 0.
+        self._latency = 0.
+        self._samples = 0
+        self._consecutive_failures = 0
+
+    @property
+    def error_rate(self):
+        return self._error_rate
+
+    @property
+    def latency(self):
+        return self._latency
+
+    @property
+    def samples(self):
+        return self._samples
+
+    @property
+    def consecutive_failures(self):
+        return self._consecutive_failures
+
+    def record(self, elapsed, failed):
+        if self._samples == 0:
+            self._latency = elapsed
+        else:
+            self._latency = self._latency + \
+                self._alpha * (elapsed - self._latency)
+        self._error_rate = self._error_rate + \
+            self._alpha * ((1. if failed else 0.) - self._error_rate)
+        self._samples = self._samples + 1
+        if failed:
+            self._consecutive_failures = self._consecutive_failures + 1
+        else:
+            self._consecutive_failures = 0
+
 
 class LRUConnectionPool(ConnectionPool):
-    def __init__(self, connection_pool_size, connections_per_key=1):
+    def __init__(self, connection_pool_size, connections_per_key=1,
+                 warm_up_workers=2, max_connection_failures=3,
+                 max_connection_error_rate=0.5):
         # connection_pool_size：连接池的大小，也就是key的最大数量
         self._pool = LRUCache(connection_pool_size)
         self._lock = threading.Lock()
+        # 连续失败max_connection_failures次，或者错误率达到
+        # + max_connection_error_rate的连接，会被关闭并在下次获取时重建
+        self._max_connection_failures = max_connection_failures
+        self._max_connection_error_rate = max_connection_error_rate
+        # connection -> ConnectionHealth，连接被回收之后自动删除
+        self._health = weakref.WeakKeyDictionary()
+        self._health_lock = threading.Lock()
         # connections_per_key：每个key对应的连接的数量
         self._connections_per_key = connections_per_key
         self._closed = False
+        # key -> Future，正在创建连接的key；
+        # + 其他线程等待这个Future，而不是等待全局锁
+        self._creating = {}
+        # 用于在后台预先建立连接的线程池，第一次预热时才创建
+        self._warm_up_workers = warm_up_workers
+        self._warm_up_executor = None
 
     def get_connection(self,
                 key,
@@ -73,13 +167,15 @@ class LRUConnectionPool(ConnectionPool):
         # connection_factory：用于创建连接对象的工厂函数
         container = self._create_connections_if_necessary(
             key,
-            connection_factory)
+            connection_factory,
+            timeout)
         while True:
             connection = self._choice_connection_from_container(
                 container,
                 block,
                 timeout)
-            if connection.closing or connection.closed:
+            if connection.closing or connection.closed or \
+                    self._is_degraded(container, connection):
                 self._remove_connection_from_container(container, connection)
                 try:
                     connection = connection_factory()
@@ -87,6 +183,7 @@ class LRUConnectionPool(ConnectionPool):
                     raise CreateConnectionError
                 self._add_connection_to_container(container, connection)
             else:
+                self._after_choice(container, connection, connection_factory)
                 return connection
         raise RuntimeError("unreachable")
 
@@ -95,10 +192,12 @@ class LRUConnectionPool(ConnectionPool):
             try:
                 connection = connection_factory()
             except:
+                self._close_connections(container)
                 raise CreateConnectionError
             self._add_connection_to_container(container, connection)
 
-    def _create_connections_if_necessary(self, key, connection_factory):
+    def _create_connections_if_necessary(self, key, connection_factory,
+                                         timeout=None):
         with self._lock:
             if self._closed:
                 raise ConnectionPoolAlreadyClosedError
@@ -106,16 +205,128 @@ class LRUConnectionPool(ConnectionPool):
             if key in self._pool:
                 return self._pool[key]
 
-            container = self._get_connection_container(self._connections_per_key)
+            future = self._creating.get(key)
+            if future is None:
+                future = self._creating[key] = Future()
+                creator = True
+            else:
+                creator = False
+
+        # 其他线程正在创建这个key的连接，只需要等待它创建完成
+        if not creator:
+            try:
+                return future.result(timeout)
+            except TimeoutError:
+                raise NoAvailableConnectionError
+
+        # 在全局锁之外建立连接，
+        # + 连接慢或者连接不上的remote，不会阻塞其他key的调用方
+        try:
+            container = self._get_connection_container(
+                self._connections_per_key)
             self._initialize_connections(container, connection_factory)
+        except BaseException as ex:
+            with self._lock:
+                self._creating.pop(key, None)
+            future.set_exception(ex)
+            raise
 
-            entry = self._pool.will_be_kicked_out()
-            # 如果连接池已经满了，那么关闭要踢出的连接
-            if entry is not None:
-                self._close_connections(entry.value)
-                LOGGER.info("kicked out key: %s" % (entry.key, ))
-            self._pool[key] = container
-            return container
+        kicked_out = None
+        with self._lock:
+            self._creating.pop(key, None)
+            closed = self._closed
+            if not closed:
+                entry = self._pool.will_be_kicked_out()
+                if entry is not None:
+                    kicked_out = entry.key, entry.value
+                self._pool[key] = container
+
+        if closed:
+            self._close_connections(container)
+            future.set_exception(ConnectionPoolAlreadyClosedError())
+            raise ConnectionPoolAlreadyClosedError
+
+        # 如果连接池已经满了，那么关闭被踢出的连接
+        if kicked_out is not None:
+            self._close_connections(kicked_out[1])
+            LOGGER.info("kicked out key: %s" % (kicked_out[0], ))
+        future.set_result(container)
+        return container
+
+    def warm_up(self, key, connection_factory, delay=0):
+        with self._lock:
+            if self._closed or key in self._pool:
+                return
+            # 连接池已满时不预热，避免踢出正在使用的连接
+            if self._pool.will_be_kicked_out() is not None:
+                return
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._submit_warm_up,
+                                    (key, connection_factory))
+            timer.setDaemon(True)
+            timer.start()
+        else:
+            self._submit_warm_up(key, connection_factory)
+
+    def _submit_warm_up(self, key, connection_factory):
+        self._submit_background_task(self._warm_up, key, connection_factory)
+
+    def _submit_background_task(self, fn, *a):
+        with self._lock:
+            if self._closed:
+                return False
+            if self._warm_up_executor is None:
+                self._warm_up_executor = ThreadPoolExecutor(
+                    self._warm_up_workers)
+            executor = self._warm_up_executor
+        try:
+            executor.submit(fn, *a)
+        except RuntimeError:
+            # 连接池已经关闭
+            return False
+        return True
+
+    def _warm_up(self, key, connection_factory):
+        try:
+            self._create_connections_if_necessary(key, connection_factory)
+            LOGGER.info("warmed up connections, key is: %s" % (key, ))
+        except ConnectionPoolAlreadyClosedError:
+            pass
+        except BaseException:
+            LOGGER.error("warm up connections failed, key is: %s" % (key, ))
+            LOGGER.error(traceback.format_exc())
+
+    def evict(self, key):
+        with self._lock:
+            if self._closed or key not in self._pool:
+                return
+            container = self._pool[key]
+            del self._pool[key]
+        self._close_connections(container)
+        LOGGER.info("evicted connections, key is: %s" % (key, ))
+
+    def report_connection(self, key, connection, elapsed, failed):
+        with self._health_lock:
+            health = self._health.get(connection)
+            if health is None:
+                health = self._health[connection] = ConnectionHealth()
+            health.record(elapsed, failed)
+            degraded = health.consecutive_failures >= \
+                self._max_connection_failures or \
+                (health.samples >= 10 and
+                 health.error_rate >= self._max_connection_error_rate)
+        if degraded and not (connection.closing or connection.closed):
+            LOGGER.error("connection to %s is degraded, "
+                         "consecutive failures: %d, error rate: %.2f" %
+                         (key, health.consecutive_failures,
+                          health.error_rate))
+            self._retire_connection(key, connection)
+
+    def _retire_connection(self, key, connection):
+        # 独占的连接只被汇报它的调用方使用，可以直接关闭，
+        # + 下次获取连接时会被替换成新的连接
+        connection.close()
 
     def release_connection(self, key, connection):
         with self._lock:
@@ -138,6 +349,9 @@ class LRUConnectionPool(ConnectionPool):
                 LOGGER.info("closed connections, key is: %s" % (key, ))
             self._closed = True
 
+        if self._warm_up_executor is not None:
+            self._warm_up_executor.shutdown(wait=False)
+
     def _get_connection_container(self, max_size):
         raise NotImplementedError
 
@@ -156,8 +370,23 @@ class LRUConnectionPool(ConnectionPool):
     def _release_connection_to_container(self, container, connection):
         raise NotImplementedError
 
+    def _after_choice(self, container, connection, connection_factory):
+        # 选中连接之后被调用，子类可以据此调整连接的数量
+        pass
+
+    def _is_degraded(self, container, connection):
+        # 被判定为不健康、但是还没有关闭的连接，下次被选中时会被替换
+        return False
+
 
 class DedicateLRUConnectionPool(LRUConnectionPool):
+    def __init__(self, connection_pool_size, connections_per_key=1,
+                 warm_up_workers=2, max_connections_per_key=None, **kw):
+        # 每个调用方独占一个连接，连接的数量是固定的，
+        # + 接受max_connections_per_key只是为了和SharedLRUConnectionPool兼容
+        super(DedicateLRUConnectionPool, self).__init__(
+            connection_pool_size, connections_per_key, warm_up_workers, **kw)
+
     def _get_connection_container(self, max_size):
         return Queue()
 
@@ -186,34 +415,215 @@ class DedicateLRUConnectionPool(LRUConnectionPool):
         container.put(connection)
 
 
+class _SharedConnectionContainer(object):
+    def __init__(self):
+        # 添加、删除连接时整体替换，选择连接时不需要加锁
+        self.connections = ()
+        self.condition = threading.Condition()
+        # 是否正在后台创建新的连接
+        self.growing = False
+        # 最近一次连接数量不够用的时间
+        self.last_busy_time = time.time()
+        # 查找连接的起始位置，in_flight相同时轮流选择连接
+        self.offset = 0
+        # connection -> 正在使用这个连接的调用方的数量，在condition中修改
+        self.borrowed = {}
+        # 缩容时被移除、但仍然有调用方在使用的连接，最后一个调用方归还时关闭
+        self.retired = set()
+        # 被判定为不健康的连接，下次被选中时替换成新的连接
+        self.degraded = set()
+
+
 class SharedLRUConnectionPool(LRUConnectionPool):
+    """
+    多个调用方共享连接：
+    + 选择正在进行的读、写最少的连接；
+    + 连接上正在进行的读写达到scale_up_in_flight时，在后台增加连接，
+      最多max_connections_per_key个；
+    + 连续scale_down_idle_time秒连接都有富余时，关闭空闲的连接，
+      最少保留connections_per_key个
+    """
+
+    def __init__(self, connection_pool_size, connections_per_key=1,
+                 warm_up_workers=2, max_connections_per_key=None,
+                 scale_up_in_flight=32, scale_down_idle_time=60, **kw):
+        super(SharedLRUConnectionPool, self).__init__(
+            connection_pool_size, connections_per_key, warm_up_workers, **kw)
+        self._max_connections_per_key = max(
+            max_connections_per_key or connections_per_key,
+            connections_per_key)
+        self._scale_up_in_flight = scale_up_in_flight
+        self._scale_down_idle_time = scale_down_idle_time
+
     def _get_connection_container(self, max_size):
-        return CyclicIterator([])
+        return _SharedConnectionContainer()
 
     def _add_connection_to_container(self, container, connection):
         with container.condition:
-            container.append(connection)
+            container.connections = container.connections + (connection, )
 
     def _close_connections(self, container):
         with container.condition:
-            container.rewind()
-            while container.has_next():
-                container.next().close()
-                container.remove()
+            connections = container.connections + tuple(container.retired)
+            container.connections = ()
+            container.retired = set()
+        for connection in connections:
+            connection.close()
+
+    @staticmethod
+    def _get_in_flight(connection):
+        return getattr(connection, "in_flight", 0)
 
     def _choice_connection_from_container(self, container, block, timeout):
-        with container.condition:
-            if container.cyclic_has_next():
-                return container.next()
+        while True:
+            chosen = self._find_least_in_flight(container)
+            # 记录连接正在被使用；选择之后连接可能已经被缩容移除了，此时重新选择
+            with container.condition:
+                if chosen in container.connections:
+                    container.borrowed[chosen] = \
+                        container.borrowed.get(chosen, 0) + 1
+                    return chosen
+
+    def _find_least_in_flight(self, container):
+        connections = container.connections
+        if not connections:
             raise RuntimeError("invalid connections_per_key")
+        # 每次从下一个位置开始查找，in_flight相同时，调用会轮流使用各个连接；
+        # + 不加锁，并发时偶尔重复使用同一个起始位置也没有关系
+        offset = container.offset % len(connections)
+        container.offset = offset + 1
+        chosen, least_in_flight = None, None
+        for index in range(len(connections)):
+            connection = connections[(offset + index) % len(connections)]
+            in_flight = self._get_in_flight(connection)
+            if least_in_flight is None or in_flight < least_in_flight:
+                chosen, least_in_flight = connection, in_flight
+                if in_flight == 0:
+                    break
+        return chosen
 
     def _remove_connection_from_container(self, container, connection):
+        # 其他调用方仍然在使用这个连接时，等它们归还之后再关闭
         with container.condition:
-            try:
-                container.remove_element(connection)
-            except ValueError:
-                pass
+            container.connections = tuple(
+                c for c in container.connections if c is not connection)
+            container.degraded.discard(connection)
+            if container.borrowed.get(connection, 0) > 1:
+                container.retired.add(connection)
+            drained = self._return_connection(container, connection) or \
+                connection not in container.retired
+        if drained and not (connection.closing or connection.closed):
+            connection.close()
 
     def _release_connection_to_container(self, container, connection):
-        pass
+        with container.condition:
+            retired = self._return_connection(container, connection)
+        if retired:
+            connection.close()
+            LOGGER.info("closed retired connection after it drained")
+
+    @staticmethod
+    def _return_connection(container, connection):
+        # 在condition中调用，返回连接是否已经被缩容移除、并且不再被使用
+        count = container.borrowed.get(connection, 0) - 1
+        if count > 0:
+            container.borrowed[connection] = count
+            return False
+        container.borrowed.pop(connection, None)
+        if connection in container.retired:
+            container.retired.discard(connection)
+            return True
+        return False
+
+    def _retire_connection(self, key, connection):
+        # 共享的连接上可能还有其他调用方正在进行的调用，不能直接关闭：
+        # + 标记之后，下次被选中时从可选的连接中移除，最后一个调用方归还时关闭
+        with self._lock:
+            container = self._pool[key] \
+                if not self._closed and key in self._pool else None
+        if container is None:
+            connection.close()
+            return
+        with container.condition:
+            if connection in container.connections:
+                container.degraded.add(connection)
+                return
+            # 已经被缩容移除的连接，最后一个调用方归还时会被关闭
+            if connection in container.retired:
+                return
+        connection.close()
+
+    def _is_degraded(self, container, connection):
+        return connection in container.degraded
 
+    def _after_choice(self, container, connection, connection_factory):
+        if self._max_connections_per_key == self._connections_per_key:
+            return
+        now = time.time()
+        connections = container.connections
+        in_flight = self._get_in_flight(connection)
+        if in_flight >= self._scale_up_in_flight:
+            container.last_busy_time = now
+            if len(connections) < self._max_connections_per_key:
+                self._grow(container, connection_factory)
+            return
+
+        # 连接数量有富余：去掉一个连接之后，其他连接仍然不会达到扩容的阈值
+        total = sum(self._get_in_flight(c) for c in connections)
+        if len(connections) <= self._connections_per_key or \
+                total >= (len(connections) - 1) * self._scale_up_in_flight / 2:
+            container.last_busy_time = now
+            return
+        if now - container.last_busy_time >= self._scale_down_idle_time:
+            self._shrink(container)
+
+    def _grow(self, container, connection_factory):
+        with container.condition:
+            if container.growing:
+                return
+            container.growing = True
+        if not self._submit_background_task(
+                self._add_connection, container, connection_factory):
+            container.growing = False
+
+    def _add_connection(self, container, connection_factory):
+        try:
+            connection = connection_factory()
+            with container.condition:
+                # 连接已经被关闭（比如key被踢出）或者已经达到上限
+                if not container.connections or \
+                        len(container.connections) >= \
+                        self._max_connections_per_key:
+                    connection.close()
+                    return
+                container.connections = container.connections + \
+                    (connection, )
+            LOGGER.info("scaled up to %d connections" %
+                        len(container.connections))
+        except BaseException:
+            LOGGER.error("create connection failed")
+            LOGGER.error(traceback.format_exc())
+        finally:
+            container.growing = False
+
+    def _shrink(self, container):
+        # 先把连接从可选的连接中移除，不会再被新的调用方选中；
+        # + 已经选中它的调用方归还之后才关闭，不会中断正在进行的调用
+        with container.condition:
+            if len(container.connections) <= self._connections_per_key:
+                return
+            idle = [c for c in container.connections
+                    if self._get_in_flight(c) == 0]
+            if not idle:
+                return
+            retired = min(idle, key=lambda c: container.borrowed.get(c, 0))
+            container.connections = tuple(
+                c for c in container.connections if c is not retired)
+            container.last_busy_time = time.time()
+            drained = container.borrowed.get(retired, 0) == 0
+            if not drained:
+                container.retired.add(retired)
+        if drained:
+            retired.close()
+        LOGGER.info("scaled down to %d connections" %
+                    len(container.connections))
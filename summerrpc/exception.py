@@ -115,6 +115,17 @@ class RequestValidateError(RemoteError):
 # 错误的响应对象
 class InvalidResponseError(RemoteError):
     pass
+
+
+# 服务端过载，请求在执行之前就被拒绝了，
+# + 因此可以安全地在其他节点上重试
+class ServerOverloadedError(RemoteError):
+    pass
+
+
+# 请求超过了服务端为方法或客户端配置的速率限制，在执行之前就被拒绝了
+class RateLimitedError(RemoteError):
+    pass
 ##### RemoteError #####
 
 
@@ -6,7 +6,21 @@ __authors__ = ["Tim Chow"]
 from ..serializer import Serializer
 from ..request import Request
 from ..result import Result
-from ..exception import DeserializationError, SerializationError
+from ..exception import DeserializationError, SerializationError, \
+    RemoteError
+
+
+def _find_remote_error(name):
+    # 只还原RemoteError及其子类，其他异常仍然使用RuntimeError
+    if not isinstance(name, basestring):
+        return None
+    classes = [RemoteError]
+    while classes:
+        cls = classes.pop()
+        if cls.__name__ == name:
+            return cls
+        classes.extend(cls.__subclasses__())
+    return None
 
 
 class BaseSerializer(Serializer):
@@ -22,7 +36,11 @@ class BaseSerializer(Serializer):
                 method_name = data.get("method_name")
                 args = data.get("args", tuple())
                 kwargs = data.get("kwargs", dict())
-                
+                # meta只携带追踪等附加信息，格式不正确时忽略它，不影响调用
+                meta = data.get("meta")
+                if not isinstance(meta, dict):
+                    meta = None
+
                 if not isinstance(class_name, basestring) or \
                         not isinstance(method_name, basestring) or \
                         not isinstance(args, (tuple, list)) or \
@@ -33,13 +51,18 @@ class BaseSerializer(Serializer):
                 request.method_name = method_name
                 request.args = args
                 request.kwargs = kwargs
+                request.meta = meta
                 return request
             else:
                 result = Result()
                 if "result" in data:
                     result.result = data["result"]
                 if "exc" in data and data["exc"] is not None:
-                    result.exc = RuntimeError(data["exc"])
+                    exc_class = _find_remote_error(data.get("exc_type"))
+                    if exc_class is not None:
+                        result.exc = exc_class(data.get("exc_msg"))
+                    else:
+                        result.exc = RuntimeError(data["exc"])
                 if "meta" in data:
                     result.meta = data["meta"]
                 return result 
@@ -63,6 +86,14 @@ class BaseSerializer(Serializer):
             d["exc"] = None
             if obj.exc is not None:
                 d["exc"] = "%s: %s" % (type(obj.exc).__name__, str(obj.exc))
+                # RemoteError带上类型和消息，客户端据此还原异常，
+                # + 比如识别出可以重试的ServerOverloadedError
+                if isinstance(obj.exc, RemoteError):
+                    msg = obj.exc.msg
+                    if msg is not None and not isinstance(msg, basestring):
+                        msg = str(msg)
+                    d["exc_type"] = type(obj.exc).__name__
+                    d["exc_msg"] = msg
             d["meta"] = obj.meta
             d["is_request"] = False
 
@@ -75,4 +106,3 @@ class BaseSerializer(Serializer):
 
     def _dumps(self, d):
         raise NotImplementedError
-
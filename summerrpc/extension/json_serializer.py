@@ -10,6 +10,11 @@ from .base_serializer import BaseSerializer
 
 
 class JsonSerializer(BaseSerializer):
+    def __init__(self):
+        # json.dumps()指定default时每次都会创建新的JSONEncoder，
+        # + 因此复用同一个，encode()不修改它的状态，可以在多个线程中使用
+        self._encoder = json.JSONEncoder(default=self.__json_default)
+
     def _loads(self, buff):
         return json.loads(buff)
 
@@ -23,7 +28,7 @@ class JsonSerializer(BaseSerializer):
         raise TypeError("%r is not json serializable" % obj)
 
     def _dumps(self, d):
-        return json.dumps(d, default=self.__json_default)
+        return self._encoder.encode(d)
 
     def get_name(self):
         return "json"
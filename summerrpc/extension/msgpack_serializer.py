@@ -4,12 +4,25 @@ __all__ = ["MsgpackSerializer"]
 __authors__ = ["Tim Chow"]
 
 import datetime
+import threading
 import msgpack
 
 from .base_serializer import BaseSerializer
 
 
 class MsgpackSerializer(BaseSerializer):
+    def __init__(self):
+        # msgpack.packb()每次都会创建新的Packer；
+        # + Packer内部有缓冲区，不能在多个线程中共享，因此每个线程复用一个
+        self._local = threading.local()
+
+    def _get_packer(self):
+        packer = getattr(self._local, "packer", None)
+        if packer is None:
+            packer = self._local.packer = \
+                msgpack.Packer(default=self.__msgpack_default)
+        return packer
+
     def __msgpack_default(self, obj):
         if isinstance(obj, datetime.datetime):
             return obj.strftime("%F %T")
@@ -23,7 +36,7 @@ class MsgpackSerializer(BaseSerializer):
         return msgpack.unpackb(buff)
 
     def _dumps(self, d):
-        return msgpack.packb(d, default=self.__msgpack_default)
+        return self._get_packer().pack(d)
 
     def get_name(self):
         return "msgpack"
@@ -1,6 +1,6 @@
 # coding: utf8
 
-__all__ = ["Filter", "LogFilter"]
+__all__ = ["Filter", "AroundFilter", "LogFilter"]
 __authors__ = ["Tim Chow"]
 
 from abc import ABCMeta, abstractmethod
@@ -21,8 +21,25 @@ class Filter(object):
         pass
 
 
+class AroundFilter(Filter):
+    """
+    包围调用的Filter：在around()中调用invoke(request, *a)执行后续的Filter和Invoker，
+    + 因此可以在调用前后执行逻辑，比如计时、重试、缓存
+    """
+
+    def filter(self, request):
+        pass
+
+    @abstractmethod
+    def around(self, invoke, request, *a):
+        pass
+
+
 class LogFilter(Filter):
     def filter(self, request):
+        # 日志级别没有开启时，不格式化参数
+        if not LOGGER.isEnabledFor(logging.INFO):
+            return
         LOGGER.info("%s.%s() is invoked, " % (request.class_name,
                                               request.method_name) +
                     "with arguments: %s, " % (request.args, ) +
@@ -1,9 +1,20 @@
 # coding: utf8
 
-__all__ = ["HeartBeatRequest", "HeartBeatResponse"]
+__all__ = ["HeartBeatRequest", "HeartBeatResponse", "HeartbeatScheduler",
+           "get_heartbeat_method", "make_heartbeat_request"]
 __authors__ = ["Tim Chow"]
 
 import time
+import heapq
+import threading
+import weakref
+import logging
+import traceback
+
+from .decorator import get_export, get_provide
+from .request import Request
+
+LOGGER = logging.getLogger(__name__)
 
 
 class HeartBeatRequest(object):
@@ -54,3 +65,93 @@ class HeartBeatResponse(object):
     def __str__(self):
         return "%s{timestamp=%.3f, args=%s, kwargs=%s}" % (
             self.__class__.__name__, self._timestamp, self._args, self._kwargs)
+
+
+def get_heartbeat_method():
+    # 返回心跳请求的(class_name, method_name)
+    class_name = HeartBeatRequest.__name__
+    export = get_export(HeartBeatRequest)
+    if export is not None:
+        class_name = export["name"]
+
+    method_name = "send"
+    provide = get_provide(HeartBeatRequest.send)
+    if provide is not None:
+        if provide["filtered"]:
+            raise RuntimeError("HeartBeatRequest.send is filtered")
+        method_name = provide["name"]
+    return class_name, method_name
+
+
+def make_heartbeat_request():
+    request = Request()
+    request.class_name, request.method_name = get_heartbeat_method()
+    request.args = tuple()
+    request.kwargs = dict()
+    request.meta = None
+    return request
+
+
+class HeartbeatScheduler(object):
+    """
+    所有连接共享的心跳调度器：一个线程，一个按到期时间排序的堆；
+    + 到期时调用connection.send_heartbeat()，返回False表示不再需要心跳
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        # (到期时间, 序号, 连接的弱引用, 间隔)
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name="summerrpc-heartbeat")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls()
+        return cls._default
+
+    def schedule(self, connection, interval):
+        with self._condition:
+            self._push(connection, interval, time.time() + interval)
+
+    def _push(self, connection, interval, deadline):
+        # 只保存弱引用，不会阻止连接被回收
+        self._sequence = self._sequence + 1
+        heapq.heappush(self._heap, (deadline, self._sequence,
+                                    weakref.ref(connection), interval))
+        # 新的心跳比之前最早的还要早时，唤醒调度线程
+        if self._heap[0][1] == self._sequence:
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = None if not self._heap else \
+                        self._heap[0][0] - time.time()
+                    self._condition.wait(timeout)
+                deadline, _, connection_ref, interval = \
+                    heapq.heappop(self._heap)
+
+            connection = connection_ref()
+            if connection is None:
+                continue
+            try:
+                reschedule = connection.send_heartbeat()
+            except BaseException:
+                LOGGER.error("send heartbeat failed")
+                LOGGER.error(traceback.format_exc())
+                reschedule = False
+            if reschedule:
+                with self._condition:
+                    self._push(connection, interval,
+                               max(deadline + interval, time.time()))
@@ -8,6 +8,8 @@ from .url import *
 from .get_local_ip import *
 from .atomic_integer import *
 from .list import *
+from .hash_ring import *
 from .constrants import *
-from .time_used import time_used
+from .clock import *
+from .time_used import *
 
@@ -0,0 +1,58 @@
+# coding: utf8
+
+"""
+单调时钟：不受系统时间调整的影响，用于计算时间间隔；
+Python 2中没有time.monotonic()，因此通过ctypes调用clock_gettime()
+"""
+
+__all__ = ["monotonic", "perf_counter"]
+__authors__ = ["Tim Chow"]
+
+import sys
+import time
+import threading
+import logging
+import ctypes
+import ctypes.util
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _make_monotonic():
+    clock_id = 6 if sys.platform == "darwin" else 1  # CLOCK_MONOTONIC
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        # 不设置argtypes：参数总是int和byref()，逐个检查类型的开销比调用本身还大
+        timespec = _Timespec()
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+    except (OSError, AttributeError, TypeError):
+        LOGGER.warning("clock_gettime() is unavailable, "
+                       "fall back to time.time()")
+        return time.time
+
+    # 每个线程预先分配一个timespec及其引用，避免每次调用都创建ctypes对象
+    local = threading.local()
+
+    def monotonic():
+        try:
+            timespec, ref = local.timespec
+        except AttributeError:
+            timespec = _Timespec()
+            ref = ctypes.byref(timespec)
+            local.timespec = timespec, ref
+        clock_gettime(clock_id, ref)
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return monotonic
+
+
+try:
+    from time import monotonic, perf_counter
+except ImportError:
+    # CLOCK_MONOTONIC的精度是纳秒，也可以作为perf_counter使用
+    monotonic = perf_counter = _make_monotonic()
@@ -0,0 +1,86 @@
+# coding: utf8
+
+"""
+一致性哈希环，使用ketama算法生成虚拟节点
+"""
+
+__all__ = ["HashRing"]
+__authors__ = ["Tim Chow"]
+
+import bisect
+import hashlib
+import struct
+
+
+class HashRing(object):
+    def __init__(self, nodes=None, replicas=160):
+        # replicas：每个节点对应的虚拟节点的数量，应该是4的倍数
+        self._replicas = max(replicas // 4, 1) * 4
+        # 有序的虚拟节点哈希值，用于二分查找
+        self._hashes = []
+        self._hash_to_node = {}
+        self._nodes = set()
+        for node in nodes or []:
+            self.add_node(node)
+
+    @staticmethod
+    def _to_bytes(key):
+        if isinstance(key, unicode):
+            return key.encode("utf8")
+        return str(key)
+
+    def _iter_node_hashes(self, node):
+        name = self._to_bytes(node)
+        for index in range(self._replicas // 4):
+            digest = hashlib.md5("%s-%d" % (name, index)).digest()
+            # 每个md5摘要可以生成4个虚拟节点
+            for h in struct.unpack("<IIII", digest):
+                yield h
+
+    def _hash(self, key):
+        digest = hashlib.md5(self._to_bytes(key)).digest()
+        return struct.unpack("<I", digest[:4])[0]
+
+    def add_node(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for h in self._iter_node_hashes(node):
+            # 哈希冲突时，保留先加入的节点
+            if h in self._hash_to_node:
+                continue
+            self._hash_to_node[h] = node
+            bisect.insort(self._hashes, h)
+
+    def remove_node(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        for h in self._iter_node_hashes(node):
+            if self._hash_to_node.get(h) != node:
+                continue
+            del self._hash_to_node[h]
+            del self._hashes[bisect.bisect_left(self._hashes, h)]
+
+    def get_node(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._hash_to_node[self._hashes[index]]
+
+    def copy(self):
+        # 复制已经计算好的虚拟节点，不会重新计算哈希值
+        ring = HashRing(replicas=self._replicas)
+        ring._hashes = list(self._hashes)
+        ring._hash_to_node = dict(self._hash_to_node)
+        ring._nodes = set(self._nodes)
+        return ring
+
+    @property
+    def nodes(self):
+        return frozenset(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
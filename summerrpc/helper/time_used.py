@@ -1,22 +1,93 @@
 # coding: utf8
 
-__all__ = ["time_used"]
+"""
+统计代码段的耗时：
+
+with time_used("connection write", 0.01):
+    ...
+
++ 关闭时返回一个什么也不做的单例，不读取时钟，也不创建对象；
++ 开启时按照sample_rate采样，耗时写入直方图，超过threshold时记录日志
+"""
+
+__all__ = ["time_used", "configure_time_used"]
 __authors__ = ["Tim Chow"]
 
 import logging
-from contextlib import contextmanager
-import time
+import random
+
+from .clock import perf_counter
 
 LOGGER = logging.getLogger(__name__)
 
 
-@contextmanager
+class _NoopTimeUsed(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOOP = _NoopTimeUsed()
+
+
+class _TimeUsed(object):
+    __slots__ = ("_note", "_threshold", "_histogram", "_start_time")
+
+    def __init__(self, note, threshold, histogram):
+        self._note = note
+        self._threshold = threshold
+        self._histogram = histogram
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = perf_counter() - self._start_time
+        if self._histogram is not None:
+            self._histogram.record(elapsed)
+        if elapsed >= self._threshold:
+            LOGGER.info("%s used %fs" % (self._note, elapsed))
+        return False
+
+
+_enabled = True
+_sample_rate = 1.
+_histogram_factory = None
+# note -> 直方图，由_histogram_factory创建
+_histograms = {}
+
+
+def configure_time_used(enabled=True, sample_rate=1., histogram_factory=None):
+    """
+    enabled：为False时，time_used()不做任何事情；
+    sample_rate：被统计的比例，取值范围是(0, 1]；
+    histogram_factory：接收note，返回具有record(elapsed)方法的直方图，比如：
+    + lambda note: MetricsRegistry.default().histogram("time_used", section=note)
+    """
+    global _enabled, _sample_rate, _histogram_factory, _histograms
+    if not 0 < sample_rate <= 1:
+        raise ValueError("sample_rate should be in (0, 1]")
+    _enabled = enabled
+    _sample_rate = sample_rate
+    _histogram_factory = histogram_factory
+    _histograms = {}
+
+
 def time_used(note, threshold=0.1):
-    start_time = time.time()
-    try:
-        yield
-    finally:
-        elapsed = time.time() - start_time
-        if elapsed >= threshold:
-            LOGGER.info("%s used %fs" % (note, elapsed))
+    if not _enabled:
+        return _NOOP
+    if _sample_rate < 1 and random.random() >= _sample_rate:
+        return _NOOP
 
+    histogram = None
+    if _histogram_factory is not None:
+        histogram = _histograms.get(note)
+        if histogram is None:
+            histogram = _histograms[note] = _histogram_factory(note)
+    return _TimeUsed(note, threshold, histogram)
@@ -0,0 +1,97 @@
+# coding: utf8
+
+"""
+服务端的拦截器：在IOLoop线程中、方法被分发到线程池之前执行，
+可以直接返回响应（鉴权、限流、缓存、截止时间检查等），也可以观察调用的结果
+"""
+
+__all__ = ["Interceptor", "RateLimitInterceptor"]
+__authors__ = ["Tim Chow"]
+
+from abc import ABCMeta, abstractmethod
+
+from .helper import LRUCache
+from .result import Result
+from .exception import RateLimitedError
+from .rate_limiter import RateLimiter
+
+
+class Interceptor(object):
+    __metaclass__ = ABCMeta
+
+    # 返回Result对象时，不再执行后续的拦截器和方法，直接把它作为响应；
+    # + 抛出的异常会作为响应的异常
+    def before(self, request, remote_address):
+        return None
+
+    # 调用完成之后执行，result是即将发送的Result对象，elapsed的单位是秒；
+    # + 只有before()被执行过的拦截器才会执行after()
+    def after(self, request, result, elapsed):
+        pass
+
+    # get_order()越大的拦截器越先执行before()，越后执行after()
+    @abstractmethod
+    def get_order(self):
+        pass
+
+
+class RateLimitInterceptor(Interceptor):
+    """
+    按方法和客户端IP限流，超过限制的请求直接返回RateLimitedError，不占用线程池
+    """
+    def __init__(self, client_limiter_factory=None, max_clients=4096, order=0):
+        # client_limiter_factory：无参数的可调用对象，为每个客户端IP创建一个RateLimiter
+        if client_limiter_factory is not None and \
+                not callable(client_limiter_factory):
+            raise TypeError("expect callable, not %s" %
+                            type(client_limiter_factory).__name__)
+        self._client_limiter_factory = client_limiter_factory
+        # 客户端的限流器保存在有界的LRU中，
+        # + before()只在IOLoop线程中执行，因此不需要加锁
+        self._client_limiters = LRUCache(max_clients)
+        # (class_name, method_name) -> RateLimiter
+        self._method_limiters = {}
+        self._order = order
+
+    def set_method_limiter(self, class_name, method_name, rate_limiter):
+        if not isinstance(rate_limiter, RateLimiter):
+            raise TypeError("expect RateLimiter, not %s" %
+                            type(rate_limiter).__name__)
+        self._method_limiters[(class_name, method_name)] = rate_limiter
+        return self
+
+    def _get_client_limiter(self, client):
+        if client in self._client_limiters:
+            return self._client_limiters[client]
+        rate_limiter = self._client_limiter_factory()
+        self._client_limiters[client] = rate_limiter
+        return rate_limiter
+
+    @staticmethod
+    def _reject(msg):
+        result = Result()
+        result.exc = RateLimitedError(msg)
+        return result
+
+    def before(self, request, remote_address):
+        # 先检查客户端的限制，被拒绝的请求不会消耗方法的令牌
+        if self._client_limiter_factory is not None:
+            client = remote_address[0] \
+                if isinstance(remote_address, tuple) else remote_address
+            if not self._get_client_limiter(client).acquire():
+                return self._reject("client %s is rate limited" % (client, ))
+
+        if self._method_limiters:
+            rate_limiter = self._method_limiters.get(
+                (request.class_name, request.method_name))
+            if rate_limiter is not None and not rate_limiter.acquire():
+                return self._reject("method (%s, %s) is rate limited" %
+                                    (request.class_name, request.method_name))
+        return None
+
+    def get_order(self):
+        return self._order
+
+    @property
+    def client_count(self):
+        return self._client_limiters.current_size
@@ -10,6 +10,7 @@ from concurrent.futures import TimeoutError
 from .result import Result
 from .exception import *
 from .helper import *
+from .metrics import MetricsRegistry, ClientMetrics
 
 
 class Invoker(object):
@@ -21,8 +22,21 @@ class Invoker(object):
 
 
 class RpcInvoker(Invoker):
+    def __init__(self, metrics_registry=None):
+        # metrics_registry不为None时，按remote和方法统计各个阶段的耗时
+        if metrics_registry is not None and \
+                not isinstance(metrics_registry, MetricsRegistry):
+            raise TypeError("expect MetricsRegistry, not %s" %
+                            type(metrics_registry).__name__)
+        self._metrics = None if metrics_registry is None \
+            else ClientMetrics(metrics_registry)
+
     def invoke(self, request, connection_context, serializer,
                 write_timeout, read_timeout):
+        if self._metrics is not None:
+            return self._invoke_with_metrics(request, connection_context,
+                    serializer, write_timeout, read_timeout)
+
         # 序列化Request对象
         buff = serializer.dumps(request)
 
@@ -34,11 +48,15 @@ class RpcInvoker(Invoker):
                 except TimeoutError:
                     raise ConnectionWriteTimeout("timeout: %s" % write_timeout)
             read_future = connection.read(transaction_id)
-        try:
-            response = read_future.result(read_timeout)
-        except TimeoutError:
-            raise ConnectionReadTimeout("timeout: %s" % read_timeout)
-        result = serializer.loads(response)
+            # 在with语句内等待响应，读超时等错误会被计入连接的健康状况
+            try:
+                response = read_future.result(read_timeout)
+            except TimeoutError:
+                raise ConnectionReadTimeout("timeout: %s" % read_timeout)
+        return self._get_result(serializer.loads(response))
+
+    @staticmethod
+    def _get_result(result):
         if not isinstance(result, Result):
             raise InvalidResponseError("expect Result, not %s" %
                                        type(result).__name__)
@@ -46,3 +64,46 @@ class RpcInvoker(Invoker):
             raise result.exc
         return result.result
 
+    def _invoke_with_metrics(self, request, connection_context, serializer,
+                             write_timeout, read_timeout):
+        buff = serializer.dumps(request)
+
+        stages = None
+        connect_start = perf_counter()
+        try:
+            with connection_context as connection:
+                write_start = perf_counter()
+                stages = self._metrics.get(connection.remote_address,
+                                           request.class_name,
+                                           request.method_name)
+                stages.connect.record(write_start - connect_start)
+
+                transaction_id, write_future = connection.write(buff, write_timeout)
+                try:
+                    write_future.result(write_timeout)
+                except TimeoutError:
+                    raise ConnectionWriteTimeout("timeout: %s" % write_timeout)
+                wait_start = perf_counter()
+                stages.write.record(wait_start - write_start)
+
+                read_future = connection.read(transaction_id)
+                try:
+                    response = read_future.result(read_timeout)
+                except TimeoutError:
+                    raise ConnectionReadTimeout("timeout: %s" % read_timeout)
+                deserialization_start = perf_counter()
+                stages.wait.record(deserialization_start - wait_start)
+
+            result = serializer.loads(response)
+            stages.deserialization.record_since(deserialization_start)
+            stages.requests.inc()
+            if isinstance(result, Result) and result.exc is not None:
+                stages.errors.inc()
+        except BaseException:
+            # 没有获取到连接时，无法确定remote，不统计
+            if stages is not None:
+                stages.requests.inc()
+                stages.errors.inc()
+            raise
+        return self._get_result(result)
+
@@ -0,0 +1,266 @@
+# coding: utf8
+
+"""
+指标：计数器、仪表和延迟直方图，
++ 服务端按导出的方法统计：排队、执行、序列化、写响应的耗时；
++ 客户端按remote和方法统计：获取连接、写请求、等待响应、反序列化的耗时
+"""
+
+__all__ = ["Counter", "Gauge", "Histogram", "MetricsRegistry",
+           "ServerMetrics", "ClientMetrics", "MetricsService"]
+__authors__ = ["Tim Chow"]
+
+import threading
+import bisect
+
+from .decorator import export
+from .helper import perf_counter
+
+
+class Counter(object):
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, increment=1):
+        with self._lock:
+            self._value = self._value + increment
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return {"value": self._value}
+
+
+class Gauge(object):
+    # func不为None时，读取时调用func获取当前值
+    def __init__(self, func=None):
+        self._value = 0
+        self._func = func
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+def _make_default_bounds():
+    # 从10微秒到约100秒，每个2的幂之间分成4个桶，相对误差不超过19%
+    bounds = []
+    bound = 1e-5
+    while bound < 100:
+        bounds.append(bound)
+        bound = bound * 2 ** 0.25
+    return tuple(bounds)
+
+
+class Histogram(object):
+    """
+    固定桶的直方图：记录时只需要一次二分查找和一次加法；
+    分位数使用所在桶的上界估算，并且不超过记录过的最大值
+    """
+    DEFAULT_BOUNDS = _make_default_bounds()
+
+    def __init__(self, bounds=None):
+        self._bounds = tuple(sorted(bounds)) if bounds else \
+            self.DEFAULT_BOUNDS
+        # 最后一个桶保存大于所有上界的值
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count = 0
+        self._sum = 0.
+        self._max = 0.
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] = self._counts[index] + 1
+            self._count = self._count + 1
+            self._sum = self._sum + value
+            if value > self._max:
+                self._max = value
+
+    # 记录从start（perf_counter()的返回值）到现在的耗时
+    def record_since(self, start):
+        self.record(perf_counter() - start)
+
+    @property
+    def count(self):
+        return self._count
+
+    def percentile(self, percent):
+        with self._lock:
+            counts = self._counts[:]
+            count = self._count
+            max_value = self._max
+        if count == 0:
+            return 0.
+        rank = count * percent / 100.
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen = seen + bucket_count
+            if seen >= rank and bucket_count > 0:
+                if index >= len(self._bounds):
+                    return max_value
+                return min(self._bounds[index], max_value)
+        return max_value
+
+    def snapshot(self):
+        return {"count": self._count,
+                "sum": self._sum,
+                "max": self._max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9)}
+
+
+class MetricsRegistry(object):
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        # (类型, 名称, 排序后的标签) -> 指标
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        # 进程内默认共享的MetricsRegistry，MetricsService导出的就是它
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls()
+        return cls._default
+
+    def _get_or_create(self, type_, name, labels, factory):
+        key = (type_, name, tuple(sorted(labels.iteritems())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    # 获取指标的开销比记录大，调用方应该缓存返回的对象
+    def counter(self, name, **labels):
+        return self._get_or_create("counter", name, labels, Counter)
+
+    def gauge(self, name, func=None, **labels):
+        return self._get_or_create("gauge", name, labels,
+                                   lambda: Gauge(func))
+
+    def histogram(self, name, bounds=None, **labels):
+        return self._get_or_create("histogram", name, labels,
+                                   lambda: Histogram(bounds))
+
+    def snapshot(self):
+        # 返回只包含基本类型的结构，可以被任意序列化器序列化
+        snapshot = {"counter": [], "gauge": [], "histogram": []}
+        for (type_, name, labels), metric in sorted(self._metrics.items()):
+            item = metric.snapshot()
+            item["name"] = name
+            item["labels"] = dict(labels)
+            snapshot[type_].append(item)
+        return snapshot
+
+    def dump_text(self):
+        lines = []
+        for (type_, name, labels), metric in sorted(self._metrics.items()):
+            label_text = ",".join('%s="%s"' % (k, v) for k, v in labels)
+            prefix = "%s{%s}" % (name, label_text) if labels else name
+            item = metric.snapshot()
+            if type_ == "histogram":
+                lines.append("%s count=%d sum=%.6f max=%.6f p50=%.6f "
+                             "p90=%.6f p99=%.6f p999=%.6f" %
+                             (prefix, item["count"], item["sum"],
+                              item["max"], item["p50"], item["p90"],
+                              item["p99"], item["p999"]))
+            else:
+                lines.append("%s %s" % (prefix, item["value"]))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+
+class _Stages(object):
+    # 一组按阶段划分的指标，由ServerMetrics、ClientMetrics创建
+    def __init__(self, registry, prefix, stage_names, **labels):
+        self.requests = registry.counter(prefix + ".requests", **labels)
+        self.errors = registry.counter(prefix + ".errors", **labels)
+        for stage_name in stage_names:
+            setattr(self, stage_name, registry.histogram(
+                "%s.%s" % (prefix, stage_name), **labels))
+
+
+class ServerMetrics(object):
+    STAGES = ("queue_wait", "execution", "serialization", "write")
+
+    def __init__(self, registry):
+        self._registry = registry
+        # 未导出的方法、被拦截器拒绝或者过载的请求，只计入这一个计数器，
+        # + 避免客户端通过任意的方法名创建大量的指标
+        self.rejected = registry.counter("server.rejected")
+        # (class_name, method_name) -> _Stages
+        self._stages = {}
+
+    @property
+    def registry(self):
+        return self._registry
+
+    def get(self, class_name, method_name):
+        key = (class_name, method_name)
+        stages = self._stages.get(key)
+        if stages is None:
+            stages = self._stages[key] = _Stages(
+                self._registry, "server", self.STAGES,
+                method="%s.%s" % key)
+        return stages
+
+
+class ClientMetrics(object):
+    STAGES = ("connect", "write", "wait", "deserialization")
+
+    def __init__(self, registry):
+        self._registry = registry
+        # (remote, class_name, method_name) -> _Stages
+        self._stages = {}
+
+    @property
+    def registry(self):
+        return self._registry
+
+    def get(self, remote, class_name, method_name):
+        key = (remote, class_name, method_name)
+        stages = self._stages.get(key)
+        if stages is None:
+            remote_text = "%s:%s" % remote if isinstance(remote, tuple) \
+                else str(remote)
+            stages = self._stages[key] = _Stages(
+                self._registry, "client", self.STAGES,
+                remote=remote_text,
+                method="%s.%s" % (class_name, method_name))
+        return stages
+
+
+@export("MetricsService")
+class MetricsService(object):
+    """导出MetricsRegistry.default()中的指标，使用Exporter.export()导出"""
+
+    def snapshot(self):
+        return MetricsRegistry.default().snapshot()
+
+    def dump_text(self):
+        return MetricsRegistry.default().dump_text()
@@ -3,33 +3,58 @@
 __all__ = ["Protocol"]
 __authors__ = ["Tim Chow"]
 
-from .filter import Filter
+from functools import partial
+
+from .filter import Filter, AroundFilter
 from .invoker import Invoker
 
 
+def _filter_then_invoke(filter_, invoke, request, *a):
+    filter_.filter(request)
+    return invoke(request, *a)
+
+
 class Protocol(object):
     def __init__(self):
         self._filters = []
         self._invoker = None
+        # 由Filter和Invoker组成的调用链，在添加Filter、设置Invoker时生成
+        self._chain = None
 
     def add_filter(self, filter_):
         if not isinstance(filter_, Filter):
             raise TypeError("expect Filter, not %s" % type(filter_).__name__)
         self._filters.append(filter_)
+        self._compile()
         return self
 
     def set_invoker(self, invoker):
         if not isinstance(invoker, Invoker):
             raise TypeError("expect Invoker, not %s" % type(invoker).__name__)
         self._invoker = invoker
+        self._compile()
         return self
 
+    def _compile(self):
+        if self._invoker is None:
+            return
+        # get_order()越大的Filter越先执行，order相同时按照添加的顺序执行；
+        # + 执行顺序确定之后，从最后执行的Filter开始向外包装
+        filters = sorted(self._filters, key=lambda f: f.get_order(),
+                         reverse=True)
+        chain = self._invoker.invoke
+        for filter_ in reversed(filters):
+            if isinstance(filter_, AroundFilter):
+                chain = partial(filter_.around, chain)
+            else:
+                chain = partial(_filter_then_invoke, filter_, chain)
+        self._chain = chain
+
     def invoke(self, request, connection_context, serializer, write_timeout, read_timeout):
-        filters = sorted(self._filters, key=lambda f: f.get_order(), reverse=True)
-        for filter_ in filters:
-            filter_.filter(request)
-        return self._invoker.invoke(request,
-                                    connection_context,
-                                    serializer,
-                                    write_timeout,
-                                    read_timeout)
+        if self._chain is None:
+            raise RuntimeError("invoker must be provided")
+        return self._chain(request,
+                           connection_context,
+                           serializer,
+                           write_timeout,
+                           read_timeout)
@@ -2,3 +2,4 @@ from .interface import *
 from .token_bucket import *
 from .redis_token_bucket import *
 
+from .leased_redis_token_bucket import *
@@ -0,0 +1,181 @@
+# coding: utf8
+
+__all__ = ["LeasedRedisTokenBucketRateLimiter"]
+__authors__ = ["Tim Chow"]
+
+import threading
+import socket
+import time
+import logging
+import traceback
+
+import redis
+from concurrent.futures import ThreadPoolExecutor
+
+from ..helper import monotonic
+from .interface import RateLimiter
+from .token_bucket import TokenBucketRateLimiter
+
+LOGGER = logging.getLogger(__name__)
+
+
+# 从Redis中的令牌桶租借最多requested个令牌，返回实际租借到的令牌数；
+# + rate是每毫秒产生的令牌数，now的单位是毫秒
+LEASE_SCRIPT = """
+local tokens_key = KEYS[1]
+local timestamp_key = KEYS[2]
+
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local ttl = math.ceil(capacity/rate/1000*2) + 1
+
+local last_tokens = tonumber(redis.call("get", tokens_key)) or capacity
+local last_refreshed = tonumber(redis.call("get", timestamp_key)) or now
+
+local delta = math.max(0, now-last_refreshed)
+local filled_tokens = math.min(capacity, last_tokens+(delta*rate))
+local granted = math.floor(math.min(filled_tokens, requested))
+
+redis.call("setex", tokens_key, ttl, filled_tokens-granted)
+redis.call("setex", timestamp_key, ttl, now)
+
+return granted
+"""
+
+
+class LeasedRedisTokenBucketRateLimiter(RateLimiter):
+    """
+    从Redis中成批地租借令牌，在本地消耗：
+    + 本地剩余的令牌少于lease_size * refill_ratio时，在后台线程中异步地续租，
+      因此大部分acquire()不需要访问Redis；
+    + 租借到的令牌在lease_ttl秒之后过期，避免进程囤积令牌；
+    + Redis不可用时，降级为本地的fallback限流器，每隔retry_interval秒重试一次
+    capacity和rate的含义与TokenBucketRateLimiter相同，rate是每毫秒产生的令牌数
+    """
+    def __init__(self, capacity, rate, redis_url=None, redis_client=None,
+                 key="LeasedRedisTokenBucketRateLimiter", lease_size=None,
+                 refill_ratio=0.5, lease_ttl=1., retry_interval=1.,
+                 fallback=None):
+        if redis_client is None:
+            if redis_url is None:
+                raise ValueError("redis_url or redis_client is required")
+            redis_client = redis.from_url(redis_url)
+        if fallback is not None and not isinstance(fallback, RateLimiter):
+            raise TypeError("expect RateLimiter, not %s" %
+                            type(fallback).__name__)
+
+        self._redis_client = redis_client
+        self._script = redis_client.register_script(LEASE_SCRIPT)
+        self._capacity = capacity
+        self._rate = rate
+        self._keys = [key, "%s.ts" % key]
+        self._lease_size = lease_size or max(1, int(capacity / 10))
+        self._refill_threshold = self._lease_size * refill_ratio
+        self._lease_ttl = lease_ttl
+        self._retry_interval = retry_interval
+        # Redis不可用时，只在本地限流
+        self._fallback = fallback or TokenBucketRateLimiter(capacity, rate)
+
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._lease_deadline = 0.
+        self._refilling = False
+        self._degraded = False
+        # 在此之前不再访问Redis
+        self._next_refill_time = 0.
+        self._executor = ThreadPoolExecutor(1)
+        self._closed = False
+
+        # 启动时同步地租借第一批令牌
+        self._refilling = True
+        self._refill()
+
+    @property
+    def degraded(self):
+        return self._degraded
+
+    @property
+    def local_tokens(self):
+        return self._tokens
+
+    def acquire(self, requested_number=1):
+        acquired = False
+        with self._lock:
+            now = monotonic()
+            if self._lease_deadline <= now:
+                self._tokens = 0
+            if not self._degraded and self._tokens >= requested_number:
+                self._tokens = self._tokens - requested_number
+                acquired = True
+            refill = not self._refilling and not self._closed and \
+                self._tokens < self._refill_threshold and \
+                now >= self._next_refill_time
+            if refill:
+                self._refilling = True
+            degraded = self._degraded
+
+        if refill:
+            try:
+                self._executor.submit(self._refill)
+            except RuntimeError:
+                # 限流器已经被关闭了
+                pass
+        if acquired:
+            return True
+        if degraded:
+            return self._fallback.acquire(requested_number)
+        return False
+
+    def _refill(self):
+        try:
+            try:
+                granted = int(self._script(
+                    keys=self._keys,
+                    args=[self._rate, self._capacity,
+                          time.time() * 1000, self._lease_size]))
+            except (redis.RedisError, socket.error) as ex:
+                LOGGER.warning("lease tokens from redis failed, "
+                               "because %s: %s" % (type(ex).__name__, ex))
+                self._on_refill_failed()
+                return
+            except Exception:
+                # 比如脚本返回了无法解析的结果，同样按照Redis不可用处理
+                LOGGER.error("lease tokens from redis failed")
+                LOGGER.error(traceback.format_exc())
+                self._on_refill_failed()
+                return
+
+            with self._lock:
+                now = monotonic()
+                if self._degraded:
+                    LOGGER.info("redis is reachable again")
+                    self._degraded = False
+                if self._lease_deadline <= now:
+                    self._tokens = 0
+                self._tokens = self._tokens + granted
+                self._lease_deadline = now + self._lease_ttl
+                # 全局的令牌不足时，等待足够的令牌产生之后再续租
+                if granted < self._lease_size:
+                    self._next_refill_time = now + \
+                        (self._lease_size - granted) / (self._rate * 1000.)
+        finally:
+            # 无论如何都要允许下一次续租，否则acquire()会永远返回False
+            with self._lock:
+                self._refilling = False
+
+    def _on_refill_failed(self):
+        with self._lock:
+            if not self._degraded:
+                LOGGER.error("redis is unreachable, "
+                             "fall back to local rate limiting")
+            self._degraded = True
+            self._next_refill_time = monotonic() + self._retry_interval
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False)
+        self._fallback.close()
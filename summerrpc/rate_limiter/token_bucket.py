@@ -1,48 +1,150 @@
 # coding: utf8
 
-__all__ = ["TokenBucketRateLimiter"]
+__all__ = ["TokenBucketRateLimiter", "StripedTokenBucketRateLimiter"]
 __authors__ = ["Tim Chow"]
 
 import threading
+import itertools
 import time
-import math
 
+from ..helper import monotonic
 from .interface import RateLimiter
 
+# 比较浮点数时允许的误差（秒），避免恰好用完令牌时因为舍入误差而被拒绝
+EPSILON = 1e-9
+
 
 class TokenBucketRateLimiter(RateLimiter):
-    def __init__(self, capacity, rate, lock=None):
+    """
+    使用GCRA（通用信元速率算法）实现的令牌桶：
+    + 只保存一个“理论到达时间”，不需要周期性地填充令牌，也不需要取整；
+    + 读取时钟在锁外进行，临界区只有几次浮点数运算
+    capacity是桶的容量，rate是每毫秒产生的令牌数
+    """
+    def __init__(self, capacity, rate, lock=None, clock=monotonic):
+        if capacity <= 0 or rate <= 0:
+            raise ValueError("capacity and rate should be greater than 0")
         self._capacity = capacity
         self._rate = rate
         self._lock = lock or threading.Lock()
-        self._last_refresh_time = 0.
-        self._consumed_tokens = 0
+        self._clock = clock
+        # 产生一个令牌需要的秒数
+        self._interval = 1. / (rate * 1000.)
+        # 桶满时，理论到达时间与当前时间的最大差值
+        self._tolerance = capacity * self._interval
+        # 理论到达时间，为0时表示桶是满的
+        self._tat = 0.
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def rate(self):
+        return self._rate
 
     def acquire(self, requested_number=1):
+        return self.try_acquire(requested_number)[0]
+
+    def try_acquire(self, requested_number=1):
+        """
+        返回(是否获取成功, 需要等待的秒数)；
+        请求的令牌数超过容量时，永远不可能获取成功，等待时间为None
+        """
+        if requested_number > self._capacity:
+            return False, None
+        now = self._clock()
+        increment = requested_number * self._interval
         with self._lock:
-            return self._acquire(requested_number)
+            tat = max(self._tat, now) + increment
+            wait = tat - now - self._tolerance
+            if wait <= EPSILON:
+                self._tat = tat
+                return True, 0.
+        return False, wait
 
-    def _acquire(self, requested_number):
-        # 计算新产生的token
-        now = long(math.floor(time.time() * 1000))
-        time_elapsed_ms = max(0, now - self._last_refresh_time)
-        new_generated_tokens = long(math.floor(time_elapsed_ms * self._rate))
+    def acquire_many(self, requested_number, timeout=None):
+        """
+        阻塞地获取requested_number个令牌，timeout为None时一直等待，
+        超时返回False
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            acquired, wait = self.try_acquire(requested_number)
+            if acquired:
+                return True
+            if wait is None:
+                return False
+            if deadline is not None:
+                remaining = deadline - self._clock()
+                if remaining < wait:
+                    return False
+            time.sleep(wait)
 
-        # 调整更新时间，注意：不能吃掉不足以产生一个令牌的时间
-        self._last_refresh_time = \
-            now - (time_elapsed_ms - long(new_generated_tokens / self._rate))
+    def close(self):
+        pass
 
-        # 当调小令牌桶容量时，需要保证消耗的令牌数不能超过容量
-        self._consumed_tokens = min(self._capacity, self._consumed_tokens)
 
-        # 填充令牌
-        self._consumed_tokens = max(0, self._consumed_tokens - new_generated_tokens)
+class StripedTokenBucketRateLimiter(RateLimiter):
+    """
+    把容量和速率平均分给多个令牌桶，每个线程优先使用固定的令牌桶，
+    以减少多线程对同一把锁的竞争；
+    + 固定的令牌桶不足时，依次尝试其他的令牌桶，因此总的限制不变；
+    + 每次请求的令牌数不能超过单个令牌桶的容量，
+      因此令牌桶的数量不会超过capacity，保证每个令牌桶至少能容纳一个令牌
+    """
+    def __init__(self, capacity, rate, stripes=8, clock=monotonic):
+        if capacity <= 0 or rate <= 0:
+            raise ValueError("capacity and rate should be greater than 0")
+        if stripes < 1:
+            raise ValueError("stripes should be greater than 0")
+        stripes = max(min(int(stripes), int(capacity)), 1)
+        self._clock = clock
+        self._stripes = [
+            TokenBucketRateLimiter(float(capacity) / stripes,
+                                   float(rate) / stripes,
+                                   clock=clock)
+            for _ in range(stripes)]
+        # 线程第一次使用时按顺序分配固定的令牌桶；
+        # + 线程标识是对齐的，直接对它取模会让所有线程都使用同一个令牌桶
+        self._local = threading.local()
+        self._next_stripe = itertools.count()
 
-        if self._consumed_tokens + requested_number <= self._capacity:
-            self._consumed_tokens = self._consumed_tokens + requested_number
-            return True
-        return False
+    def _get_stripe_index(self):
+        index = getattr(self._local, "index", None)
+        if index is None:
+            # itertools.count的next()在GIL的保护下是原子的
+            index = self._local.index = \
+                next(self._next_stripe) % len(self._stripes)
+        return index
+
+    def acquire(self, requested_number=1):
+        return self.try_acquire(requested_number)[0]
+
+    def try_acquire(self, requested_number=1):
+        count = len(self._stripes)
+        index = self._get_stripe_index()
+        min_wait = None
+        for offset in range(count):
+            acquired, wait = self._stripes[(index + offset) % count]\
+                .try_acquire(requested_number)
+            if acquired:
+                return True, 0.
+            if wait is not None and (min_wait is None or wait < min_wait):
+                min_wait = wait
+        return False, min_wait
+
+    def acquire_many(self, requested_number, timeout=None):
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            acquired, wait = self.try_acquire(requested_number)
+            if acquired:
+                return True
+            if wait is None:
+                return False
+            if deadline is not None and deadline - self._clock() < wait:
+                return False
+            time.sleep(wait)
 
     def close(self):
         pass
-
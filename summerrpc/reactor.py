@@ -0,0 +1,79 @@
+# coding: utf8
+
+"""
+客户端的IO线程：每个Reactor是一个运行IOLoop的daemon线程，
+所有的ReactorConnection共享少量的Reactor，而不是每个连接两个线程
+"""
+
+__all__ = ["Reactor", "ReactorPool"]
+__authors__ = ["Tim Chow"]
+
+import threading
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .helper import AtomicInteger
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Reactor(object):
+    def __init__(self, name="summerrpc-reactor"):
+        self._ioloop = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self._ioloop = IOLoop()
+        self._ioloop.make_current()
+        self._started.set()
+        LOGGER.info("reactor started, thread ident: %d" %
+                    threading.currentThread().ident)
+        self._ioloop.start()
+        LOGGER.info("reactor stopped")
+
+    @property
+    def ioloop(self):
+        return self._ioloop
+
+    def in_reactor_thread(self):
+        return threading.currentThread() is self._thread
+
+    def add_callback(self, callback, *a, **kw):
+        # 线程安全，callback会在Reactor线程中执行
+        self._ioloop.add_callback(callback, *a, **kw)
+
+    def stop(self):
+        self._ioloop.add_callback(self._ioloop.stop)
+
+
+class ReactorPool(object):
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, size=1):
+        self._reactors = [Reactor("summerrpc-reactor-%d" % index)
+                          for index in range(max(size, 1))]
+        self._counter = AtomicInteger(0)
+
+    @classmethod
+    def default(cls):
+        # 进程内默认共享的ReactorPool，第一次使用时才创建
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls()
+        return cls._default
+
+    def choice(self):
+        # 轮流把连接分配给各个Reactor
+        index = self._counter.increase(1) % len(self._reactors)
+        return self._reactors[index]
+
+    def stop(self):
+        for reactor in self._reactors:
+            reactor.stop()
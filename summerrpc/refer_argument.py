@@ -12,6 +12,8 @@ class ReferArgument(object):
         self._connection_pool_class = SharedLRUConnectionPool
         self._connection_pool_size = 15
         self._connections_per_key = 1
+        # 每个key最多的连接数量，为None时不会动态地增加连接
+        self._max_connections_per_key = None
 
         self._connection_class = SharedBlockingConnection
         self._client_socket_timeout = 15
@@ -22,6 +24,14 @@ class ReferArgument(object):
         self._max_pending_reads = None
         self._max_pooling_reads = None
         self._heartbeat_interval = None
+        # 方法名 -> 参数下标或函数，用于从请求参数中提取路由键
+        self._hash_arguments = {}
+        # 服务发现到新的remote之后，是否在后台预先建立连接
+        self._warm_up = False
+        # 发现新的remote之后，延迟多少秒再建立连接
+        self._warm_up_delay = 0
+        # 服务端在执行之前拒绝请求（过载、限流）时，重新选择remote重试的次数
+        self._max_rejected_retries = 1
 
     @property
     def connection_pool_class(self):
@@ -47,6 +57,14 @@ class ReferArgument(object):
         self._connections_per_key = connections_per_key
         return self
 
+    @property
+    def max_connections_per_key(self):
+        return self._max_connections_per_key
+
+    def set_max_connections_per_key(self, max_connections_per_key):
+        self._max_connections_per_key = max_connections_per_key
+        return self
+
     @property
     def connection_class(self):
         return self._connection_class
@@ -111,3 +129,53 @@ class ReferArgument(object):
         self._heartbeat_interval = heartbeat_interval
         return self
 
+    @property
+    def warm_up(self):
+        return self._warm_up
+
+    def set_warm_up(self, warm_up):
+        if not isinstance(warm_up, bool):
+            raise TypeError("expect bool, not %s" % type(warm_up).__name__)
+        self._warm_up = warm_up
+        return self
+
+    @property
+    def warm_up_delay(self):
+        return self._warm_up_delay
+
+    def set_warm_up_delay(self, warm_up_delay):
+        if not isinstance(warm_up_delay, (int, long, float)):
+            raise TypeError("expect int or float, not %s" %
+                            type(warm_up_delay).__name__)
+        self._warm_up_delay = warm_up_delay
+        return self
+
+    @property
+    def max_rejected_retries(self):
+        return self._max_rejected_retries
+
+    def set_max_rejected_retries(self, max_rejected_retries):
+        if not isinstance(max_rejected_retries, (int, long)):
+            raise TypeError("expect int, not %s" %
+                            type(max_rejected_retries).__name__)
+        if max_rejected_retries < 0:
+            raise ValueError("max_rejected_retries should not be less than 0")
+        self._max_rejected_retries = max_rejected_retries
+        return self
+
+    @property
+    def hash_arguments(self):
+        return self._hash_arguments
+
+    def set_hash_argument(self, method_name, hash_argument):
+        # hash_argument：位置参数的下标，
+        # + 或者形如 f(args, kwargs) -> hash_key 的函数
+        if not callable(hash_argument) and \
+                not isinstance(hash_argument, (int, long)):
+            raise TypeError("expect int or callable, not %s" %
+                            type(hash_argument).__name__)
+        self._hash_arguments[method_name] = hash_argument
+        return self
+
+    def get_hash_argument(self, method_name):
+        return self._hash_arguments.get(method_name)
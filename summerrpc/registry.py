@@ -1,19 +1,24 @@
 # coding: utf8
 
-__all__ = ["RegisterEntrySet", "Registry", "ZookeeperRegistry"]
+__all__ = ["RegisterEntrySet", "RegistryListener", "Registry",
+           "AbstractRegistry", "ZookeeperRegistry", "StaticRegistry",
+           "FileRegistry"]
 __authors__ = ["Tim Chow"]
 
 from abc import ABCMeta, abstractmethod
 from urllib import unquote
 from urlparse import urlparse
+from functools import partial
 import logging
 import traceback
+import threading
+import json
+import os
+import tempfile
 
 import zookeeper
 
-from .helper import (
-            SafeDict,
-            parse_query)
+from .helper import parse_query
 
 LOGGER = logging.getLogger(__name__)
 
@@ -31,9 +36,28 @@ class RegisterEntrySet(object):
             yield k, v
 
 
+class RegistryListener(object):
+    """服务发现的结果发生变化时，Registry会调用listener的这些方法"""
+
+    # key对应的remotes发生了变化，remotes是变化之后的tuple
+    def on_remotes_changed(self, key, remotes):
+        pass
+
+    # remote第一次出现在任意一个key中
+    def on_remote_added(self, remote):
+        pass
+
+    # remote不再出现在任何一个key中
+    def on_remote_removed(self, remote):
+        pass
+
+
 class Registry(object):
     __metaclass__ = ABCMeta
 
+    # 使用tuple保存listener，添加、删除时整体替换，遍历时不需要加锁
+    _listeners = ()
+
     @abstractmethod
     def register(self, register_entry_set, delete_if_exists):
         pass
@@ -46,6 +70,16 @@ class Registry(object):
     def get_remotes(self, class_name, method_name, transport, serializer):
         pass
 
+    @staticmethod
+    def make_key(class_name, method_name, transport, serializer):
+        # 服务注册时使用的URL的(scheme, path, serializer)
+        return (transport, "/%s/%s" % (class_name, method_name), serializer)
+
+    def get_remotes_by_key(self, key):
+        transport, path, serializer = key
+        _, class_name, method_name = path.split("/", 2)
+        return self.get_remotes(class_name, method_name, transport, serializer)
+
     @abstractmethod
     def close(self):
         pass
@@ -54,10 +88,211 @@ class Registry(object):
     def discovery_successfully(self):
         pass
 
+    # replay：是否把当前的服务发现结果通知给新添加的listener
+    def add_listener(self, listener, replay=False):
+        self._listeners = self._listeners + (listener, )
+        return self
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(l for l in self._listeners
+                                if l is not listener)
+        return self
+
+    def _fire(self, method_name, *a):
+        for listener in self._listeners:
+            try:
+                getattr(listener, method_name)(*a)
+            except BaseException:
+                LOGGER.error("listener %r raised while handling %s" %
+                             (listener, method_name))
+                LOGGER.error(traceback.format_exc())
+
+
+class AbstractRegistry(Registry):
+    """
+    维护服务发现的结果：
+    + 子类只需要给出当前全部的注册项（比如znode的名称），
+    + 以及如何把一个注册项解析成[(key, remote), ...]；
+    + 每次更新只解析新增的注册项，只重建发生变化的key，并通知listener
+    """
+
+    def __init__(self):
+        # key -> tuple of remote
+        # + 每次更新都生成新的字典并整体替换，已经发布的字典不会被修改，
+        # + 因此读取时不需要加锁
+        self._local_cache = {}
+        # 注册项 -> [(key, remote), ...]
+        self._entries = {}
+        # key -> {remote: 引用计数}
+        self._key_to_remotes = {}
+        # remote -> 引用计数
+        self._remote_counts = {}
+        self._update_lock = threading.Lock()
+
+    def add_listener(self, listener, replay=False):
+        if not replay:
+            return super(AbstractRegistry, self).add_listener(listener)
+        # 持有更新锁，保证listener不会漏掉或者重复收到变化
+        with self._update_lock:
+            super(AbstractRegistry, self).add_listener(listener)
+            for key, remotes in self._local_cache.items():
+                listener.on_remotes_changed(key, remotes)
+        return self
+
+    @abstractmethod
+    def _parse_entry(self, entry):
+        pass
+
+    def _parse_url_entry(self, entry, get_data):
+        """
+        解析URLBuilder生成的注册URL：
+        + path不为空时，一个注册项对应一个方法；
+        + path为空时，是服务级别的注册项，调用get_data()获取数据：
+          {"pid": 进程号, "methods": {"Class": ["method", ...], ...}}
+        """
+        url = urlparse(unquote(entry))
+        query = parse_query(url.query)
+        if "serializer" not in query:
+            return []
+        serializer = query["serializer"][0]
+
+        netloc = url.netloc.split(":", 1)
+        if len(netloc) != 2:
+            return []
+        host = netloc[0]
+        port = int(netloc[1])
+
+        if url.path:
+            return [((url.scheme, url.path, serializer), (host, port))]
+
+        methods = json.loads(get_data()).get("methods", {})
+        pairs = []
+        for class_name, method_names in methods.iteritems():
+            for method_name in method_names:
+                key = self.make_key(str(class_name), str(method_name),
+                                    url.scheme, serializer)
+                pairs.append((key, (host, port)))
+        return pairs
+
+    # 返回解析失败的注册项
+    def _update_entries(self, entries):
+        with self._update_lock:
+            latest = set(entries)
+            current = set(self._entries)
+            changed_keys = set()
+            # 本次更新中新增、删除的remote，发布新的快照之后再通知listener
+            added, removed = set(), set()
+
+            for entry in current - latest:
+                for key, remote in self._entries.pop(entry):
+                    if self._remove_remote(key, remote):
+                        removed.add(remote)
+                    changed_keys.add(key)
+
+            failed = []
+            for entry in latest - current:
+                try:
+                    pairs = self._parse_entry(entry)
+                except BaseException as ex:
+                    LOGGER.error("parse entry: %s failed" % entry)
+                    LOGGER.error(traceback.format_exc())
+                    if self._is_transient_error(ex):
+                        # 不记录暂时失败的注册项，下次更新时会重新解析
+                        failed.append(entry)
+                        continue
+                    # 格式错误的注册项永远不会解析成功，记录为空，不再重试
+                    pairs = []
+                self._entries[entry] = pairs
+                for key, remote in pairs:
+                    if self._add_remote(key, remote):
+                        # 在同一次更新中先被删除、又被添加的remote没有变化
+                        if remote in removed:
+                            removed.discard(remote)
+                        else:
+                            added.add(remote)
+                    changed_keys.add(key)
+
+            if not changed_keys:
+                return failed
+
+            local_cache = dict(self._local_cache)
+            for key in changed_keys:
+                remotes = self._key_to_remotes.get(key)
+                if remotes:
+                    local_cache[key] = tuple(sorted(remotes))
+                else:
+                    self._key_to_remotes.pop(key, None)
+                    local_cache.pop(key, None)
+            self._local_cache = local_cache
+            LOGGER.info("%d entries changed, %d keys changed" %
+                        (len(latest ^ current), len(changed_keys)))
+
+            for key in changed_keys:
+                self._fire("on_remotes_changed", key,
+                           local_cache.get(key, ()))
+            for remote in added:
+                self._fire("on_remote_added", remote)
+            for remote in removed:
+                self._fire("on_remote_removed", remote)
+            return failed
+
+    # 解析注册项时抛出的异常是否是暂时的，比如读取注册中心超时
+    def _is_transient_error(self, ex):
+        return False
+
+    # 返回remote是否第一次出现在任意一个key中
+    def _add_remote(self, key, remote):
+        remotes = self._key_to_remotes.setdefault(key, {})
+        remotes[remote] = remotes.get(remote, 0) + 1
+
+        count = self._remote_counts.get(remote, 0)
+        self._remote_counts[remote] = count + 1
+        return count == 0
+
+    # 返回remote是否不再出现在任何一个key中
+    def _remove_remote(self, key, remote):
+        remotes = self._key_to_remotes.get(key, {})
+        count = remotes.get(remote, 0) - 1
+        if count > 0:
+            remotes[remote] = count
+        else:
+            remotes.pop(remote, None)
+
+        count = self._remote_counts.get(remote, 0) - 1
+        if count > 0:
+            self._remote_counts[remote] = count
+            return False
+        self._remote_counts.pop(remote, None)
+        return True
+
+    def _clear_entries(self):
+        with self._update_lock:
+            self._entries.clear()
+            self._key_to_remotes.clear()
+            self._remote_counts.clear()
+            self._local_cache = {}
+
+    def get_remotes(self, class_name, method_name, transport, serializer):
+        return self._local_cache.get(
+            self.make_key(class_name, method_name, transport, serializer), ())
+
+    def get_remotes_by_key(self, key):
+        return self._local_cache.get(key, ())
+
+    def iter_remotes(self):
+        # 遍历当前所有的remote
+        return iter(list(self._remote_counts))
+
+    def discovery_successfully(self):
+        return len(self._local_cache) > 0
+
 
-class ZookeeperRegistry(Registry):
+class ZookeeperRegistry(AbstractRegistry):
     def __init__(self, hosts, base_znode, retry_policy=None,
-                 log_level=zookeeper.LOG_LEVEL_ERROR):
+                 log_level=zookeeper.LOG_LEVEL_ERROR,
+                 discovery_delay=0.2, max_discovery_retries=5,
+                 max_discovery_retry_delay=30.):
+        super(ZookeeperRegistry, self).__init__()
         # 合法的znode名称是：以/开头，除了根znode，其他znode不能以/结尾
         if not isinstance(base_znode, str) or \
                 not base_znode.startswith("/") or \
@@ -72,7 +307,16 @@ class ZookeeperRegistry(Registry):
         self._delete_if_exists = True
 
         self._discovery_handler = None
-        self._local_cache = SafeDict()
+        # 子节点变化之后，延迟discovery_delay秒再拉取子节点，
+        # + 这期间的多次变化只会触发一次拉取
+        self._discovery_delay = discovery_delay
+        self._discovery_timer = None
+        self._discovery_timer_lock = threading.Lock()
+        # 读取注册项的数据暂时失败时，按指数退避重试，最多重试max_discovery_retries次
+        self._max_discovery_retries = max_discovery_retries
+        self._max_discovery_retry_delay = max_discovery_retry_delay
+        self._discovery_retries = 0
+        self._retry_timer = None
 
     def register(self, register_entry_set, delete_if_exists=True):
         if not isinstance(register_entry_set, RegisterEntrySet):
@@ -151,41 +395,80 @@ class ZookeeperRegistry(Registry):
         # 连接或重连成功
         if state == zookeeper.CONNECTED_STATE:
             LOGGER.info("discovery_handler: connect or reconnect successfully")
-            self._real_discovery(
+            self._real_discovery(handler, self._base_znode)
+
+    def _children_watcher(self, handler, type, state, path):
+        with self._discovery_timer_lock:
+            if self._discovery_timer is not None:
+                return
+            self._discovery_timer = threading.Timer(
+                self._discovery_delay,
+                self._delayed_discovery,
+                (handler, path))
+            self._discovery_timer.setDaemon(True)
+            self._discovery_timer.start()
+
+    def _delayed_discovery(self, handler, path):
+        with self._discovery_timer_lock:
+            self._discovery_timer = None
+        self._real_discovery(handler, path)
+
+    # watch为False时不设置watcher，重试时使用，避免重复添加watcher
+    def _real_discovery(self, handler, path, watch=True):
+        try:
+            if watch:
+                children = zookeeper.get_children(
                     handler,
-                    type,
-                    state,
-                    self._base_znode)
-
-    def _real_discovery(self, handler, type, state, path):
-        children = zookeeper.get_children(
-            handler,
-            path,
-            self._real_discovery)
-
-        temp_cache = SafeDict()
-        for child in children:
-            url = urlparse(unquote(child))
-            query = parse_query(url.query)
-            if "serializer" not in query:
-                continue
-            serializer = query["serializer"][0]
-
-            netloc = url.netloc.split(":", 1)
-            if len(netloc) != 2:
-                continue
-            host = netloc[0]
-            port = int(netloc[1])
-
-            k = (url.scheme, url.path, serializer)
-            v = (host, port)
-            temp_cache.setdefault(k, []).append(v)
-        self._local_cache = temp_cache
-        LOGGER.info("local_cache is: %s", self._local_cache)
-
-    def get_remotes(self, class_name, method_name, transport, serializer):
-        k = (transport, "/%s/%s" % (class_name, method_name), serializer)
-        return self._local_cache.get(k, [])
+                    path,
+                    self._children_watcher)
+            else:
+                children = zookeeper.get_children(handler, path)
+        except zookeeper.ZooKeeperException:
+            LOGGER.error("get children of %s failed" % path)
+            LOGGER.error(traceback.format_exc())
+            return
+        if self._update_entries(children):
+            self._schedule_retry(handler, path)
+        else:
+            self._discovery_retries = 0
+
+    def _schedule_retry(self, handler, path):
+        with self._discovery_timer_lock:
+            if self._retry_timer is not None:
+                return
+            if self._discovery_retries >= self._max_discovery_retries:
+                LOGGER.error("give up retrying failed entries of %s "
+                             "until children change" % path)
+                self._discovery_retries = 0
+                return
+            delay = min(self._discovery_delay * 2 ** self._discovery_retries,
+                        self._max_discovery_retry_delay)
+            self._discovery_retries = self._discovery_retries + 1
+            self._retry_timer = threading.Timer(
+                delay, self._retry_discovery, (handler, path))
+            self._retry_timer.setDaemon(True)
+            self._retry_timer.start()
+
+    def _retry_discovery(self, handler, path):
+        with self._discovery_timer_lock:
+            self._retry_timer = None
+        self._real_discovery(handler, path, False)
+
+    def _is_transient_error(self, ex):
+        # 只有读取数据时ZooKeeper返回的错误是暂时的，格式错误不会重试
+        return isinstance(ex, zookeeper.ZooKeeperException)
+
+    def _parse_entry(self, child):
+        return self._parse_url_entry(
+            child,
+            partial(self._get_child_data, child))
+
+    def _get_child_data(self, child):
+        if self._base_znode == "/":
+            znode = "/%s" % child
+        else:
+            znode = "%s/%s" % (self._base_znode, child)
+        return zookeeper.get(self._discovery_handler, znode)[0]
 
     def close(self):
         LOGGER.info("close ZookeeperRegistry")
@@ -201,9 +484,169 @@ class ZookeeperRegistry(Registry):
         except BaseException:
             traceback.print_exc()
 
+        with self._discovery_timer_lock:
+            if self._discovery_timer is not None:
+                self._discovery_timer.cancel()
+                self._discovery_timer = None
+            if self._retry_timer is not None:
+                self._retry_timer.cancel()
+                self._retry_timer = None
+
         self._register_handler = None
         self._discovery_handler = None
-        self._local_cache.clear()
+        self._clear_entries()
 
-    def discovery_successfully(self):
-        return len(self._local_cache) > 0
+
+class StaticRegistry(AbstractRegistry):
+    """
+    进程内的注册中心，注册项保存在内存中，
+    + 适合在本地进行测试、压测等不需要ZooKeeper的场景
+    """
+
+    def __init__(self, urls=None):
+        super(StaticRegistry, self).__init__()
+        # 注册项（URLBuilder生成的URL） -> 数据
+        self._register_entries = {}
+        for url in urls or []:
+            self._register_entries[url] = ""
+        self._discovering = False
+        self._lock = threading.Lock()
+
+    def register(self, register_entry_set, delete_if_exists=True):
+        if not isinstance(register_entry_set, RegisterEntrySet):
+            raise TypeError("expect RegisterEntrySet, not %s" %
+                            type(register_entry_set).__name__)
+        with self._lock:
+            register_entries = dict(self._register_entries)
+            for entry, data in register_entry_set.iter_entry():
+                if entry in register_entries and not delete_if_exists:
+                    raise RuntimeError("%s already exists" % entry)
+                register_entries[entry] = data
+            self._register_entries = register_entries
+        self._refresh()
+
+    def unregister(self, register_entry_set):
+        with self._lock:
+            register_entries = dict(self._register_entries)
+            for entry, _ in register_entry_set.iter_entry():
+                register_entries.pop(entry, None)
+            self._register_entries = register_entries
+        self._refresh()
+
+    def discovery(self):
+        self._discovering = True
+        self._refresh()
+
+    def _refresh(self):
+        if self._discovering:
+            self._update_entries(list(self._register_entries))
+
+    def _parse_entry(self, entry):
+        return self._parse_url_entry(
+            entry,
+            partial(self._register_entries.get, entry, ""))
+
+    def close(self):
+        self._discovering = False
+        self._clear_entries()
+
+
+class FileRegistry(AbstractRegistry):
+    """
+    基于文件的注册中心，文件的格式可以是：
+    + JSON对象：{URL: 数据, ...}；
+    + JSON数组：[URL, ...]；
+    + 每行一个URL，忽略空行和以#开头的行。
+    discovery之后，后台线程会轮询文件的修改时间和大小，变化之后重新加载
+    """
+
+    def __init__(self, path, poll_interval=1.):
+        super(FileRegistry, self).__init__()
+        self._path = path
+        self._poll_interval = poll_interval
+        # 最近一次加载的注册项 -> 数据
+        self._file_entries = {}
+        self._file_stat = None
+        self._poll_thread = None
+        self._closed = threading.Event()
+
+    def register(self, register_entry_set, delete_if_exists=True):
+        if not isinstance(register_entry_set, RegisterEntrySet):
+            raise TypeError("expect RegisterEntrySet, not %s" %
+                            type(register_entry_set).__name__)
+        # 多个进程同时注册时，后写入的会覆盖先写入的；
+        # + 生产环境中，应该只由sidecar写这个文件
+        entries = self._read_file() if os.path.exists(self._path) else {}
+        for entry, data in register_entry_set.iter_entry():
+            if entry in entries and not delete_if_exists:
+                raise RuntimeError("%s already exists" % entry)
+            entries[entry] = data
+        self._write_file(entries)
+
+    def _write_file(self, entries):
+        # 先写临时文件再rename，读取方不会读到写了一半的文件
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.rename(temp_path, self._path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _read_file(self):
+        with open(self._path) as f:
+            content = f.read()
+        if content.lstrip().startswith(("{", "[")):
+            entries = json.loads(content)
+            if isinstance(entries, list):
+                entries = dict.fromkeys(entries, "")
+        else:
+            entries = {}
+            for line in content.splitlines():
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    entries[line] = ""
+        return dict((str(k), v if isinstance(v, basestring)
+                     else json.dumps(v)) for k, v in entries.iteritems())
+
+    def discovery(self):
+        if self._poll_thread is not None:
+            raise RuntimeError("discovery already started")
+        self._reload_if_necessary()
+        self._poll_thread = threading.Thread(target=self._poll)
+        self._poll_thread.setDaemon(True)
+        self._poll_thread.start()
+
+    def _poll(self):
+        while not self._closed.wait(self._poll_interval):
+            try:
+                self._reload_if_necessary()
+            except BaseException:
+                LOGGER.error("reload %s failed" % self._path)
+                LOGGER.error(traceback.format_exc())
+
+    def _reload_if_necessary(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            LOGGER.error("stat %s failed" % self._path)
+            return
+        file_stat = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if file_stat == self._file_stat:
+            return
+        self._file_entries = self._read_file()
+        # 解析成功之后才记录文件的状态，写了一半或者格式错误的文件会在下次轮询时重新读取
+        self._file_stat = file_stat
+        self._update_entries(list(self._file_entries))
+
+    def _parse_entry(self, entry):
+        return self._parse_url_entry(
+            entry,
+            partial(self._file_entries.get, entry, ""))
+
+    def close(self):
+        LOGGER.info("close FileRegistry")
+        self._closed.set()
+        self._clear_entries()
@@ -0,0 +1,193 @@
+# coding: utf8
+
+"""
+remote的调用统计：正在进行的调用数、调用耗时的EWMA，供负载均衡使用；
+以及remote的熔断器，连续失败的remote会被暂时摘除
+"""
+
+__all__ = ["CircuitBreaker", "RemoteStat", "RemoteStats"]
+__authors__ = ["Tim Chow"]
+
+import threading
+import math
+
+from .helper import monotonic
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, open_duration=5.):
+        # 连续失败failure_threshold次之后打开熔断器，
+        # + open_duration秒之后进入半开状态，放行一个探测请求：
+        # + 探测成功则关闭熔断器，失败则重新打开
+        self._failure_threshold = failure_threshold
+        self._open_duration = open_duration
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_time = None
+        self._probe_time = None
+
+    @property
+    def state(self):
+        return self._state
+
+    def is_available(self, now):
+        # 与allow_request()的判断相同，但是不改变状态，也不占用探测请求的名额
+        if self._state == self.CLOSED:
+            return True
+        if self._state == self.OPEN:
+            return now - self._opened_time >= self._open_duration
+        return now - self._probe_time >= self._open_duration
+
+    def allow_request(self, now):
+        if self._state == self.CLOSED:
+            return True
+        if self._state == self.OPEN:
+            if now - self._opened_time < self._open_duration:
+                return False
+            self._state = self.HALF_OPEN
+            self._probe_time = now
+            return True
+        # 半开状态下，同时只放行一个探测请求；
+        # + 探测请求迟迟没有结果时（比如没有被负载均衡选中），再放行一个
+        if now - self._probe_time >= self._open_duration:
+            self._probe_time = now
+            return True
+        return False
+
+    def on_success(self):
+        self._consecutive_failures = 0
+        self._state = self.CLOSED
+
+    def on_failure(self, now):
+        self._consecutive_failures = self._consecutive_failures + 1
+        if self._state == self.HALF_OPEN or \
+                self._consecutive_failures >= self._failure_threshold:
+            self._state = self.OPEN
+            self._opened_time = now
+
+
+class RemoteStat(object):
+    def __init__(self, decay_time, failure_threshold=5, open_duration=5.):
+        # 正在进行的调用数
+        self._active = 0
+        # 调用耗时的指数加权移动平均，单位是秒，还没有完成过调用时为0
+        self._ewma = 0.
+        self._last_update_time = None
+        self._decay_time = decay_time
+        self._circuit_breaker = CircuitBreaker(failure_threshold,
+                                               open_duration)
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def ewma(self):
+        return self._ewma
+
+    @property
+    def circuit_breaker(self):
+        return self._circuit_breaker
+
+    def begin(self):
+        self._active = self._active + 1
+
+    # elapsed为None时只结束调用，不更新耗时
+    def end(self, elapsed, now):
+        self._active = max(self._active - 1, 0)
+        if elapsed is None:
+            return
+
+        # 按照距离上次更新的时间衰减旧值：距离越久，旧值的权重越小；
+        # + 耗时突增时直接取新值（peak EWMA），使慢节点能被迅速避开
+        if self._last_update_time is None or elapsed > self._ewma:
+            self._ewma = elapsed
+        else:
+            weight = math.exp(-max(now - self._last_update_time, 0) /
+                              self._decay_time)
+            self._ewma = self._ewma * weight + elapsed * (1 - weight)
+        self._last_update_time = now
+
+
+class RemoteStats(object):
+    def __init__(self, decay_time=10., failure_threshold=5, open_duration=5.):
+        self._decay_time = decay_time
+        self._failure_threshold = failure_threshold
+        self._open_duration = open_duration
+        self._stats = {}
+        self._lock = threading.Lock()
+        # 熔断器不处于关闭状态的remote的数量，为0时不需要逐个检查
+        self._unhealthy_count = 0
+
+    def get(self, remote):
+        stat = self._stats.get(remote)
+        if stat is not None:
+            return stat
+        with self._lock:
+            stat = self._stats.get(remote)
+            if stat is None:
+                stat = self._stats[remote] = RemoteStat(
+                    self._decay_time,
+                    self._failure_threshold,
+                    self._open_duration)
+            return stat
+
+    def begin_invoke(self, remote):
+        stat = self.get(remote)
+        with self._lock:
+            stat.begin()
+
+    def end_invoke(self, remote, elapsed, failed=False, rejected=False):
+        # failed：是否是连接、传输层面的失败，业务异常不应该算作失败；
+        # + rejected：请求是否在执行之前被服务端拒绝（过载、限流），
+        # + 它既不说明remote健康，也不说明remote不可用，不改变熔断器的状态
+        stat = self.get(remote)
+        now = monotonic()
+        with self._lock:
+            stat.end(elapsed, now)
+            if rejected:
+                return
+            circuit_breaker = stat.circuit_breaker
+            was_closed = circuit_breaker.state == CircuitBreaker.CLOSED
+            if failed:
+                circuit_breaker.on_failure(now)
+            else:
+                circuit_breaker.on_success()
+            is_closed = circuit_breaker.state == CircuitBreaker.CLOSED
+            if was_closed != is_closed:
+                self._unhealthy_count = self._unhealthy_count + \
+                    (1 if was_closed else -1)
+
+    def filter_available(self, remotes):
+        # 过滤掉熔断器打开的remote，只读取状态，不加锁；
+        # + 所有的remote都被熔断时，返回全部的remote，而不是一个也不返回
+        if self._unhealthy_count == 0:
+            return remotes
+        now = monotonic()
+        stats = self._stats
+        available = [remote for remote in remotes
+                     if remote not in stats or
+                     stats[remote].circuit_breaker.is_available(now)]
+        return available or remotes
+
+    def allow_request(self, remote):
+        # 只对最终选中的remote调用，半开状态的探测请求名额在这里被占用
+        if self._unhealthy_count == 0:
+            return True
+        stat = self._stats.get(remote)
+        if stat is None or \
+                stat.circuit_breaker.state == CircuitBreaker.CLOSED:
+            return True
+        with self._lock:
+            return stat.circuit_breaker.allow_request(monotonic())
+
+    def remove(self, remote):
+        with self._lock:
+            stat = self._stats.pop(remote, None)
+            if stat is not None and \
+                    stat.circuit_breaker.state != CircuitBreaker.CLOSED:
+                self._unhealthy_count = self._unhealthy_count - 1
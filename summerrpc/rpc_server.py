@@ -29,6 +29,17 @@ class RpcServerBuilder(object):
         # 连接的最大空闲时间
         self._max_idle_time = 8 * 60 * 60
         self._registry = None
+        # 全局的并发限制，默认是None，也就是不限制
+        self._concurrency_limiter = None
+        # 是否按服务实例注册：每个进程只注册一个znode，方法表保存在znode的数据中；
+        # + 旧版本的客户端无法识别这种格式，所以默认关闭
+        self._service_level_registration = False
+        # 服务端的拦截器
+        self._interceptors = []
+        # 指标，默认是None，也就是不统计
+        self._metrics_registry = None
+        # 分布式追踪，默认是None，也就是不追踪
+        self._tracer = None
 
     def with_server_socket(self, server_socket):
         if not isinstance(server_socket, ServerSocket):
@@ -123,6 +134,40 @@ class RpcServerBuilder(object):
         self._registry = registry
         return self
 
+    def with_concurrency_limiter(self, concurrency_limiter):
+        if not isinstance(concurrency_limiter, ConcurrencyLimiter):
+            raise TypeError("expect ConcurrencyLimiter, not %s" %
+                            type(concurrency_limiter).__name__)
+        self._concurrency_limiter = concurrency_limiter
+        return self
+
+    def with_service_level_registration(self, service_level_registration):
+        if not isinstance(service_level_registration, bool):
+            raise TypeError("expect bool, not %s" %
+                            type(service_level_registration).__name__)
+        self._service_level_registration = service_level_registration
+        return self
+
+    def add_interceptor(self, interceptor):
+        if not isinstance(interceptor, Interceptor):
+            raise TypeError("expect Interceptor, not %s" %
+                            type(interceptor).__name__)
+        self._interceptors.append(interceptor)
+        return self
+
+    def with_metrics_registry(self, metrics_registry):
+        if not isinstance(metrics_registry, MetricsRegistry):
+            raise TypeError("expect MetricsRegistry, not %s" %
+                            type(metrics_registry).__name__)
+        self._metrics_registry = metrics_registry
+        return self
+
+    def with_tracer(self, tracer):
+        if not isinstance(tracer, Tracer):
+            raise TypeError("expect Tracer, not %s" % type(tracer).__name__)
+        self._tracer = tracer
+        return self
+
     @property
     def server_socket(self):
         return self._server_socket
@@ -171,6 +216,26 @@ class RpcServerBuilder(object):
     def registry(self):
         return self._registry
 
+    @property
+    def concurrency_limiter(self):
+        return self._concurrency_limiter
+
+    @property
+    def service_level_registration(self):
+        return self._service_level_registration
+
+    @property
+    def interceptors(self):
+        return self._interceptors
+
+    @property
+    def metrics_registry(self):
+        return self._metrics_registry
+
+    @property
+    def tracer(self):
+        return self._tracer
+
     def build(self):
         if self.server_socket is None or self.exporter is None:
             raise RuntimeError(
@@ -186,7 +251,12 @@ class RpcServerBuilder(object):
                          self.exporter,
                          self.concurrent_request_per_connection,
                          self.max_idle_time,
-                         self.registry)
+                         self.registry,
+                         self.concurrency_limiter,
+                         self.service_level_registration,
+                         self.interceptors,
+                         self.metrics_registry,
+                         self.tracer)
 
 
 class RpcServer(object):
@@ -195,7 +265,9 @@ class RpcServer(object):
                  process_pool_size,
                  transport, serializer, exporter,
                  concurrent_request_per_connection,
-                 max_idle_time, registry):
+                 max_idle_time, registry, concurrency_limiter=None,
+                 service_level_registration=False, interceptors=None,
+                 metrics_registry=None, tracer=None):
         # 当前的并发连接数
         self._current_connections = 0
         # 最大并发连接数
@@ -218,9 +290,21 @@ class RpcServer(object):
         self._serializer = serializer
         self._exporter = exporter
         self._registry = registry
+        self._service_level_registration = service_level_registration
 
         self._concurrent_request_per_connection = concurrent_request_per_connection
         self._max_idle_time = max_idle_time
+        self._concurrency_limiter = concurrency_limiter
+        # 按照执行before()的顺序排列
+        self._interceptors = tuple(sorted(interceptors or [],
+                                          key=lambda i: i.get_order(),
+                                          reverse=True))
+        self._metrics = None
+        if metrics_registry is not None:
+            self._metrics = ServerMetrics(metrics_registry)
+            metrics_registry.gauge("server.connections",
+                                   lambda: self._current_connections)
+        self._tracer = tracer
 
         self._started = False
         self._starting = False
@@ -229,6 +313,23 @@ class RpcServer(object):
         self._start_stop_lock = threading.Lock()
 
         self._id_generator = partial(AtomicInteger(0).increase, 1)
+        self._heartbeat = self._prepare_heartbeat()
+
+    def _prepare_heartbeat(self):
+        # 预先序列化心跳请求和心跳响应，Runner收到心跳时直接在IOLoop线程回复；
+        # + 客户端不关心心跳响应的内容，因此响应的结果是None；
+        # + Exporter没有导出心跳方法时（install_heartbeat=False），不回复心跳
+        heartbeat_method = get_heartbeat_method()
+        if self._exporter.get_method(*heartbeat_method) is None:
+            return None
+        try:
+            request_buff = self._serializer.dumps(make_heartbeat_request())
+            response_buff = self._serializer.dumps(Result())
+        except SerializationError:
+            LOGGER.error("serialize heartbeat failed")
+            LOGGER.error(traceback.format_exc())
+            return None
+        return request_buff, response_buff, heartbeat_method
 
     @property
     def started(self):
@@ -293,7 +394,12 @@ class RpcServer(object):
                        self._thread_pool,
                        self._process_pool,
                        self._ioloop,
-                       self._concurrent_request_per_connection)
+                       self._concurrent_request_per_connection,
+                       self._concurrency_limiter,
+                       self._heartbeat,
+                       self._interceptors,
+                       self._metrics,
+                       self._tracer)
 
     def _close_inactive_connections(self):
         """关闭不活跃连接"""
@@ -322,6 +428,12 @@ class RpcServer(object):
         LOGGER.info("begin to register")
         # 获取服务端的ip和port
         host, port = self._server_socket.getsockname()
+        if self._service_level_registration:
+            res = self._get_service_register_entry_set(host, port)
+            self._registry.register(res, True)
+            LOGGER.info("register end")
+            return
+
         res = RegisterEntrySet()
         for class_name, method_name, _ in self._exporter.iter_method():
             register_url = URLBuilder() \
@@ -336,6 +448,24 @@ class RpcServer(object):
         self._registry.register(res, True)
         LOGGER.info("register end")
 
+    def _get_service_register_entry_set(self, host, port):
+        # 整个进程只注册一个URL，path为空，
+        # + 进程号和导出的方法表保存在数据中：
+        # + {"pid": 进程号, "methods": {"Class": ["method", ...], ...}}
+        methods = {}
+        for class_name, method_name, _ in self._exporter.iter_method():
+            methods.setdefault(class_name, []).append(method_name)
+        register_url = URLBuilder() \
+                .with_scheme(self._transport.get_name()) \
+                .with_host(host) \
+                .with_port(port) \
+                .with_argument("serializer", self._serializer.get_name()) \
+                .with_argument("max_buffer_size", str(self._max_buffer_size)) \
+                .with_argument("pid", str(os.getpid())) \
+                .build(quote_url=True)
+        data = json.dumps({"pid": os.getpid(), "methods": methods})
+        return RegisterEntrySet().with_entry(register_url, data)
+
     def can_start(self):
         if self._starting:
             LOGGER.info("starting")
@@ -455,12 +585,37 @@ def WRAPPER(obj, method_name, *a, **kw):
     return getattr(obj, method_name)(*a, **kw)
 
 
+def TIMED_CALL(stages, submit_time, method, args, kwargs):
+    # 在线程池中执行，分别统计排队和执行的耗时
+    start_time = perf_counter()
+    stages.queue_wait.record(start_time - submit_time)
+    try:
+        return method(*args, **kwargs)
+    finally:
+        stages.execution.record_since(start_time)
+
+
+def RECORD_ELAPSED(histogram, start_time, future):
+    histogram.record_since(start_time)
+
+
+def TRACED_CALL(span, method, *a, **kw):
+    previous = Tracer.activate(span)
+    try:
+        return method(*a, **kw)
+    finally:
+        Tracer.deactivate(previous)
+
+
 class Runner(object):
     def __init__(self, connection_information, remote_address, transport, serializer,
                  exporter, thread_pool, process_pool,
-                 ioloop, concurrent_request_per_connection):
+                 ioloop, concurrent_request_per_connection,
+                 concurrency_limiter=None, heartbeat=None, interceptors=(),
+                 metrics=None, tracer=None):
         LOGGER.debug("accept connection from: %s" % str(remote_address))
         self._connection_information = connection_information
+        self._remote_address = remote_address
         self._stream = self._connection_information.stream
         self._transport = transport
         self._serializer = serializer
@@ -470,6 +625,15 @@ class Runner(object):
         self._ioloop = ioloop
         self._concurrent_request_per_connection = concurrent_request_per_connection
         self._current_concurrency = 0
+        self._concurrency_limiter = concurrency_limiter
+        # (序列化后的心跳请求, 序列化后的心跳响应, (class_name, method_name))
+        self._heartbeat = heartbeat
+        self._interceptors = interceptors
+        # ServerMetrics，为None时不统计
+        self._metrics = metrics
+        self._tracer = tracer
+        # transaction_id -> 正在处理的请求的span
+        self._spans = {}
 
         self._run()
 
@@ -489,12 +653,23 @@ class Runner(object):
                 self._connection_information.timestamp = self._ioloop.time()
                 # 读取请求
                 transaction_id, buff = yield self._transport.read(self._stream)
+                # 心跳请求与预先序列化的完全相同时，不需要反序列化
+                if self._heartbeat is not None and \
+                        len(buff) == len(self._heartbeat[0]) and \
+                        buff == self._heartbeat[0]:
+                    self._send_heartbeat_response(transaction_id)
+                    continue
                 # 反序列化
                 request = self._serializer.loads(buff)
                 if not isinstance(request, Request):
                     LOGGER.error("expect Request, not %s" % type(request).__name__)
                     self._stream.close()
                     break
+                if self._heartbeat is not None and \
+                        (request.class_name, request.method_name) == \
+                        self._heartbeat[2]:
+                    self._send_heartbeat_response(transaction_id)
+                    continue
             except UnsatisfiableReadError:
                 LOGGER.error("read operation unsatisfied")
                 self._stream.close()
@@ -512,22 +687,74 @@ class Runner(object):
 
             self._invoke(request, transaction_id)
 
+    @gen.coroutine
+    def _send_heartbeat_response(self, transaction_id):
+        # 在IOLoop线程中直接回复，不经过线程池和并发限制
+        try:
+            yield self._transport.write(self._stream, transaction_id,
+                                        self._heartbeat[1])
+        except StreamClosedError:
+            LOGGER.debug("stream was closed while writing heartbeat")
+        except StreamBufferFullError:
+            LOGGER.error("stream buffer was full while writing heartbeat")
+
     def _invoke(self, request, transaction_id):
         class_name = request.class_name
         method_name = request.method_name
         args = request.args
         kwargs = request.kwargs
+        begin_time = self._ioloop.time()
+        span = None
+        if self._tracer is not None:
+            span = self._spans[transaction_id] = \
+                self._tracer.start_server_span(request, self._remote_address)
+
+        # 在IOLoop线程中执行拦截器，拦截器返回响应时，不再分发请求
+        if self._interceptors and \
+                self._intercept(request, transaction_id, begin_time):
+            return
+
+        # 超过全局并发限制时，不查找、不执行方法，直接返回过载错误
+        if self._concurrency_limiter is not None and \
+                not self._concurrency_limiter.acquire():
+            LOGGER.debug("concurrency limit reached, reject (%s, %s)" %
+                         (class_name, method_name))
+            if self._metrics is not None:
+                self._metrics.rejected.inc()
+            future = Future()
+            future.set_exception(ServerOverloadedError(
+                "concurrency limit: %d" % self._concurrency_limiter.limit))
+            self._current_concurrency = self._current_concurrency + 1
+            self._ioloop.add_future(future, partial(self._send_response,
+                        request, transaction_id, None, begin_time, None))
+            return
+        start_time = self._ioloop.time()
 
         method = self._exporter.get_method(class_name, method_name)
+        stages = None
         if method is None:
             msg = "the requested method:(%s, %s) is not exported" % (class_name, method_name)
             LOGGER.error(msg)
+            # 方法名由客户端决定，不为它们创建指标，只计入固定的计数器
+            if self._metrics is not None:
+                self._metrics.rejected.inc()
             future = Future()
             future.set_exception(LookupMethodError(msg))
         else:
+            stages = None if self._metrics is None else \
+                self._metrics.get(class_name, method_name)
+            dispatch_time = None if stages is None else perf_counter()
+            # 是否已经分别统计了排队和执行的耗时
+            timed = False
             # 如果方法是tornado协程，则直接在IOLoop线程运行它
             if gen.is_coroutine_function(method):
-                future = method(*args, **kwargs)
+                # 协程第一次yield之前发起的调用会继承span
+                previous = None if span is None else Tracer.activate(span)
+                try:
+                    future = method(*args, **kwargs)
+                finally:
+                    if span is not None:
+                        Tracer.deactivate(previous)
             else:
                 run_in_subprocess = get_run_in_subprocess(method)
                 # 如果方法具有run_in_subprocess标记，并且指定了进程池，
@@ -549,31 +776,105 @@ class Runner(object):
                         future.set_exception(SubmitTaskToProcessPoolError(str(ex)))
                 # 否则，如果指定了线程池，那么在线程中运行它
                 elif self._thread_pool is not None:
-                    future = self._thread_pool.submit(method, *args, **kwargs)
+                    # 在执行方法的线程中设置当前span，嵌套的调用会继承它
+                    if span is not None:
+                        method = partial(TRACED_CALL, span, method)
+                    if stages is None:
+                        future = self._thread_pool.submit(method, *args, **kwargs)
+                    else:
+                        future = self._thread_pool.submit(
+                            TIMED_CALL, stages, dispatch_time,
+                            method, args, kwargs)
+                        timed = True
                 # 如果没指定线程池，那么抛出异常
                 else:
                     future = Future()
                     future.set_exception(ConcurrencyError("no thread pool is specified"))
+            # 协程和进程池中的方法，执行耗时包含了排队的时间
+            if stages is not None and not timed:
+                future.add_done_callback(
+                    partial(RECORD_ELAPSED, stages.execution, dispatch_time))
         self._current_concurrency = self._current_concurrency + 1
         self._ioloop.add_future(future, partial(self._send_response,
-                    request.meta, transaction_id))
+                    request, transaction_id, start_time, begin_time, stages))
 
-    @gen.coroutine
-    def _send_response(self, meta, transaction_id, future):
-        if self._connection_information.stream_closed:
-            raise gen.Return
+    def _intercept(self, request, transaction_id, begin_time):
+        for index, interceptor in enumerate(self._interceptors):
+            try:
+                result = interceptor.before(request, self._remote_address)
+            except BaseException as ex:
+                result = Result()
+                result.exc = ex if isinstance(ex, RemoteError) \
+                    else MethodExecutionError(ex)
+            if result is None:
+                continue
+            result.meta = request.meta
+            if self._metrics is not None:
+                self._metrics.rejected.inc()
+            self._current_concurrency = self._current_concurrency + 1
+            self._write_result(request, transaction_id, begin_time, result,
+                               self._interceptors[:index + 1], None)
+            return True
+        return False
+
+    def _run_after(self, request, result, begin_time, interceptors):
+        elapsed = self._ioloop.time() - begin_time
+        for interceptor in reversed(interceptors):
+            try:
+                interceptor.after(request, result, elapsed)
+            except BaseException:
+                LOGGER.error("interceptor %r raised in after()" % interceptor)
+                LOGGER.error(traceback.format_exc())
+
+    def _send_response(self, request, transaction_id, start_time, begin_time,
+                       stages, future):
+        # start_time为None表示请求没有获取到并发名额
+        if start_time is not None and self._concurrency_limiter is not None:
+            self._concurrency_limiter.release(self._ioloop.time() - start_time)
 
         result = Result()
-        result.meta = meta
+        result.meta = request.meta
         try:
             result.result = future.result()
+        except ServerOverloadedError as ex:
+            result.exc = ex
         except BaseException:
             result.exc = MethodExecutionError(future.exception())
+        self._write_result(request, transaction_id, begin_time, result,
+                           self._interceptors, stages)
+
+    @gen.coroutine
+    # stages为None时不统计，只有导出的方法才有对应的指标
+    def _write_result(self, request, transaction_id, begin_time, result,
+                      interceptors, stages):
+        if interceptors:
+            self._run_after(request, result, begin_time, interceptors)
+
+        span = None
+        if self._tracer is not None:
+            span = self._spans.pop(transaction_id, None)
+        if self._connection_information.stream_closed:
+            if span is not None:
+                self._tracer.finish(span, result.exc)
+            raise gen.Return
+
+        if stages is not None:
+            stages.requests.inc()
+            if result.exc is not None:
+                stages.errors.inc()
 
         try:
-            buff = self._serializer.dumps(result)
+            if stages is None:
+                buff = self._serializer.dumps(result)
+            else:
+                serialize_start = perf_counter()
+                buff = self._serializer.dumps(result)
+                write_start = perf_counter()
+                stages.serialization.record(write_start - serialize_start)
             self._connection_information.timestamp = self._ioloop.time()
             yield self._transport.write(self._stream, transaction_id, buff)
+            if stages is not None:
+                stages.write.record_since(write_start)
         except SerializationError:
             LOGGER.error(traceback.format_exc())
         except StreamClosedError:
@@ -581,6 +882,8 @@ class Runner(object):
         except StreamBufferFullError:
             LOGGER.error("stream buffer was full while writing")
         finally:
+            if span is not None:
+                self._tracer.finish(span, result.exc)
             self._current_concurrency = max(self._current_concurrency - 1, 0)
             self._connection_information.timestamp = self._ioloop.time()
             self._connection_information.read_condition.notify_all()
@@ -7,6 +7,7 @@ import traceback
 import sys
 import os
 import types
+import json
 
 from tornado.ioloop import IOLoop
 from tornado.iostream import (IOStream, 
@@ -28,5 +29,10 @@ from .exception import *
 from .request import Request
 from .decorator import *
 from .connection_information import ConnectionInformation
+from .heartbeat import make_heartbeat_request, get_heartbeat_method
+from .concurrency_limiter import ConcurrencyLimiter
+from .interceptor import Interceptor
+from .metrics import MetricsRegistry, ServerMetrics
+from .tracing import Tracer
 
 EWOULDBLOCK = (socket.errno.EAGAIN, socket.errno.EWOULDBLOCK)
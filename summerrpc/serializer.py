@@ -33,6 +33,13 @@ class Serializer(object):
     def get_name(self):
         pass
 
+    def request_serializer(self, class_name, method_name):
+        """
+        返回用于序列化(class_name, method_name)的请求的序列化器，
+        + 子类可以预先序列化请求中固定不变的部分，默认返回自身
+        """
+        return self
+
 
 class PickleSerializer(Serializer, Singleton):
     def dumps(self, obj, protocol=1):
@@ -19,7 +19,8 @@ from .request import Request
 from .exception import *
 from .heartbeat import *
 from .refer_argument import ReferArgument
-from .connection_pool import get_connection_from_pool
+from .tracing import Tracer
+from .connection_pool import get_connection_from_pool, is_connection_failure
 
 LOGGER = logging.getLogger(__name__)
 
@@ -30,6 +31,9 @@ class Stub(object):
         self._serializer = None
         self._cluster = None
         self._protocol = None
+        # (序列化器, 序列化后的心跳请求)
+        self._heartbeat_buff = None
+        self._tracer = None
 
     def set_transport(self, transport):
         if not isinstance(transport, Transport):
@@ -55,6 +59,12 @@ class Stub(object):
         self._protocol = protocol
         return self
 
+    def set_tracer(self, tracer):
+        if not isinstance(tracer, Tracer):
+            raise TypeError("expect Tracer, not %s" % type(tracer).__name__)
+        self._tracer = tracer
+        return self
+
     def refer(self, class_object, refer_argument=None):
         if not inspect.isclass(class_object):
             raise TypeError("expect class, not %s" % type(class_object).__name__)
@@ -76,7 +86,8 @@ class Stub(object):
                      self._cluster,
                      self._protocol,
                      self.heartbeat_func,
-                     refer_argument)
+                     refer_argument,
+                     self._tracer)
 
     def close(self):
         if self._cluster is not None:
@@ -84,26 +95,15 @@ class Stub(object):
             self._cluster = None
 
     def heartbeat_func(self):
-        class_name = HeartBeatRequest.__name__
-        export = get_export(HeartBeatRequest)
-        if export is not None:
-            class_name = export["name"]
-
-        method_name = "send"
-        provide = get_provide(HeartBeatRequest.send)
-        if provide is not None:
-            if provide["filtered"]:
-                raise RuntimeError("HeartBeatRequest.send is filtered")
-            method_name = provide["name"]
-
-        request = Request()
-        request.class_name = class_name
-        request.method_name = method_name
-        request.args = tuple()
-        request.kwargs = dict()
-        request.meta = None
-
-        return self._serializer.dumps(request)
+        # 心跳请求的内容是固定的，只序列化一次；
+        # + 同时缓存序列化器，序列化器被替换之后重新生成
+        serializer = self._serializer
+        cached = self._heartbeat_buff
+        if cached is not None and cached[0] is serializer:
+            return cached[1]
+        buff = serializer.dumps(make_heartbeat_request())
+        self._heartbeat_buff = (serializer, buff)
+        return buff
 
 
 class Refer(object):
@@ -114,7 +114,8 @@ class Refer(object):
                  cluster,  # 集群层，用于负载均衡，包含Registry
                  protocol,  # 协议层，包含Filter和Invoker
                  heartbeat_func,  # 调用该函数，会返回序列化后的heartbeat请求
-                 refer_argument):
+                 refer_argument,
+                 tracer=None):  # 分布式追踪，为None时不追踪
         self._class_object = class_object
         self._transport = transport
         self._serializer = serializer
@@ -122,15 +123,29 @@ class Refer(object):
         self._heartbeat_func = heartbeat_func
         self._protocol = protocol
         self._refer_argument = refer_argument
+        self._tracer = tracer
+        pool_kwargs = {}
+        if refer_argument.max_connections_per_key is not None:
+            pool_kwargs["max_connections_per_key"] = \
+                refer_argument.max_connections_per_key
         self._connection_pool = refer_argument.connection_pool_class(
             refer_argument.connection_pool_size,
-            refer_argument.connections_per_key)
+            refer_argument.connections_per_key,
+            **pool_kwargs)
 
         self._class_name = self._class_object.__name__
         export = get_export(self._class_object)
         if export is not None:
             self._class_name = export["name"]
 
+        # method_name -> Cluster.make_key()生成的key
+        self._remote_keys = {}
+
+        self._connection_warmer = None
+        if refer_argument.warm_up:
+            self._connection_warmer = _ConnectionWarmer(self)
+            self._cluster.add_listener(self._connection_warmer, True)
+
     def __getattr__(self, attr_name):
         attr = getattr(self._class_object, attr_name, None)
         if attr is None:
@@ -146,7 +161,10 @@ class Refer(object):
                 raise RuntimeError("method %s.%s is not exported" %
                         (self._class_name, attr_name))
             method_name = provide["name"]
-        return self._dynamic_proxy(method_name)
+        # 缓存生成的代理方法，之后的访问不会再进入__getattr__
+        proxy = self._dynamic_proxy(method_name)
+        setattr(self, attr_name, proxy)
+        return proxy
 
     def _connection_factory(self, host, port):
         sock = ClientSocketBuilder() \
@@ -166,23 +184,68 @@ class Refer(object):
                                         self._heartbeat_func)
         return connection
 
-    def _get_connnection_context(self, method_name):
-        # 获取要连接到的远程服务的地址
-        remote = self._cluster.get_remote(
+    def _get_hash_key(self, method_name, args, kwargs):
+        hash_argument = self._refer_argument.get_hash_argument(method_name)
+        if hash_argument is None:
+            return None
+        if callable(hash_argument):
+            return hash_argument(args, kwargs)
+        if -len(args) <= hash_argument < len(args):
+            return args[hash_argument]
+        return None
+
+    def _get_remote_key(self, method_name):
+        key = self._remote_keys.get(method_name)
+        if key is None:
+            key = self._remote_keys[method_name] = self._cluster.make_key(
                 self._class_name,
                 method_name,
                 self._transport.get_name(),
                 self._serializer.get_name())
+        return key
+
+    def _get_remote(self, method_name, hash_key=None):
+        # 获取要连接到的远程服务的地址
+        remote = self._cluster.get_remote_by_key(
+                self._get_remote_key(method_name),
+                hash_key)
         if remote is None:
             raise NoRemoteServerError(
                 "there is no remote server")
+        return remote
+
+    def _get_connnection_context(self, remote):
         return get_connection_from_pool(
                 self._connection_pool,
                 remote,
                 partial(self._connection_factory, remote[0], remote[1]))
 
     def _dynamic_proxy(self, method_name):
+        # 序列化器可以为每个方法提供专用的实现，默认就是self._serializer
+        serializer = self._serializer.request_serializer(
+            self._class_name, method_name)
+
         def _inner(*args, **kwargs):
+            hash_key = self._get_hash_key(method_name, args, kwargs)
+            remote = self._get_remote(method_name, hash_key)
+            # 被拒绝的请求没有执行过，可以安全地在其他remote上重试
+            retries = self._refer_argument.max_rejected_retries
+            excluded = []
+            while True:
+                try:
+                    return _invoke(remote, args, kwargs)
+                except (ServerOverloadedError, RateLimitedError):
+                    if retries <= 0:
+                        raise
+                    retries = retries - 1
+                    excluded.append(remote)
+                    remote = self._cluster.get_remote_by_key(
+                        self._get_remote_key(method_name), hash_key, excluded)
+                    # 没有其他remote时，不再重试
+                    if remote is None:
+                        raise
+
+        def _invoke(remote, args, kwargs):
             # 生成Request对象
             request = Request()
             request.class_name = self._class_name
@@ -190,15 +253,73 @@ class Refer(object):
             request.args = args
             request.kwargs = kwargs
 
-            return self._protocol.invoke(
-                        request,
-                        self._get_connnection_context(method_name),
-                        self._serializer,
-                        self._refer_argument.write_timeout,
-                        self._refer_argument.read_timeout)
+            # 把trace_id和span_id放在meta中，传递给服务端
+            span = error = None
+            if self._tracer is not None:
+                span = self._tracer.start_client_span(
+                    self._class_name, method_name, remote)
+                request.meta = self._tracer.inject(span, request.meta)
+            # 统计remote的调用数和调用耗时，供Cluster做负载均衡
+            self._cluster.begin_invoke(remote)
+            start_time = monotonic()
+            failed = rejected = False
+            try:
+                return self._protocol.invoke(
+                            request,
+                            self._get_connnection_context(remote),
+                            serializer,
+                            self._refer_argument.write_timeout,
+                            self._refer_argument.read_timeout)
+            except BaseException as ex:
+                failed = is_connection_failure(ex)
+                rejected = isinstance(
+                    ex, (ServerOverloadedError, RateLimitedError))
+                error = ex
+                raise
+            finally:
+                self._cluster.end_invoke(remote, monotonic() - start_time,
+                                         failed, rejected)
+                if span is not None:
+                    self._tracer.finish(span, error)
         return _inner
 
     def refer_close(self):
+        if self._connection_warmer is not None:
+            self._cluster.remove_listener(self._connection_warmer)
+            self._connection_warmer = None
         # 关闭连接池
         self._connection_pool.close()
 
+
+class _ConnectionWarmer(object):
+    """
+    订阅服务发现的变化：
+    + 发现提供该服务的新remote时，在后台预先建立连接；
+    + remote下线之后，关闭到它的连接
+    """
+
+    def __init__(self, refer):
+        self._refer = refer
+        self._transport_name = refer._transport.get_name()
+        self._serializer_name = refer._serializer.get_name()
+        self._path_prefix = "/%s/" % refer._class_name
+
+    def on_remotes_changed(self, key, remotes):
+        transport, path, serializer = key
+        if transport != self._transport_name or \
+                serializer != self._serializer_name or \
+                not path.startswith(self._path_prefix):
+            return
+        refer = self._refer
+        for remote in remotes:
+            refer._connection_pool.warm_up(
+                remote,
+                partial(refer._connection_factory, remote[0], remote[1]),
+                refer._refer_argument.warm_up_delay)
+
+    def on_remote_added(self, remote):
+        pass
+
+    def on_remote_removed(self, remote):
+        self._refer._connection_pool.evict(remote)
+
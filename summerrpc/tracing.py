@@ -0,0 +1,250 @@
+# coding: utf8
+
+"""
+分布式追踪：
++ 客户端为每次调用生成一个span，把trace_id和span_id放在Request.meta中；
++ 服务端从meta中取出它们，生成子span，并在执行方法的线程中把它设置为当前span，
+  因此方法中发起的调用会继承同一个trace；
++ 结束的span被交给SpanSink，比如内存中的环形缓冲区或者文件
+"""
+
+__all__ = ["Span", "SpanSink", "RingBufferSpanSink", "FileSpanSink",
+           "Tracer", "get_current_span"]
+__authors__ = ["Tim Chow"]
+
+from abc import ABCMeta, abstractmethod
+from collections import deque
+import threading
+import random
+import json
+import time
+import logging
+import traceback
+from Queue import Queue, Full, Empty
+
+from .helper import perf_counter
+
+LOGGER = logging.getLogger(__name__)
+
+# Request.meta中使用的key
+TRACE_ID = "trace_id"
+SPAN_ID = "span_id"
+SAMPLED = "sampled"
+
+_local = threading.local()
+
+
+def get_current_span():
+    """返回当前线程正在处理的span，没有时返回None"""
+    return getattr(_local, "span", None)
+
+
+def _generate_id():
+    return "%016x" % random.getrandbits(64)
+
+
+class Span(object):
+    CLIENT = "client"
+    SERVER = "server"
+
+    def __init__(self, name, kind, trace_id, span_id, parent_id=None,
+                 sampled=True, remote=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.remote = remote
+        # start_time是墙上时间，用于对齐不同主机上的span；耗时使用perf_counter计算
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self._start_counter = perf_counter()
+
+    def finish(self, error=None):
+        self.duration = perf_counter() - self._start_counter
+        if error is not None:
+            self.error = "%s: %s" % (type(error).__name__, error)
+
+    def to_dict(self):
+        remote = self.remote
+        if isinstance(remote, tuple):
+            remote = "%s:%s" % remote[:2]
+        return {"name": self.name,
+                "kind": self.kind,
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "remote": remote,
+                "start_time": self.start_time,
+                "duration": self.duration,
+                "error": self.error}
+
+    def __repr__(self):
+        return "Span%r" % (self.to_dict(), )
+
+
+class SpanSink(object):
+    __metaclass__ = ABCMeta
+
+    # 在结束span的线程中调用，应该尽快返回
+    @abstractmethod
+    def emit(self, span):
+        pass
+
+    def close(self):
+        pass
+
+
+class RingBufferSpanSink(SpanSink):
+    """在内存中保存最近的capacity个span，主要用于测试和在线查看"""
+
+    def __init__(self, capacity=10000):
+        # deque的append是线程安全的，满了之后自动丢弃最旧的span
+        self._spans = deque(maxlen=capacity)
+
+    def emit(self, span):
+        self._spans.append(span)
+
+    def spans(self, trace_id=None):
+        # 在C代码中复制，不会与其他线程的append交错
+        spans = list(self._spans)
+        if trace_id is None:
+            return spans
+        return [span for span in spans if span.trace_id == trace_id]
+
+
+class FileSpanSink(SpanSink):
+    """
+    每个span以一行JSON的形式追加到文件中：
+    + emit()只把span放入队列，由后台线程序列化、批量写入并flush，
+      不会在IOLoop线程中进行磁盘IO；
+    + 队列满时丢弃新的span，而不是阻塞调用方
+    """
+
+    _STOP = object()
+
+    def __init__(self, path, max_queue_size=10000):
+        self._file = open(path, "a")
+        self._queue = Queue(max_queue_size)
+        self._dropped = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write_spans)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def emit(self, span):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(span)
+        except Full:
+            self._dropped = self._dropped + 1
+
+    def _write_spans(self):
+        while True:
+            # 等待第一个span，然后取出队列中所有的span，一起写入
+            spans = [self._queue.get()]
+            while True:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            stopped = any(span is self._STOP for span in spans)
+            lines = [json.dumps(span.to_dict()) + "\n"
+                     for span in spans if span is not self._STOP]
+            try:
+                self._file.writelines(lines)
+                self._file.flush()
+            except (IOError, OSError):
+                LOGGER.error("write spans failed")
+                LOGGER.error(traceback.format_exc())
+            if stopped:
+                return
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # 写完队列中剩余的span之后再关闭文件
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._file.close()
+
+
+class Tracer(object):
+    def __init__(self, sink, sample_rate=1.):
+        if not isinstance(sink, SpanSink):
+            raise TypeError("expect SpanSink, not %s" % type(sink).__name__)
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate should be in [0, 1]")
+        self._sink = sink
+        # 只在trace的入口采样，下游沿用上游的决定
+        self._sample_rate = sample_rate
+
+    @property
+    def sink(self):
+        return self._sink
+
+    def start_client_span(self, class_name, method_name, remote=None):
+        # 继承当前线程的span，否则开始一个新的trace
+        parent = get_current_span()
+        if parent is None:
+            trace_id, parent_id = _generate_id(), None
+            sampled = random.random() < self._sample_rate
+        else:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+            sampled = parent.sampled
+        return Span("%s.%s" % (class_name, method_name), Span.CLIENT,
+                    trace_id, _generate_id(), parent_id, sampled, remote)
+
+    @staticmethod
+    def inject(span, meta):
+        # 返回新的meta，不修改调用方传入的dict
+        meta = dict(meta) if isinstance(meta, dict) else {}
+        meta[TRACE_ID] = span.trace_id
+        meta[SPAN_ID] = span.span_id
+        meta[SAMPLED] = span.sampled
+        return meta
+
+    def start_server_span(self, request, remote=None):
+        meta = request.meta
+        name = "%s.%s" % (request.class_name, request.method_name)
+        if isinstance(meta, dict) and meta.get(TRACE_ID):
+            return Span(name, Span.SERVER, meta[TRACE_ID], _generate_id(),
+                        meta.get(SPAN_ID), not not meta.get(SAMPLED, True),
+                        remote)
+        # 上游没有开启追踪时，从这里开始一个新的trace
+        return Span(name, Span.SERVER, _generate_id(), _generate_id(), None,
+                    random.random() < self._sample_rate, remote)
+
+    def finish(self, span, error=None):
+        span.finish(error)
+        if not span.sampled:
+            return
+        try:
+            self._sink.emit(span)
+        except BaseException as ex:
+            LOGGER.error("emit span failed, because %s: %s" %
+                         (type(ex).__name__, ex))
+
+    @staticmethod
+    def activate(span):
+        """把span设置为当前线程的span，返回之前的span，用于恢复"""
+        previous = getattr(_local, "span", None)
+        _local.span = span
+        return previous
+
+    @staticmethod
+    def deactivate(previous):
+        _local.span = previous
+
+    def close(self):
+        self._sink.close()
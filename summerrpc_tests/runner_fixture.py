@@ -0,0 +1,71 @@
+# coding: utf8
+
+"""在单独的IOLoop中用Runner处理请求，不需要真实的socket"""
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.locks import Condition
+import tornado.gen as gen
+
+from summerrpc.rpc_server import Runner
+from summerrpc.connection_information import ConnectionInformation
+from summerrpc.serializer import PickleSerializer
+
+REMOTE_ADDRESS = ("127.0.0.1", 10000)
+
+
+class FakeStream(object):
+    def closed(self):
+        return False
+
+
+class FakeTransport(object):
+    # 依次返回预先序列化好的请求，之后的read()永远不会完成
+    def __init__(self, requests):
+        self._requests = list(requests)
+        self.responses = []
+
+    def read(self, stream):
+        future = Future()
+        if self._requests:
+            future.set_result(self._requests.pop(0))
+        return future
+
+    def write(self, stream, transaction_id, buff):
+        self.responses.append((transaction_id, buff))
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def run_requests(exporter, requests, serializer=None, timeout=5,
+                 **runner_kwargs):
+    """
+    requests是Request对象的列表，transaction_id是它们的下标；
+    返回transaction_id -> 反序列化之后的Result
+    """
+    serializer = serializer or PickleSerializer()
+    transport = FakeTransport([(transaction_id, serializer.dumps(request))
+                               for transaction_id, request
+                               in enumerate(requests)])
+    ioloop = IOLoop()
+    thread_pool = ThreadPoolExecutor(2)
+
+    @gen.coroutine
+    def main():
+        connection_information = ConnectionInformation(
+            FakeStream(), ioloop.time(), Condition())
+        Runner(connection_information, REMOTE_ADDRESS, transport,
+               serializer, exporter, thread_pool, None, ioloop, 100,
+               **runner_kwargs)
+        while len(transport.responses) < len(requests):
+            yield gen.sleep(0.005)
+
+    try:
+        ioloop.run_sync(main, timeout)
+    finally:
+        thread_pool.shutdown()
+        ioloop.close()
+    return dict((transaction_id, serializer.loads(buff))
+                for transaction_id, buff in transport.responses)
@@ -0,0 +1,32 @@
+# coding: utf8
+
+import unittest
+import threading
+import time
+
+from summerrpc.helper import clock
+
+
+class TestClock(unittest.TestCase):
+    def testMonotonicAcrossThreads(self):
+        monotonic = clock._make_monotonic()
+        start = monotonic()
+        time.sleep(0.01)
+        self.assertTrue(monotonic() - start >= 0.009)
+
+        # 每个线程使用自己的timespec，并发调用时不会读到其他线程的值
+        errors = []
+
+        def run():
+            last = monotonic()
+            for _ in range(10000):
+                now = monotonic()
+                if now < last:
+                    errors.append((last, now))
+                last = now
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
@@ -0,0 +1,216 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.cluster import (
+    RoundRobinCluster,
+    LeastActiveCluster,
+    P2CEWMACluster,
+    ConsistentHashCluster
+)
+from summerrpc.helper import HashRing
+from summerrpc.remote_stats import CircuitBreaker
+
+
+class FakeRegistry(object):
+    def __init__(self, remotes):
+        self._remotes = remotes
+
+    def make_key(self, class_name, method_name, transport, serializer):
+        return (transport, "/%s/%s" % (class_name, method_name), serializer)
+
+    def get_remotes(self, class_name, method_name, transport, serializer):
+        return self._remotes
+
+    def get_remotes_by_key(self, key):
+        return self._remotes
+
+    def add_listener(self, listener):
+        pass
+
+    def remove_listener(self, listener):
+        pass
+
+    def close(self):
+        pass
+
+
+REMOTES = [("127.0.0.1", 8001), ("127.0.0.1", 8002), ("127.0.0.1", 8003)]
+
+
+class TestCluster(unittest.TestCase):
+    def _get_remote(self, cluster):
+        return cluster.get_remote("Service", "method", "record", "pickle")
+
+    def testRoundRobinCluster(self):
+        cluster = RoundRobinCluster(FakeRegistry(REMOTES))
+        chosen = [self._get_remote(cluster) for _ in range(6)]
+        self.assertEqual(sorted(chosen[:3]), REMOTES)
+        self.assertEqual(chosen[:3], chosen[3:])
+
+    def testExcludedRemotes(self):
+        key = ("record", "/Service/method", "pickle")
+        cluster = RoundRobinCluster(FakeRegistry(REMOTES))
+        for _ in range(3):
+            self.assertEqual(
+                cluster.get_remote_by_key(key, None, REMOTES[:2]),
+                REMOTES[2])
+        self.assertEqual(cluster.get_remote_by_key(key, None, REMOTES), None)
+
+        cluster = ConsistentHashCluster(FakeRegistry(REMOTES))
+        remote = cluster.get_remote_by_key(key, "user")
+        other = cluster.get_remote_by_key(key, "user", [remote])
+        self.assertTrue(other is not None and other != remote)
+        # 排除是临时的，不会修改哈希环
+        self.assertEqual(cluster.get_remote_by_key(key, "user"), remote)
+
+    def testLeastActiveCluster(self):
+        cluster = LeastActiveCluster(FakeRegistry(REMOTES))
+        cluster.begin_invoke(REMOTES[0])
+        cluster.begin_invoke(REMOTES[2])
+        self.assertEqual(self._get_remote(cluster), REMOTES[1])
+        cluster.begin_invoke(REMOTES[1])
+        cluster.begin_invoke(REMOTES[1])
+        cluster.end_invoke(REMOTES[2], 0.01)
+        self.assertEqual(self._get_remote(cluster), REMOTES[2])
+
+    def testP2CEWMACluster(self):
+        remotes = REMOTES[:2]
+        cluster = P2CEWMACluster(FakeRegistry(remotes))
+        cluster.begin_invoke(remotes[0])
+        cluster.end_invoke(remotes[0], 1.0)
+        cluster.begin_invoke(remotes[1])
+        cluster.end_invoke(remotes[1], 0.01)
+        for _ in range(10):
+            self.assertEqual(self._get_remote(cluster), remotes[1])
+
+    def testP2CEWMAClusterUnknownRemote(self):
+        remotes = REMOTES[:2]
+        cluster = P2CEWMACluster(FakeRegistry(remotes), default_latency=1.)
+        cluster.begin_invoke(remotes[0])
+        cluster.end_invoke(remotes[0], 0.01)
+        # 没有完成过调用、也没有正在进行的调用的remote会被优先尝试
+        self.assertEqual(self._get_remote(cluster), remotes[1])
+        # 卡住的remote上的调用迟迟不结束，它的负载随着调用数增加
+        for _ in range(3):
+            cluster.begin_invoke(remotes[1])
+        for _ in range(10):
+            self.assertEqual(self._get_remote(cluster), remotes[0])
+
+    def testP2CEWMAClusterRejectedRemote(self):
+        remotes = REMOTES[:2]
+        cluster = P2CEWMACluster(FakeRegistry(remotes), default_latency=1.)
+        for remote in remotes:
+            cluster.begin_invoke(remote)
+            cluster.end_invoke(remote, 0.05)
+        # 很快返回的拒绝不会降低remote的负载，流量会离开被拒绝的remote
+        for _ in range(3):
+            cluster.begin_invoke(remotes[0])
+            cluster.end_invoke(remotes[0], 0.0001, rejected=True)
+        for _ in range(10):
+            self.assertEqual(self._get_remote(cluster), remotes[1])
+
+    def testRejectedNotCountedByCircuitBreaker(self):
+        cluster = RoundRobinCluster(FakeRegistry(REMOTES[:1]))
+        stats = cluster._remote_stats
+        for _ in range(4):
+            cluster.begin_invoke(REMOTES[0])
+            cluster.end_invoke(REMOTES[0], 0.01, failed=True)
+        # 拒绝不算作成功，不会重置连续失败的次数
+        cluster.begin_invoke(REMOTES[0])
+        cluster.end_invoke(REMOTES[0], 0.001, rejected=True)
+        self.assertEqual(stats.get(REMOTES[0]).ewma, 0.01)
+        cluster.begin_invoke(REMOTES[0])
+        cluster.end_invoke(REMOTES[0], 0.01, failed=True)
+        self.assertEqual(stats.get(REMOTES[0]).circuit_breaker.state,
+                         CircuitBreaker.OPEN)
+
+    def testConsistentHashCluster(self):
+        remotes = list(REMOTES)
+        cluster = ConsistentHashCluster(FakeRegistry(remotes))
+        keys = ["key-%d" % i for i in range(1000)]
+        before = dict((key, cluster.get_remote("Service", "method",
+                        "record", "pickle", key)) for key in keys)
+        self.assertEqual(set(before.values()), set(REMOTES))
+
+        # 移除一个节点后，只有原来落在该节点上的key会被重新路由
+        cluster._registry = FakeRegistry(REMOTES[:2])
+        for key in keys:
+            remote = cluster.get_remote("Service", "method",
+                                        "record", "pickle", key)
+            if before[key] != REMOTES[2]:
+                self.assertEqual(remote, before[key])
+            else:
+                self.assertTrue(remote in REMOTES[:2])
+
+
+class TestHashRing(unittest.TestCase):
+    def testAddAndRemoveNode(self):
+        ring = HashRing(["a", "b"], replicas=40)
+        self.assertEqual(len(ring), 2)
+        ring.add_node("c")
+        copied = ring.copy()
+        ring.remove_node("a")
+        self.assertEqual(ring.nodes, frozenset(["b", "c"]))
+        self.assertEqual(copied.nodes, frozenset(["a", "b", "c"]))
+        for i in range(100):
+            self.assertTrue(ring.get_node(i) in ("b", "c"))
+        self.assertEqual(HashRing().get_node("key"), None)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def testStateTransition(self):
+        breaker = CircuitBreaker(failure_threshold=2, open_duration=1)
+        breaker.on_failure(0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.on_failure(0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request(0.5))
+        # 半开状态只放行一个探测请求
+        self.assertTrue(breaker.allow_request(1))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow_request(1.5))
+        breaker.on_failure(1.5)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow_request(2.5))
+        breaker.on_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def testClusterSkipsOpenRemote(self):
+        cluster = RoundRobinCluster(FakeRegistry(REMOTES))
+        for _ in range(5):
+            cluster.begin_invoke(REMOTES[0])
+            cluster.end_invoke(REMOTES[0], 0.01, True)
+        for _ in range(10):
+            self.assertNotEqual(
+                cluster.get_remote("Service", "method", "record", "pickle"),
+                REMOTES[0])
+
+    def _open_breaker(self, cluster, remote):
+        for _ in range(5):
+            cluster.begin_invoke(remote)
+            cluster.end_invoke(remote, 0.01, True)
+        return cluster._remote_stats.get(remote).circuit_breaker
+
+    def testHalfOpenProbeOnlyForChosenRemote(self):
+        remotes = REMOTES[:2]
+        cluster = RoundRobinCluster(FakeRegistry(remotes))
+        breaker = self._open_breaker(cluster, remotes[0])
+        # 模拟熔断时间已经过去
+        breaker._opened_time = breaker._opened_time - 10
+        self.assertTrue(breaker.is_available(breaker._opened_time + 10))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        chosen = [cluster.get_remote("Service", "method", "record", "pickle")
+                  for _ in range(10)]
+        # 只有一个探测请求被放行，并且只在remote被选中时才占用名额
+        self.assertEqual(chosen.count(remotes[0]), 1)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def testAllRemotesOpenFailOpen(self):
+        cluster = RoundRobinCluster(FakeRegistry(REMOTES))
+        for remote in REMOTES:
+            self._open_breaker(cluster, remote)
+        self.assertTrue(
+            cluster.get_remote("Service", "method", "record", "pickle")
+            in REMOTES)
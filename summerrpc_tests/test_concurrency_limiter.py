@@ -0,0 +1,31 @@
+import unittest
+
+from summerrpc.concurrency_limiter import AIMDConcurrencyLimiter
+
+
+class TestAIMDConcurrencyLimiter(unittest.TestCase):
+    def testAcquire(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release(0.01)
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertTrue(limiter.acquire())
+
+    def testDecreaseOnHighLatency(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=10,
+                                         latency_threshold=0.1,
+                                         backoff_ratio=0.5)
+        limiter.acquire()
+        limiter.release(1)
+        self.assertEqual(limiter.limit, 5)
+
+    def testIncreaseWhenSaturated(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=2, max_limit=3)
+        for _ in range(100):
+            limiter.acquire()
+            limiter.acquire()
+            limiter.release(0.01)
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 3)
@@ -0,0 +1,186 @@
+# coding: utf8
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from summerrpc.configuration_center import (
+    AbstractConfigurationCenter,
+    MemoryConfigurationCenter,
+    SnapshotConfigurationCenter,
+    ZookeeperConfigurationCenter
+)
+from summerrpc.configuration_center import \
+    zookeeper_configuration_center as zkcc_module
+
+
+class FakeConfigurationCenter(AbstractConfigurationCenter):
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Listener(object):
+    def __init__(self):
+        self.changes = []
+
+    def on_key_changed(self, key, value):
+        self.changes.append((key, value))
+
+
+class TestAbstractConfigurationCenter(unittest.TestCase):
+    def testTypedAccessors(self):
+        center = FakeConfigurationCenter()
+        self.assertFalse(center.success)
+        self.assertEqual(center.get_int("size", 8), 8)
+        center._replace_all({"size": ("16", 1), "ratio": ("0.5", 1),
+                             "enabled": ("true", 1),
+                             "hosts": ('["a", "b"]', 1)}, 3)
+        self.assertTrue(center.success)
+        self.assertEqual(center.main_version, 3)
+        self.assertEqual(center.get_int("size"), 16)
+        self.assertEqual(center.get_float("ratio"), 0.5)
+        self.assertTrue(center.get_bool("enabled"))
+        # 值没有变化时，返回同一个解析结果
+        hosts = center.get_json("hosts")
+        self.assertEqual(hosts, ["a", "b"])
+        self.assertTrue(center.get_json("hosts") is hosts)
+        center._update("hosts", '["c"]', 2)
+        self.assertEqual(center.get_json("hosts"), ["c"])
+        # 解析失败时返回默认值
+        center._update("size", "sixteen", 2)
+        self.assertEqual(center.get_int("size", 8), 8)
+
+    def testListener(self):
+        center = FakeConfigurationCenter()
+        listener, size_listener = Listener(), Listener()
+        center.add_listener(listener).add_listener(size_listener, "size")
+        center._replace_all({"size": ("16", 1), "name": ("foo", 1)})
+        center._update("size", "16", 2)
+        center._update("size", "32", 3)
+        # 过期的版本会被忽略
+        center._update("size", "64", 1)
+        center._replace_all({"size": ("32", 3)})
+        self.assertEqual(center.get_key("size"), "32")
+        self.assertEqual(size_listener.changes, [("size", "16"),
+                                                 ("size", "32")])
+        self.assertEqual(sorted(listener.changes[:2]),
+                         [("name", "foo"), ("size", "16")])
+        self.assertEqual(listener.changes[2:], [("size", "32"),
+                                                ("name", None)])
+
+
+class FakeZookeeper(object):
+    # path -> (data, version)，记录每个path上注册的watcher
+    def __init__(self, nodes):
+        self.nodes = dict(nodes)
+        self.watchers = {}
+
+    def get(self, handler, path, watcher=None):
+        if path not in self.nodes:
+            raise zkcc_module.zookeeper.NoNodeException(path)
+        self.watchers[path] = watcher
+        data, version = self.nodes[path]
+        return data, {"version": version}
+
+    def get_children(self, handler, path, watcher=None):
+        self.watchers[path] = watcher
+        prefix = path.rstrip("/") + "/"
+        return [p[len(prefix):] for p in self.nodes if p.startswith(prefix)]
+
+
+class TestZookeeperConfigurationCenter(unittest.TestCase):
+    def setUp(self):
+        self._zk = FakeZookeeper({"/conf": ("", 1),
+                                  "/conf/size": ("16", 1),
+                                  "/conf/name": ("foo", 1)})
+        self._get = zkcc_module.zookeeper.get
+        self._get_children = zkcc_module.zookeeper.get_children
+        zkcc_module.zookeeper.get = self._zk.get
+        zkcc_module.zookeeper.get_children = self._zk.get_children
+        self._center = ZookeeperConfigurationCenter("127.0.0.1:2181", "/conf")
+        self._listener = Listener()
+        self._center.add_listener(self._listener)
+        self._center._real_start(0)
+        del self._listener.changes[:]
+
+    def tearDown(self):
+        zkcc_module.zookeeper.get = self._get
+        zkcc_module.zookeeper.get_children = self._get_children
+
+    def _fire(self, type_, path):
+        state = zkcc_module.zookeeper.CONNECTED_STATE
+        self._zk.watchers[path](0, type_, state, path)
+
+    def testKeyChanged(self):
+        self.assertEqual(self._center.main_version, 1)
+        self.assertEqual(self._center.get_int("size"), 16)
+        self._zk.nodes["/conf/size"] = ("32", 2)
+        self._fire(zkcc_module.zookeeper.CHANGED_EVENT, "/conf/size")
+        # 只重新拉取发生变化的key，解析结果随之失效
+        self.assertEqual(self._center.get_int("size"), 32)
+        self.assertEqual(self._center.get_version("size"), 2)
+        self.assertEqual(self._listener.changes, [("size", "32")])
+
+    def testKeyAddedAndDeleted(self):
+        self._zk.nodes["/conf/ratio"] = ("0.5", 1)
+        self._fire(zkcc_module.zookeeper.CHILD_EVENT, "/conf")
+        self.assertEqual(self._center.get_float("ratio"), 0.5)
+        self.assertEqual(self._listener.changes, [("ratio", "0.5")])
+
+        del self._listener.changes[:]
+        del self._zk.nodes["/conf/name"]
+        self._fire(zkcc_module.zookeeper.DELETED_EVENT, "/conf/name")
+        self._fire(zkcc_module.zookeeper.CHILD_EVENT, "/conf")
+        self.assertEqual(self._center.get_key("name"), None)
+        self.assertEqual(dict(self._center.iteritems()),
+                         {"size": "16", "ratio": "0.5"})
+        self.assertEqual(self._listener.changes, [("name", None)])
+
+    def testStaleVersionIgnored(self):
+        self._zk.nodes["/conf/size"] = ("32", 3)
+        self._fire(zkcc_module.zookeeper.CHANGED_EVENT, "/conf/size")
+        # 延迟到达的旧版本不会覆盖新的值
+        self._zk.nodes["/conf/size"] = ("24", 2)
+        self._fire(zkcc_module.zookeeper.CHANGED_EVENT, "/conf/size")
+        self.assertEqual(self._center.get_int("size"), 32)
+        self.assertEqual(self._center.get_version("size"), 3)
+        self.assertEqual(self._listener.changes, [("size", "32")])
+
+
+class TestSnapshotConfigurationCenter(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, "snapshot.json")
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def testServeSnapshotAtBoot(self):
+        memory = MemoryConfigurationCenter({"size": "16", "name": "foo"})
+        with SnapshotConfigurationCenter(memory, self._path) as center:
+            self.assertEqual(center.get_int("size"), 16)
+            memory.set("size", "32")
+            self.assertEqual(center.get_int("size"), 32)
+
+        # 配置中心还没有返回配置时，使用快照
+        memory = MemoryConfigurationCenter()
+        memory.start = lambda: None
+        center = SnapshotConfigurationCenter(memory, self._path)
+        center.start()
+        self.assertTrue(center.success)
+        self.assertEqual(dict(center.iteritems()),
+                         {"size": "32", "name": "foo"})
+
+        # 配置中心加载之后，以配置中心为准
+        listener = Listener()
+        center.add_listener(listener)
+        memory.load({"size": "32", "ratio": "0.5"})
+        self.assertEqual(dict(center.iteritems()),
+                         {"size": "32", "ratio": "0.5"})
+        self.assertEqual(sorted(listener.changes),
+                         [("name", None), ("ratio", "0.5")])
+        center.close()
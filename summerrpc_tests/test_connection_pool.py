@@ -1,20 +1,29 @@
+# coding: utf8
+
 import unittest
+import time
+import threading
 
 from summerrpc.connection_pool import (
     DedicateLRUConnectionPool,
     SharedLRUConnectionPool,
     get_connection_from_pool
 )
-from summerrpc.exception import NoAvailableConnectionError
+from summerrpc.exception import (
+    NoAvailableConnectionError,
+    ConnectionReadTimeout,
+    MethodExecutionError
+)
 
 
 class FakeConnection(object):
     def __init__(self):
         self.closed = False
         self.closing = False
+        self.in_flight = 0
 
     def close(self):
-        pass
+        self.closed = True
 
 
 class TestConnectionPool(unittest.TestCase):
@@ -102,3 +111,189 @@ class TestConnectionPool(unittest.TestCase):
         print("===testClosedDedicateConnection===")
         pool.close()
 
+
+    def testWarmUpAndEvict(self):
+        pool = SharedLRUConnectionPool(2, 2)
+        created = []
+
+        def connection_factory():
+            connection = FakeConnection()
+            created.append(connection)
+            return connection
+        key = "5"
+        pool.warm_up(key, connection_factory)
+        for _ in range(100):
+            if len(created) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(created), 2)
+        conn1 = pool.get_connection(key, connection_factory)
+        self.assertTrue(conn1 in created)
+        self.assertEqual(len(created), 2)
+
+        pool.evict(key)
+        pool.get_connection(key, connection_factory)
+        self.assertEqual(len(created), 4)
+        pool.close()
+
+    def testCreateConnectionsOutsideGlobalLock(self):
+        pool = SharedLRUConnectionPool(2, 1)
+        slow_started = threading.Event()
+        slow_finished = threading.Event()
+        created = []
+
+        def slow_connection_factory():
+            slow_started.set()
+            slow_finished.wait(5)
+            created.append("slow")
+            return FakeConnection()
+
+        def get_slow_connection():
+            pool.get_connection("slow", slow_connection_factory)
+        threads = [threading.Thread(target=get_slow_connection)
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        slow_started.wait(5)
+
+        # 其他key的调用方不会被正在建立的慢连接阻塞
+        conn = pool.get_connection("fast", lambda : FakeConnection())
+        self.assertTrue(conn is not None)
+        self.assertFalse(slow_finished.is_set())
+
+        slow_finished.set()
+        for thread in threads:
+            thread.join()
+        # 同一个key的多个调用方共享一次创建
+        self.assertEqual(created, ["slow"])
+        pool.close()
+
+    def testLeastInFlightConnection(self):
+        pool = SharedLRUConnectionPool(1, 3)
+        connection_factory = lambda : FakeConnection()
+        key = "6"
+        conn1 = pool.get_connection(key, connection_factory)
+        conn1.in_flight = 2
+        conn2 = pool.get_connection(key, connection_factory)
+        conn2.in_flight = 1
+        conn3 = pool.get_connection(key, connection_factory)
+        self.assertTrue(conn3 is not conn1 and conn3 is not conn2)
+        conn3.in_flight = 3
+        self.assertTrue(pool.get_connection(key, connection_factory) is conn2)
+        pool.close()
+
+    def testScaleConnections(self):
+        pool = SharedLRUConnectionPool(1, 1, max_connections_per_key=2,
+                                       scale_up_in_flight=2,
+                                       scale_down_idle_time=0)
+        connection_factory = lambda : FakeConnection()
+        key = "7"
+        borrowed = []
+        conn1 = pool.get_connection(key, connection_factory)
+        borrowed.append(conn1)
+        conn1.in_flight = 2
+        borrowed.append(pool.get_connection(key, connection_factory))
+        for _ in range(100):
+            conn2 = pool.get_connection(key, connection_factory)
+            borrowed.append(conn2)
+            if conn2 is not conn1:
+                break
+            time.sleep(0.01)
+        self.assertTrue(conn2 is not conn1)
+        for connection in borrowed:
+            pool.release_connection(key, connection)
+
+        # 负载降低之后，关闭空闲的连接
+        conn1.in_flight = 0
+        pool.get_connection(key, connection_factory)
+        self.assertTrue(conn2.closed or conn1.closed)
+        pool.close()
+
+    def testShrinkWaitsForBorrowedConnection(self):
+        pool = SharedLRUConnectionPool(1, 1, max_connections_per_key=2,
+                                       scale_up_in_flight=2,
+                                       scale_down_idle_time=60)
+        connection_factory = lambda : FakeConnection()
+        key = "9"
+        conn1 = pool.get_connection(key, connection_factory)
+        conn1.in_flight = 2
+        pool.release_connection(key, conn1)
+        pool.get_connection(key, connection_factory)
+        pool.release_connection(key, conn1)
+        for _ in range(100):
+            if len(pool._pool[key].connections) == 2:
+                break
+            time.sleep(0.01)
+        conn1.in_flight = 0
+
+        # 两个连接都被调用方选中了，但是还没有开始写
+        first = pool.get_connection(key, connection_factory)
+        second = pool.get_connection(key, connection_factory)
+        self.assertTrue(first is not second)
+        # 缩容移除了其中一个连接，但是在归还之前不会关闭它
+        container = pool._pool[key]
+        pool._shrink(container)
+        self.assertEqual(len(container.connections), 1)
+        self.assertFalse(first.closed or second.closed)
+        pool.release_connection(key, first)
+        pool.release_connection(key, second)
+        self.assertTrue(first.closed != second.closed)
+        pool.close()
+
+    def testDedicatePoolAcceptsMaxConnectionsPerKey(self):
+        pool = DedicateLRUConnectionPool(1, 1, max_connections_per_key=4)
+        connection = pool.get_connection("10", lambda : FakeConnection())
+        pool.release_connection("10", connection)
+        pool.close()
+
+    def testDegradedConnectionIsReplaced(self):
+        pool = SharedLRUConnectionPool(1, 1, max_connection_failures=2)
+        connection_factory = lambda : FakeConnection()
+        key = "8"
+        for _ in range(2):
+            try:
+                with get_connection_from_pool(pool, key,
+                                              connection_factory) as conn1:
+                    raise ConnectionReadTimeout("timeout")
+            except ConnectionReadTimeout:
+                pass
+        # 不健康的连接在下次被选中时被替换，没有其他调用方使用时立即关闭
+        self.assertFalse(conn1.closed)
+        conn2 = pool.get_connection(key, connection_factory)
+        self.assertTrue(conn2 is not conn1)
+        self.assertTrue(conn1.closed)
+        pool.release_connection(key, conn2)
+
+        # 业务异常不会影响连接的健康状况
+        for _ in range(3):
+            try:
+                with get_connection_from_pool(pool, key, connection_factory):
+                    raise MethodExecutionError("error")
+            except MethodExecutionError:
+                pass
+        self.assertFalse(conn2.closed)
+        pool.close()
+
+    def testDegradedConnectionWaitsForBorrowers(self):
+        pool = SharedLRUConnectionPool(1, 1, max_connection_failures=1)
+        connection_factory = lambda : FakeConnection()
+        key = "9"
+        conn1 = pool.get_connection(key, connection_factory)
+        # 另一个调用方在同一个连接上的调用失败，连接被判定为不健康
+        try:
+            with get_connection_from_pool(pool, key,
+                                          connection_factory) as conn:
+                self.assertTrue(conn is conn1)
+                raise ConnectionReadTimeout("timeout")
+        except ConnectionReadTimeout:
+            pass
+        self.assertFalse(conn1.closed)
+
+        # 新的调用方使用新的连接，正在进行的调用不会被中断
+        conn2 = pool.get_connection(key, connection_factory)
+        self.assertTrue(conn2 is not conn1)
+        self.assertFalse(conn1.closed)
+        pool.release_connection(key, conn1)
+        self.assertTrue(conn1.closed)
+        self.assertFalse(conn2.closed)
+        pool.close()
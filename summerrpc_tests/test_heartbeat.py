@@ -0,0 +1,125 @@
+# coding: utf8
+
+import unittest
+import threading
+import socket
+import time
+
+from summerrpc.heartbeat import HeartbeatScheduler, make_heartbeat_request
+from summerrpc.helper import ServerSocketBuilder
+from summerrpc.exporter import Exporter
+from summerrpc.rpc_server import RpcServerBuilder
+from summerrpc.connection import SharedBlockingConnection
+from summerrpc.transport import BlockingRecordTransport
+from summerrpc.serializer import PickleSerializer
+from summerrpc.exception import MethodExecutionError
+
+from summerrpc_tests.runner_fixture import run_requests
+
+
+class FakeConnection(object):
+    def __init__(self, max_heartbeats):
+        self.heartbeats = 0
+        self._max_heartbeats = max_heartbeats
+        self.finished = threading.Event()
+
+    def send_heartbeat(self):
+        self.heartbeats = self.heartbeats + 1
+        if self.heartbeats >= self._max_heartbeats:
+            self.finished.set()
+            return False
+        return True
+
+
+class TestHeartbeatScheduler(unittest.TestCase):
+    def testSchedule(self):
+        scheduler = HeartbeatScheduler()
+        slow = FakeConnection(2)
+        fast = FakeConnection(5)
+        scheduler.schedule(slow, 0.05)
+        scheduler.schedule(fast, 0.01)
+        self.assertTrue(fast.finished.wait(5))
+        self.assertTrue(slow.finished.wait(5))
+        # send_heartbeat返回False之后，不会再被调度
+        self.assertEqual(fast.heartbeats, 5)
+        self.assertEqual(slow.heartbeats, 2)
+
+
+def prepare_heartbeat(exporter):
+    # 返回RpcServer交给Runner的(心跳请求, 心跳响应, (class_name, method_name))
+    server_socket = ServerSocketBuilder() \
+        .with_host("127.0.0.1") \
+        .with_port(0) \
+        .with_non_blocking() \
+        .build()
+    try:
+        return RpcServerBuilder() \
+            .with_server_socket(server_socket) \
+            .with_exporter(exporter) \
+            .build()._heartbeat
+    finally:
+        server_socket.close()
+
+
+class TestServerHeartbeat(unittest.TestCase):
+    def testRunnerAnswersHeartbeat(self):
+        exporter = Exporter()
+        heartbeat = prepare_heartbeat(exporter)
+        self.assertTrue(heartbeat is not None)
+        # 与预先序列化的心跳请求不完全相同时，按照方法名识别
+        request = make_heartbeat_request()
+        request.meta = {"trace_id": "abc"}
+        results = run_requests(exporter, [make_heartbeat_request(), request],
+                               heartbeat=heartbeat)
+        for transaction_id in (0, 1):
+            self.assertEqual(results[transaction_id].exc, None)
+            self.assertEqual(results[transaction_id].result, None)
+
+    def testHeartbeatNotInstalled(self):
+        exporter = Exporter(install_heartbeat=False)
+        heartbeat = prepare_heartbeat(exporter)
+        self.assertEqual(heartbeat, None)
+        result = run_requests(exporter, [make_heartbeat_request()],
+                              heartbeat=heartbeat)[0]
+        self.assertTrue(isinstance(result.exc, MethodExecutionError))
+
+
+class TestClientHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self._client_socket, self._server_socket = socket.socketpair()
+        self._transport = BlockingRecordTransport()
+        self._heartbeat_buff = PickleSerializer().dumps(
+            make_heartbeat_request())
+        # heartbeat_interval为None时不会被HeartbeatScheduler调度，由测试调用
+        self._connection = SharedBlockingConnection(
+            self._client_socket, self._transport,
+            heartbeat_func=lambda: self._heartbeat_buff)
+
+    def tearDown(self):
+        self._connection.close()
+        self._server_socket.close()
+
+    def _wait(self, predicate):
+        deadline = time.time() + 2
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def testSendHeartbeat(self):
+        self.assertTrue(self._connection.send_heartbeat())
+        transaction_id, buff = self._transport.read(self._server_socket)
+        self.assertEqual(buff, self._heartbeat_buff)
+        self.assertEqual(self._connection._heartbeats.current_size, 1)
+        self._transport.write(self._server_socket, transaction_id, "")
+        # 收到心跳响应之后，不再等待它
+        self.assertTrue(self._wait(
+            lambda: self._connection._heartbeats.current_size == 0))
+        self.assertFalse(self._connection.closed)
+
+    def testMissingHeartbeatsCloseConnection(self):
+        # 服务端不回复心跳，最多等待4个心跳
+        for _ in range(4):
+            self.assertTrue(self._connection.send_heartbeat())
+            self._transport.read(self._server_socket)
+        self.assertFalse(self._connection.send_heartbeat())
+        self.assertTrue(self._wait(lambda: self._connection.closed))
@@ -0,0 +1,129 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.interceptor import Interceptor, RateLimitInterceptor
+from summerrpc.rate_limiter import TokenBucketRateLimiter
+from summerrpc.request import Request
+from summerrpc.result import Result
+from summerrpc.exporter import Exporter
+from summerrpc.exception import RateLimitedError, MethodExecutionError
+
+from summerrpc_tests.runner_fixture import run_requests
+
+
+def make_request(class_name, method_name):
+    request = Request()
+    request.class_name = class_name
+    request.method_name = method_name
+    return request
+
+
+class TestRateLimitInterceptor(unittest.TestCase):
+    def testMethodLimit(self):
+        interceptor = RateLimitInterceptor()
+        # rate很小，测试期间不会产生新的令牌
+        interceptor.set_method_limiter(
+            "Service", "method", TokenBucketRateLimiter(2, 1e-6))
+        request = make_request("Service", "method")
+        address = ("127.0.0.1", 10000)
+        self.assertEqual(interceptor.before(request, address), None)
+        self.assertEqual(interceptor.before(request, address), None)
+        result = interceptor.before(request, address)
+        self.assertTrue(isinstance(result.exc, RateLimitedError))
+        # 其他方法不受限制
+        self.assertEqual(interceptor.before(
+            make_request("Service", "other"), address), None)
+
+    def testClientLimit(self):
+        interceptor = RateLimitInterceptor(
+            lambda: TokenBucketRateLimiter(1, 1e-6), max_clients=2)
+        request = make_request("Service", "method")
+        self.assertEqual(interceptor.before(request, ("10.0.0.1", 1)), None)
+        # 同一个IP的不同连接共享限制
+        result = interceptor.before(request, ("10.0.0.1", 2))
+        self.assertTrue(isinstance(result.exc, RateLimitedError))
+        self.assertEqual(interceptor.before(request, ("10.0.0.2", 1)), None)
+        self.assertEqual(interceptor.before(request, ("10.0.0.3", 1)), None)
+        self.assertEqual(interceptor.client_count, 2)
+
+
+class Service(object):
+    calls = []
+
+    def method(self):
+        Service.calls.append("method")
+        return "ok"
+
+
+class RecordInterceptor(Interceptor):
+    # action为None时放行，为Result时直接响应，为异常对象时抛出它
+    def __init__(self, name, order, calls, action=None):
+        self._name = name
+        self._order = order
+        self._calls = calls
+        self._action = action
+
+    def before(self, request, remote_address):
+        self._calls.append("before " + self._name)
+        if isinstance(self._action, BaseException):
+            raise self._action
+        return self._action
+
+    def after(self, request, result, elapsed):
+        self._calls.append("after " + self._name)
+
+    def get_order(self):
+        return self._order
+
+
+class TestRunnerInterceptors(unittest.TestCase):
+    def setUp(self):
+        Service.calls = []
+        self._exporter = Exporter().export(Service)
+        self._calls = []
+
+    def _run(self, interceptors):
+        # RpcServer按照get_order()从大到小排序之后交给Runner
+        interceptors = tuple(sorted(interceptors,
+                                    key=lambda i: i.get_order(),
+                                    reverse=True))
+        return run_requests(self._exporter,
+                            [make_request("Service", "method")],
+                            interceptors=interceptors)[0]
+
+    def testAllInterceptorsRun(self):
+        result = self._run([
+            RecordInterceptor("low", 1, self._calls),
+            RecordInterceptor("high", 2, self._calls)])
+        self.assertEqual(result.result, "ok")
+        self.assertEqual(Service.calls, ["method"])
+        self.assertEqual(self._calls, ["before high", "before low",
+                                       "after low", "after high"])
+
+    def testBeforeReturnsResult(self):
+        response = Result()
+        response.result = "intercepted"
+        result = self._run([
+            RecordInterceptor("low", 1, self._calls),
+            RecordInterceptor("middle", 2, self._calls, response),
+            RecordInterceptor("high", 3, self._calls)])
+        self.assertEqual(result.result, "intercepted")
+        # 方法和之后的拦截器都不会执行，只有执行过before()的拦截器执行after()
+        self.assertEqual(Service.calls, [])
+        self.assertEqual(self._calls, ["before high", "before middle",
+                                       "after middle", "after high"])
+
+    def testBeforeRaises(self):
+        result = self._run([
+            RecordInterceptor("raise", 1, self._calls, ValueError("bad"))])
+        self.assertTrue(isinstance(result.exc, MethodExecutionError))
+        self.assertEqual(Service.calls, [])
+        self.assertEqual(self._calls, ["before raise", "after raise"])
+
+        # RemoteError原样返回
+        del self._calls[:]
+        result = self._run([
+            RecordInterceptor("limit", 1, self._calls,
+                              RateLimitedError("limited"))])
+        self.assertTrue(isinstance(result.exc, RateLimitedError))
@@ -0,0 +1,170 @@
+# coding: utf8
+
+import unittest
+
+from concurrent.futures import Future
+
+from summerrpc.metrics import Histogram, MetricsRegistry, ClientMetrics, \
+    ServerMetrics
+from summerrpc.invoker import RpcInvoker
+from summerrpc.request import Request
+from summerrpc.result import Result
+from summerrpc.exporter import Exporter
+from summerrpc.serializer import PickleSerializer
+from summerrpc.exception import MethodExecutionError
+
+from summerrpc_tests.runner_fixture import run_requests
+
+REMOTE = ("127.0.0.1", 8001)
+
+
+def make_request(method_name, *args):
+    request = Request()
+    request.class_name = "Service"
+    request.method_name = method_name
+    request.args = args
+    return request
+
+
+class TestHistogram(unittest.TestCase):
+    def testPercentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(99), 0.)
+        for _ in range(99):
+            histogram.record(0.001)
+        histogram.record(1.)
+        self.assertEqual(histogram.count, 100)
+        # 分位数的相对误差不超过一个桶的宽度
+        self.assertTrue(0.001 <= histogram.percentile(50) < 0.0012)
+        self.assertTrue(0.001 <= histogram.percentile(99) < 0.0012)
+        self.assertEqual(histogram.percentile(99.9), 1.)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["max"], 1.)
+        self.assertAlmostEqual(snapshot["sum"], 1.099)
+
+    def testOverflow(self):
+        histogram = Histogram([0.1, 0.2])
+        histogram.record(5.)
+        self.assertEqual(histogram.percentile(50), 5.)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def testGetOrCreate(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("requests", method="A.b")
+        self.assertTrue(registry.counter("requests", method="A.b") is counter)
+        self.assertFalse(registry.counter("requests", method="A.c") is counter)
+        counter.inc()
+        counter.inc(2)
+        registry.gauge("connections", lambda: 7)
+        stages = ClientMetrics(registry).get(("127.0.0.1", 80), "A", "b")
+        stages.wait.record(0.01)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(len(snapshot["histogram"]), 4)
+        self.assertEqual(snapshot["gauge"][0]["value"], 7)
+        text = registry.dump_text()
+        self.assertTrue('requests{method="A.b"} 3\n' in text)
+        self.assertTrue("connections 7\n" in text)
+        self.assertTrue('client.wait{method="A.b",remote="127.0.0.1:80"} '
+                        'count=1 ' in text)
+
+
+class Service(object):
+    def echo(self, data):
+        return data
+
+    def fail(self):
+        raise ValueError("fail")
+
+
+class FakeConnection(object):
+    # write()立即完成，read()返回预先序列化好的Result
+    def __init__(self, response):
+        self.remote_address = REMOTE
+        self._response = response
+
+    def write(self, buff, timeout):
+        future = Future()
+        future.set_result(None)
+        return 1, future
+
+    def read(self, transaction_id):
+        future = Future()
+        future.set_result(self._response)
+        return future
+
+
+class FakeConnectionContext(object):
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class TestServerMetrics(unittest.TestCase):
+    def testRunnerRecordsStages(self):
+        metrics = ServerMetrics(MetricsRegistry())
+        results = run_requests(Exporter().export(Service),
+                               [make_request("echo", "data"),
+                                make_request("echo", "data"),
+                                make_request("fail")],
+                               metrics=metrics)
+        self.assertEqual(results[0].result, "data")
+        self.assertTrue(isinstance(results[2].exc, MethodExecutionError))
+
+        echo = metrics.get("Service", "echo")
+        self.assertEqual(echo.requests.value, 2)
+        self.assertEqual(echo.errors.value, 0)
+        for stage_name in ServerMetrics.STAGES:
+            self.assertEqual(getattr(echo, stage_name).count, 2)
+        fail = metrics.get("Service", "fail")
+        self.assertEqual(fail.requests.value, 1)
+        self.assertEqual(fail.errors.value, 1)
+        for stage_name in ServerMetrics.STAGES:
+            self.assertEqual(getattr(fail, stage_name).count, 1)
+
+    def testUnknownMethodsShareOneCounter(self):
+        registry = MetricsRegistry()
+        metrics = ServerMetrics(registry)
+        results = run_requests(Exporter().export(Service),
+                               [make_request("unknown%d" % index)
+                                for index in range(10)],
+                               metrics=metrics)
+        self.assertEqual(len(results), 10)
+        # 客户端发送的方法名不会创建新的指标
+        self.assertEqual(metrics.rejected.value, 10)
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["histogram"], [])
+        self.assertEqual([item["name"] for item in snapshot["counter"]],
+                         ["server.rejected"])
+
+
+
+class TestClientMetrics(unittest.TestCase):
+    def _invoke(self, invoker, result):
+        serializer = PickleSerializer()
+        connection = FakeConnection(serializer.dumps(result))
+        return invoker.invoke(make_request("echo", "data"),
+                              FakeConnectionContext(connection),
+                              serializer, 1, 1)
+
+    def testRpcInvokerRecordsStages(self):
+        registry = MetricsRegistry()
+        invoker = RpcInvoker(registry)
+        result = Result()
+        result.result = "data"
+        self.assertEqual(self._invoke(invoker, result), "data")
+        result = Result()
+        result.exc = MethodExecutionError("fail")
+        self.assertRaises(MethodExecutionError, self._invoke, invoker, result)
+
+        stages = ClientMetrics(registry).get(REMOTE, "Service", "echo")
+        self.assertEqual(stages.requests.value, 2)
+        self.assertEqual(stages.errors.value, 1)
+        for stage_name in ClientMetrics.STAGES:
+            self.assertEqual(getattr(stages, stage_name).count, 2)
@@ -0,0 +1,71 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.protocol import Protocol
+from summerrpc.filter import Filter, AroundFilter
+from summerrpc.invoker import Invoker
+
+
+class RecordInvoker(Invoker):
+    def __init__(self, calls):
+        self._calls = calls
+
+    def invoke(self, request, connection_context, serializer,
+               write_timeout, read_timeout):
+        self._calls.append("invoke")
+        return request
+
+
+class RecordFilter(Filter):
+    def __init__(self, name, order, calls):
+        self._name = name
+        self._order = order
+        self._calls = calls
+
+    def filter(self, request):
+        self._calls.append(self._name)
+
+    def get_order(self):
+        return self._order
+
+
+class RecordAroundFilter(AroundFilter):
+    def __init__(self, order, calls):
+        self._order = order
+        self._calls = calls
+
+    def around(self, invoke, request, *a):
+        self._calls.append("before")
+        result = invoke(request, *a)
+        self._calls.append("after")
+        return result
+
+    def get_order(self):
+        return self._order
+
+
+class TestProtocol(unittest.TestCase):
+    def testFilterChain(self):
+        calls = []
+        protocol = Protocol() \
+            .add_filter(RecordFilter("low", 1, calls)) \
+            .add_filter(RecordAroundFilter(2, calls)) \
+            .add_filter(RecordFilter("high", 3, calls)) \
+            .set_invoker(RecordInvoker(calls))
+        self.assertEqual(protocol.invoke("request", None, None, 1, 1),
+                         "request")
+        self.assertEqual(calls, ["high", "before", "low", "invoke", "after"])
+
+    def testEqualOrderKeepsRegistrationOrder(self):
+        calls = []
+        protocol = Protocol() \
+            .add_filter(RecordFilter("first", 0, calls)) \
+            .add_filter(RecordFilter("second", 0, calls)) \
+            .set_invoker(RecordInvoker(calls))
+        protocol.invoke("request", None, None, 1, 1)
+        self.assertEqual(calls, ["first", "second", "invoke"])
+
+    def testWithoutInvoker(self):
+        self.assertRaises(RuntimeError, Protocol().invoke,
+                          "request", None, None, 1, 1)
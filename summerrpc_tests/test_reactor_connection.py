@@ -0,0 +1,53 @@
+# coding: utf8
+
+import unittest
+import threading
+import socket
+
+from summerrpc.connection import ReactorConnection
+from summerrpc.transport import BlockingRecordTransport
+from summerrpc.exception import ConnectionAbortError
+
+
+class TestReactorConnection(unittest.TestCase):
+    def setUp(self):
+        self._server_socket, client_socket = socket.socketpair()
+        self._transport = BlockingRecordTransport()
+        self._connection = ReactorConnection(client_socket, self._transport)
+        self._echo_thread = threading.Thread(target=self._echo)
+        self._echo_thread.setDaemon(True)
+        self._echo_thread.start()
+
+    def tearDown(self):
+        self._connection.close()
+        self._server_socket.close()
+
+    def _echo(self):
+        # 按照与请求相反的顺序返回响应
+        while True:
+            try:
+                first = self._transport.read(self._server_socket)
+                second = self._transport.read(self._server_socket)
+            except BaseException:
+                return
+            for transaction_id, buff in (second, first):
+                self._transport.write(self._server_socket,
+                                      transaction_id, buff)
+
+    def testWriteAndRead(self):
+        tid1, write_future1 = self._connection.write("first")
+        tid2, write_future2 = self._connection.write("second")
+        self.assertEqual(write_future1.result(5), tid1)
+        self.assertEqual(write_future2.result(5), tid2)
+        self.assertEqual(self._connection.read(tid1).result(5), "first")
+        self.assertEqual(self._connection.read(tid2).result(5), "second")
+
+    def testClose(self):
+        tid, write_future = self._connection.write("data")
+        write_future.result(5)
+        read_future = self._connection.read(tid + 1)
+        self._connection.close()
+        self.assertRaises(ConnectionAbortError, read_future.result, 5)
+        self.assertRaises(ConnectionAbortError,
+                          self._connection.write, "data")
+        self.assertTrue(self._connection.closed)
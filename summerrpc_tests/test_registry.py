@@ -0,0 +1,336 @@
+# coding: utf8
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import time
+
+from summerrpc import registry as registry_module
+from summerrpc.registry import (
+    RegisterEntrySet,
+    RegistryListener,
+    StaticRegistry,
+    FileRegistry,
+    ZookeeperRegistry
+)
+from summerrpc.helper import URLBuilder, ServerSocketBuilder
+from summerrpc.exporter import Exporter
+from summerrpc.rpc_server import RpcServerBuilder
+
+
+def build_url(port, path="/Service/method"):
+    return URLBuilder() \
+        .with_scheme("record") \
+        .with_host("127.0.0.1") \
+        .with_port(port) \
+        .with_path(path) \
+        .with_argument("serializer", "pickle") \
+        .build(quote_url=True)
+
+
+KEY = ("record", "/Service/method", "pickle")
+OTHER_KEY = ("record", "/Service/other", "pickle")
+
+
+class RecordingListener(RegistryListener):
+    # 记录收到的事件，以及收到事件时registry中的remotes
+    def __init__(self, registry):
+        self._registry = registry
+        self.events = []
+
+    def on_remotes_changed(self, key, remotes):
+        self.events.append(("changed", key, remotes))
+
+    def on_remote_added(self, remote):
+        self.events.append(("added", remote,
+                            self._registry.get_remotes_by_key(KEY)))
+
+    def on_remote_removed(self, remote):
+        self.events.append(("removed", remote,
+                            self._registry.get_remotes_by_key(KEY)))
+
+
+class TestAbstractRegistry(unittest.TestCase):
+    def setUp(self):
+        self._registry = StaticRegistry()
+        self._registry.discovery()
+        self._listener = RecordingListener(self._registry)
+        self._registry.add_listener(self._listener)
+
+    def tearDown(self):
+        self._registry.close()
+
+    def testEventsAfterSnapshot(self):
+        self._registry.register(
+            RegisterEntrySet().with_entry(build_url(8001), ""))
+        # listener收到事件时，新的快照已经发布了
+        self.assertEqual(self._listener.events, [
+            ("changed", KEY, (("127.0.0.1", 8001), )),
+            ("added", ("127.0.0.1", 8001), (("127.0.0.1", 8001), ))])
+
+        del self._listener.events[:]
+        self._registry.unregister(
+            RegisterEntrySet().with_entry(build_url(8001), ""))
+        self.assertEqual(self._listener.events, [
+            ("changed", KEY, ()),
+            ("removed", ("127.0.0.1", 8001), ())])
+
+    def testIncrementalDiff(self):
+        self._registry._update_entries([build_url(8001), build_url(8002)])
+        del self._listener.events[:]
+
+        # 只有发生变化的key会被通知；
+        # + remote仍然出现在其他key中时，不会收到removed事件
+        self._registry._update_entries(
+            [build_url(8001), build_url(8002, "/Service/other")])
+        self.assertEqual(sorted(self._listener.events), [
+            ("changed", KEY, (("127.0.0.1", 8001), )),
+            ("changed", OTHER_KEY, (("127.0.0.1", 8002), ))])
+
+        del self._listener.events[:]
+        self._registry._update_entries(
+            [build_url(8001), build_url(8002, "/Service/other")])
+        self.assertEqual(self._listener.events, [])
+
+    def testReplay(self):
+        self._registry._update_entries([build_url(8001)])
+        listener = RecordingListener(self._registry)
+        self._registry.add_listener(listener, True)
+        self.assertEqual(listener.events,
+                         [("changed", KEY, (("127.0.0.1", 8001), ))])
+
+
+class TestZookeeperRegistry(unittest.TestCase):
+    def setUp(self):
+        self._get_children = registry_module.zookeeper.get_children
+        self._calls = []
+
+        def get_children(handler, path, watcher=None):
+            self._calls.append(path)
+            return [build_url(8001)]
+        registry_module.zookeeper.get_children = get_children
+
+    def tearDown(self):
+        registry_module.zookeeper.get_children = self._get_children
+
+    def testRetryFailedEntry(self):
+        registry = ZookeeperRegistry("127.0.0.1:2181", "/summerrpc",
+                                     discovery_delay=0.05)
+        registry._discovery_handler = 0
+        url = build_url(9001, "")
+        data = json.dumps({"pid": 1, "methods": {"Service": ["method"]}})
+        calls = []
+
+        def get(handler, path, watcher=None):
+            calls.append(path)
+            if len(calls) == 1:
+                raise registry_module.zookeeper.ZooKeeperException("timeout")
+            return data, {"version": 0}
+        original_get = registry_module.zookeeper.get
+        registry_module.zookeeper.get = get
+        try:
+            # 第一次读取数据失败，注册项不会被缓存，之后会重新解析
+            self.assertEqual(registry._update_entries([url]), [url])
+            self.assertEqual(
+                registry.get_remotes("Service", "method", "record", "pickle"),
+                ())
+            self.assertEqual(registry._update_entries([url]), [])
+            self.assertEqual(
+                registry.get_remotes("Service", "method", "record", "pickle"),
+                (("127.0.0.1", 9001), ))
+        finally:
+            registry_module.zookeeper.get = original_get
+            registry.close()
+
+    def testMalformedEntryNotRetried(self):
+        registry = ZookeeperRegistry("127.0.0.1:2181", "/summerrpc")
+        registry._discovery_handler = 0
+        calls = []
+
+        def get(handler, path, watcher=None):
+            calls.append(path)
+            return "not json", {"version": 0}
+        original_get = registry_module.zookeeper.get
+        registry_module.zookeeper.get = get
+        bad_port = build_url(9001).replace("9001", "port", 1)
+        try:
+            # 格式错误的注册项记录为空，之后不会重新解析
+            entries = [build_url(9002, ""), bad_port]
+            self.assertEqual(registry._update_entries(entries), [])
+            self.assertEqual(registry._update_entries(entries), [])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(registry._entries[bad_port], [])
+        finally:
+            registry_module.zookeeper.get = original_get
+            registry.close()
+
+    def testRetryWithLimit(self):
+        registry = ZookeeperRegistry("127.0.0.1:2181", "/summerrpc",
+                                     discovery_delay=0.01,
+                                     max_discovery_retries=3)
+        registry._discovery_handler = 0
+        watchers = []
+
+        def get_children(handler, path, watcher=None):
+            watchers.append(watcher)
+            return [build_url(9001, "")]
+
+        def get(handler, path, watcher=None):
+            raise registry_module.zookeeper.ZooKeeperException("timeout")
+        original_get = registry_module.zookeeper.get
+        registry_module.zookeeper.get = get
+        registry_module.zookeeper.get_children = get_children
+        try:
+            registry._real_discovery(0, "/summerrpc")
+            deadline = time.time() + 2
+            while len(watchers) < 4 and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.2)
+            # 暂时的失败最多重试3次，重试时不会重复添加watcher
+            self.assertEqual(len(watchers), 4)
+            self.assertTrue(watchers[0] is not None)
+            self.assertEqual(watchers[1:], [None, None, None])
+            self.assertEqual(registry._retry_timer, None)
+        finally:
+            registry_module.zookeeper.get = original_get
+            registry.close()
+
+    def testDebounceChildrenEvents(self):
+        registry = ZookeeperRegistry("127.0.0.1:2181", "/summerrpc",
+                                     discovery_delay=0.05)
+        # 延迟期间的多次子节点变化只触发一次拉取
+        for _ in range(5):
+            registry._children_watcher(0, 4, 3, "/summerrpc")
+        deadline = time.time() + 2
+        while not self._calls and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(self._calls, ["/summerrpc"])
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ))
+        registry.close()
+
+
+class TestStaticRegistry(unittest.TestCase):
+    def testRegisterAndDiscovery(self):
+        registry = StaticRegistry([build_url(8001)])
+        registry.discovery()
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ))
+
+        # 服务级别的注册项
+        entry_set = RegisterEntrySet().with_entry(
+            build_url(8002, ""),
+            json.dumps({"methods": {"Service": ["method", "other"]}}))
+        registry.register(entry_set)
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ("127.0.0.1", 8002)))
+        self.assertEqual(
+            registry.get_remotes("Service", "other", "record", "pickle"),
+            (("127.0.0.1", 8002), ))
+
+        registry.unregister(entry_set)
+        self.assertEqual(
+            registry.get_remotes("Service", "other", "record", "pickle"), ())
+        registry.close()
+
+
+class Service(object):
+    def method(self):
+        pass
+
+    def other(self):
+        pass
+
+
+class TestServiceLevelRegistration(unittest.TestCase):
+    def testRegisterAndParse(self):
+        server_socket = ServerSocketBuilder() \
+            .with_host("127.0.0.1") \
+            .with_port(0) \
+            .with_non_blocking() \
+            .build()
+        port = server_socket.getsockname()[1]
+        registry = StaticRegistry()
+        server = RpcServerBuilder() \
+            .with_server_socket(server_socket) \
+            .with_exporter(Exporter().export(Service)) \
+            .with_registry(registry) \
+            .with_service_level_registration(True) \
+            .build()
+        try:
+            server._register_if_necessary()
+            registry.discovery()
+            # 整个进程只有一个注册项，方法表保存在数据中
+            self.assertEqual(len(registry._register_entries), 1)
+            for method_name in ("method", "other"):
+                self.assertEqual(
+                    registry.get_remotes("Service", method_name,
+                                         "record", "pickle"),
+                    (("127.0.0.1", port), ))
+        finally:
+            registry.close()
+            server_socket.close()
+
+
+class TestFileRegistry(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, "registry")
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def testLineFormat(self):
+        with open(self._path, "w") as f:
+            f.write("# comment\n%s\n\n%s\n" % (build_url(8001), build_url(8002)))
+        registry = FileRegistry(self._path)
+        registry.discovery()
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ("127.0.0.1", 8002)))
+        registry.close()
+
+    def testReloadAfterMalformedFile(self):
+        content = json.dumps([build_url(8001)])
+        with open(self._path, "w") as f:
+            f.write(content[:-1] + " ")
+        stat = os.stat(self._path)
+        registry = FileRegistry(self._path)
+        self.assertRaises(ValueError, registry._reload_if_necessary)
+
+        # 修改时间、大小都没有变化，也会重新读取
+        with open(self._path, "w") as f:
+            f.write(content)
+        os.utime(self._path, (stat.st_atime, stat.st_mtime))
+        registry._reload_if_necessary()
+        registry.discovery()
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ))
+        registry.close()
+
+    def testRegister(self):
+        registry = FileRegistry(self._path, poll_interval=0.01)
+        registry.register(RegisterEntrySet().with_entry(build_url(8001), ""))
+        registry.discovery()
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ))
+
+        registry.register(RegisterEntrySet().with_entry(build_url(8002), ""))
+        registry._reload_if_necessary()
+        self.assertEqual(
+            registry.get_remotes("Service", "method", "record", "pickle"),
+            (("127.0.0.1", 8001), ("127.0.0.1", 8002)))
+        self.assertRaises(
+            RuntimeError,
+            registry.register,
+            RegisterEntrySet().with_entry(build_url(8002), ""),
+            False)
+        registry.close()
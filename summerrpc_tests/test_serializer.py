@@ -0,0 +1,83 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.request import Request
+from summerrpc.result import Result
+from summerrpc.exception import ServerOverloadedError, RateLimitedError
+from summerrpc.serializer import PickleSerializer
+from summerrpc.extension.json_serializer import JsonSerializer
+from summerrpc.extension.msgpack_serializer import MsgpackSerializer
+
+
+class TestRequestSerializer(unittest.TestCase):
+    def _make_request(self, method_name="method"):
+        request = Request()
+        request.class_name = "Service"
+        request.method_name = method_name
+        request.args = [1, "a"]
+        request.kwargs = {"k": [1, 2]}
+        request.meta = {"trace_id": "abc"}
+        return request
+
+    def _check(self, serializer):
+        # 预先序列化固定字段没有明显的收益，直接使用serializer自身
+        self.assertTrue(
+            serializer.request_serializer("Service", "method") is serializer)
+        for method_name in ("method", "other"):
+            # 复用的JSONEncoder/Packer不会残留上一次序列化的内容
+            for _ in range(2):
+                loaded = serializer.loads(
+                    serializer.dumps(self._make_request(method_name)))
+                self.assertEqual(loaded.class_name, "Service")
+                self.assertEqual(loaded.method_name, method_name)
+                self.assertEqual(list(loaded.args), [1, "a"])
+                self.assertEqual(loaded.kwargs, {"k": [1, 2]})
+                self.assertEqual(loaded.meta, {"trace_id": "abc"})
+
+    def testJsonSerializer(self):
+        self._check(JsonSerializer())
+
+    def testMsgpackSerializer(self):
+        self._check(MsgpackSerializer())
+
+    def testPickleSerializer(self):
+        serializer = PickleSerializer()
+        self.assertTrue(
+            serializer.request_serializer("Service", "method") is serializer)
+
+    def testInvalidMetaIgnored(self):
+        for serializer in (JsonSerializer(), MsgpackSerializer()):
+            request = self._make_request()
+            request.meta = ["not", "a", "dict"]
+            loaded = serializer.loads(serializer.dumps(request))
+            self.assertEqual(loaded.method_name, "method")
+            self.assertEqual(loaded.meta, None)
+
+
+class TestResultSerializer(unittest.TestCase):
+    def _round_trip(self, serializer, exc):
+        result = Result()
+        result.exc = exc
+        return serializer.loads(serializer.dumps(result)).exc
+
+    def _check(self, serializer):
+        exc = self._round_trip(serializer, ServerOverloadedError("too many"))
+        self.assertTrue(isinstance(exc, ServerOverloadedError))
+        self.assertEqual(exc.msg, "too many")
+        exc = self._round_trip(serializer, RateLimitedError("slow down"))
+        self.assertTrue(isinstance(exc, RateLimitedError))
+        # 不是RemoteError的异常仍然还原成RuntimeError
+        exc = self._round_trip(serializer, KeyError("k"))
+        self.assertTrue(type(exc) is RuntimeError)
+
+    def testJsonSerializer(self):
+        self._check(JsonSerializer())
+
+    def testMsgpackSerializer(self):
+        self._check(MsgpackSerializer())
+
+    def testPickleSerializer(self):
+        exc = self._round_trip(PickleSerializer(),
+                               ServerOverloadedError("too many"))
+        self.assertTrue(isinstance(exc, ServerOverloadedError))
@@ -0,0 +1,111 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.stub import Stub
+from summerrpc.cluster import RandomCluster, ConsistentHashCluster
+from summerrpc.invoker import Invoker
+from summerrpc.protocol import Protocol
+from summerrpc.refer_argument import ReferArgument
+from summerrpc.transport import BlockingRecordTransport
+from summerrpc.serializer import PickleSerializer
+from summerrpc.exception import ServerOverloadedError
+
+
+class Service(object):
+    def echo(self, data):
+        return data
+
+
+class FakeRegistry(object):
+    def __init__(self, remotes):
+        self._remotes = remotes
+
+    def make_key(self, class_name, method_name, transport, serializer):
+        return (transport, "/%s/%s" % (class_name, method_name), serializer)
+
+    def get_remotes_by_key(self, key):
+        return self._remotes
+
+    def add_listener(self, listener):
+        pass
+
+    def remove_listener(self, listener):
+        pass
+
+    def close(self):
+        pass
+
+
+class RejectingInvoker(Invoker):
+    # 前rejections次调用返回ServerOverloadedError，之后原样返回参数
+    def __init__(self, rejections):
+        self.rejections = rejections
+        self.calls = 0
+
+    def invoke(self, request, connection_context, serializer,
+               write_timeout, read_timeout):
+        self.calls = self.calls + 1
+        if self.calls <= self.rejections:
+            raise ServerOverloadedError("overloaded")
+        return request.args[0]
+
+
+class RecordingCluster(ConsistentHashCluster):
+    # 记录每次调用选中的remote
+    def __init__(self, registry):
+        super(RecordingCluster, self).__init__(registry)
+        self.remotes = []
+
+    def begin_invoke(self, remote):
+        self.remotes.append(remote)
+        super(RecordingCluster, self).begin_invoke(remote)
+
+
+class TestRefer(unittest.TestCase):
+    def _refer(self, invoker, refer_argument, cluster=None):
+        cluster = cluster or RandomCluster(
+            FakeRegistry([("127.0.0.1", 8001), ("127.0.0.1", 8002)]))
+        stub = Stub() \
+            .set_cluster(cluster) \
+            .set_protocol(Protocol().set_invoker(invoker)) \
+            .set_transport(BlockingRecordTransport()) \
+            .set_serializer(PickleSerializer())
+        return stub.refer(Service, refer_argument)
+
+    def testRetryRejectedRequest(self):
+        invoker = RejectingInvoker(1)
+        refer = self._refer(invoker, ReferArgument())
+        self.assertEqual(refer.echo("data"), "data")
+        self.assertEqual(invoker.calls, 2)
+        refer.refer_close()
+
+    def testRejectedRetriesExhausted(self):
+        invoker = RejectingInvoker(3)
+        refer = self._refer(invoker,
+                            ReferArgument().set_max_rejected_retries(1))
+        self.assertRaises(ServerOverloadedError, refer.echo, "data")
+        self.assertEqual(invoker.calls, 2)
+        refer.refer_close()
+
+    def testRetryOnAnotherRemote(self):
+        remotes = (("127.0.0.1", 8001), ("127.0.0.1", 8002))
+        cluster = RecordingCluster(FakeRegistry(remotes))
+        invoker = RejectingInvoker(1)
+        # 一致性哈希总是选择同一个remote，重试时必须排除它
+        refer = self._refer(invoker,
+                            ReferArgument().set_hash_argument("echo", 0),
+                            cluster)
+        self.assertEqual(refer.echo("data"), "data")
+        self.assertEqual(len(set(cluster.remotes)), 2)
+        refer.refer_close()
+
+    def testNoOtherRemote(self):
+        # 只有一个remote时，被拒绝之后不再重试
+        invoker = RejectingInvoker(1)
+        refer = self._refer(invoker,
+                            ReferArgument().set_max_rejected_retries(3),
+                            RandomCluster(FakeRegistry([("127.0.0.1", 8001)])))
+        self.assertRaises(ServerOverloadedError, refer.echo, "data")
+        self.assertEqual(invoker.calls, 1)
+        refer.refer_close()
@@ -0,0 +1,40 @@
+# coding: utf8
+
+import unittest
+
+from summerrpc.helper import time_used, configure_time_used
+from summerrpc.metrics import MetricsRegistry
+
+
+class TestTimeUsed(unittest.TestCase):
+    def tearDown(self):
+        configure_time_used()
+
+    def testDisabled(self):
+        configure_time_used(enabled=False)
+        # 关闭时返回同一个什么也不做的对象
+        self.assertTrue(time_used("a") is time_used("b"))
+        with time_used("a"):
+            pass
+
+    def testFeedHistogram(self):
+        registry = MetricsRegistry()
+        configure_time_used(histogram_factory=lambda note: registry.histogram(
+            "time_used", section=note))
+        for _ in range(3):
+            with time_used("section", 1):
+                pass
+        self.assertEqual(
+            registry.histogram("time_used", section="section").count, 3)
+
+    def testSampling(self):
+        registry = MetricsRegistry()
+        configure_time_used(sample_rate=0.5,
+                            histogram_factory=lambda note: registry.histogram(
+                                "time_used", section=note))
+        for _ in range(1000):
+            with time_used("section", 1):
+                pass
+        count = registry.histogram("time_used", section="section").count
+        self.assertTrue(300 < count < 700)
+        self.assertRaises(ValueError, configure_time_used, sample_rate=0)
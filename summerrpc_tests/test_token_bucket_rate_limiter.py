@@ -1,7 +1,16 @@
+# coding: utf8
+
 from unittest import TestCase
+import threading
 import time
+import math
+import os
+import uuid
+
+import redis
 
 from summerrpc.rate_limiter import *
+from summerrpc.rate_limiter.leased_redis_token_bucket import LEASE_SCRIPT
 
 
 class TestTokenBucketRateLimiter(TestCase):
@@ -24,3 +33,224 @@ class TestTokenBucketRateLimiter(TestCase):
         self.assertTrue(self._redis_rate_limiter.acquire(9))
         self.assertFalse(self._redis_rate_limiter.acquire(9))
 
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+class TestGCRATokenBucket(TestCase):
+    def testTryAcquire(self):
+        clock = FakeClock()
+        rate_limiter = TokenBucketRateLimiter(10, 1, clock=clock)
+        self.assertEqual(rate_limiter.try_acquire(10), (True, 0.))
+        acquired, wait = rate_limiter.try_acquire(2)
+        self.assertFalse(acquired)
+        self.assertAlmostEqual(wait, 0.002)
+        clock.now += 0.002
+        self.assertTrue(rate_limiter.acquire(2))
+        # 超过容量的请求永远不会成功
+        self.assertEqual(rate_limiter.try_acquire(11), (False, None))
+        self.assertFalse(rate_limiter.acquire_many(11))
+
+    def testAcquireMany(self):
+        rate_limiter = TokenBucketRateLimiter(5, 1)
+        self.assertTrue(rate_limiter.acquire_many(5, timeout=0))
+        self.assertFalse(rate_limiter.acquire_many(5, timeout=0.001))
+        self.assertTrue(rate_limiter.acquire_many(5, timeout=1))
+
+    def testStriped(self):
+        clock = FakeClock()
+        rate_limiter = StripedTokenBucketRateLimiter(8, 1, stripes=4,
+                                                     clock=clock)
+        # 固定的令牌桶耗尽后，会使用其他的令牌桶
+        for _ in range(8):
+            self.assertTrue(rate_limiter.acquire())
+        acquired, wait = rate_limiter.try_acquire()
+        self.assertFalse(acquired)
+        self.assertAlmostEqual(wait, 0.004)
+        clock.now += 0.004
+        self.assertTrue(rate_limiter.acquire())
+
+    def testStripesSpreadAcrossThreads(self):
+        rate_limiter = StripedTokenBucketRateLimiter(64, 1, stripes=4)
+        indexes = []
+        threads = [threading.Thread(
+            target=lambda: indexes.append(rate_limiter._get_stripe_index()))
+            for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(indexes), [0, 0, 1, 1, 2, 2, 3, 3])
+
+    def testStripesLimitedByCapacity(self):
+        clock = FakeClock()
+        rate_limiter = StripedTokenBucketRateLimiter(2, 1e-6, clock=clock)
+        # 令牌桶的数量不超过容量，每个令牌桶至少能容纳一个令牌
+        self.assertTrue(rate_limiter.acquire())
+        self.assertTrue(rate_limiter.acquire())
+        self.assertFalse(rate_limiter.acquire())
+        self.assertRaises(ValueError, StripedTokenBucketRateLimiter, 0, 1)
+        self.assertRaises(ValueError, StripedTokenBucketRateLimiter, 8, 1, 0)
+
+
+class FakeRedis(object):
+    """代替Redis：每次最多租借remaining个令牌，fail为True时模拟Redis不可用"""
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.fail = False
+        self.calls = 0
+
+    def register_script(self, script):
+        return self._lease
+
+    def _lease(self, keys, args):
+        self.calls += 1
+        if self.fail:
+            raise redis.ConnectionError("redis is down")
+        granted = min(self.remaining, args[3])
+        self.remaining -= granted
+        return granted
+
+
+class ScriptRedis(object):
+    """
+    在内存中执行与LEASE_SCRIPT相同的逻辑，多个限流器可以共享它；
+    + 用于在没有Redis的环境中测试租借令牌的脚本
+    """
+    def __init__(self):
+        self.data = {}
+
+    def register_script(self, script):
+        assert script == LEASE_SCRIPT
+        return self._lease
+
+    def _lease(self, keys, args):
+        tokens_key, timestamp_key = keys
+        rate, capacity, now, requested = [float(arg) for arg in args]
+        last_tokens = self.data.get(tokens_key, capacity)
+        last_refreshed = self.data.get(timestamp_key, now)
+        delta = max(0, now - last_refreshed)
+        filled_tokens = min(capacity, last_tokens + delta * rate)
+        granted = math.floor(min(filled_tokens, requested))
+        self.data[tokens_key] = filled_tokens - granted
+        self.data[timestamp_key] = now
+        # Redis把Lua的数字转换成整数
+        return int(granted)
+
+
+class BadReplyRedis(FakeRedis):
+    # reply不为None时，脚本返回无法解析的结果
+    reply = None
+
+    def _lease(self, keys, args):
+        if self.reply is not None:
+            self.calls += 1
+            return self.reply
+        return super(BadReplyRedis, self)._lease(keys, args)
+
+
+class TestLeasedRedisTokenBucket(TestCase):
+    def _wait_refill(self, rate_limiter):
+        for _ in range(100):
+            if not rate_limiter._refilling:
+                return
+            time.sleep(0.01)
+
+    def testLease(self):
+        client = FakeRedis(25)
+        rate_limiter = LeasedRedisTokenBucketRateLimiter(
+            100, 1e-6, redis_client=client, lease_size=10, lease_ttl=60)
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(rate_limiter.local_tokens, 10)
+        # 剩余的令牌少于5个时，在后台续租
+        for _ in range(6):
+            self.assertTrue(rate_limiter.acquire())
+        self._wait_refill(rate_limiter)
+        self.assertEqual(client.calls, 2)
+        self.assertEqual(rate_limiter.local_tokens, 14)
+        for _ in range(14):
+            self.assertTrue(rate_limiter.acquire())
+        self._wait_refill(rate_limiter)
+        self.assertEqual(rate_limiter.local_tokens, 5)
+        rate_limiter.close()
+
+    def testFallback(self):
+        client = FakeRedis(0)
+        client.fail = True
+        rate_limiter = LeasedRedisTokenBucketRateLimiter(
+            100, 1e-6, redis_client=client, lease_size=10, retry_interval=0,
+            fallback=TokenBucketRateLimiter(2, 1e-6))
+        self.assertTrue(rate_limiter.degraded)
+        self.assertTrue(rate_limiter.acquire())
+        self.assertTrue(rate_limiter.acquire())
+        self.assertFalse(rate_limiter.acquire())
+
+        # Redis恢复之后，重新使用租借的令牌
+        client.fail = False
+        client.remaining = 10
+        self._wait_refill(rate_limiter)
+        rate_limiter.acquire()
+        self._wait_refill(rate_limiter)
+        self.assertFalse(rate_limiter.degraded)
+        self.assertTrue(rate_limiter.acquire())
+        rate_limiter.close()
+
+    def testUnexpectedReply(self):
+        client = BadReplyRedis(10)
+        client.reply = "not a number"
+        rate_limiter = LeasedRedisTokenBucketRateLimiter(
+            100, 1e-6, redis_client=client, lease_size=10, retry_interval=0,
+            fallback=TokenBucketRateLimiter(1, 1e-6))
+        # 续租失败之后仍然可以再次续租
+        self.assertFalse(rate_limiter._refilling)
+        self.assertTrue(rate_limiter.degraded)
+        client.reply = None
+        rate_limiter.acquire()
+        self._wait_refill(rate_limiter)
+        self.assertFalse(rate_limiter.degraded)
+        self.assertEqual(rate_limiter.local_tokens, 10)
+        rate_limiter.close()
+
+    def _check_shared_bucket(self, client, key):
+        # 两个限流器共享容量为20的全局令牌桶，每次租借10个
+        limiters = [LeasedRedisTokenBucketRateLimiter(
+            20, 1e-6, redis_client=client, key=key, lease_size=10,
+            lease_ttl=60) for _ in range(2)]
+        try:
+            for rate_limiter in limiters:
+                self.assertEqual(rate_limiter.local_tokens, 10)
+            for _ in range(10):
+                self.assertTrue(limiters[0].acquire())
+            self._wait_refill(limiters[0])
+            # 全局的令牌已经被租借完了
+            self.assertFalse(limiters[0].acquire())
+            self.assertEqual(limiters[0].local_tokens, 0)
+            self.assertTrue(limiters[1].acquire())
+        finally:
+            for rate_limiter in limiters:
+                rate_limiter.close()
+
+    def testLeaseScript(self):
+        self._check_shared_bucket(ScriptRedis(), "leased")
+
+    def testLeaseScriptWithRedis(self):
+        # Redis可用时，执行真正的Lua脚本，地址可以通过SUMMERRPC_TEST_REDIS_URL指定
+        url = os.environ.get("SUMMERRPC_TEST_REDIS_URL",
+                             "redis://127.0.0.1:6379/15")
+        client = redis.StrictRedis.from_url(url, socket_timeout=1,
+                                            socket_connect_timeout=0.2)
+        try:
+            client.ping()
+        except redis.RedisError:
+            self.skipTest("redis is unavailable")
+        key = "summerrpc-test-%s" % uuid.uuid4().hex
+        try:
+            self._check_shared_bucket(client, key)
+        finally:
+            client.delete(key, "%s.ts" % key)
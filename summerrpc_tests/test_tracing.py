@@ -0,0 +1,168 @@
+# coding: utf8
+
+import unittest
+import tempfile
+import shutil
+import json
+import threading
+import os
+
+from summerrpc.request import Request
+from summerrpc.tracing import (
+    Tracer,
+    RingBufferSpanSink,
+    FileSpanSink,
+    get_current_span
+)
+from summerrpc.stub import Stub
+from summerrpc.cluster import RandomCluster
+from summerrpc.invoker import Invoker
+from summerrpc.protocol import Protocol
+from summerrpc.refer_argument import ReferArgument
+from summerrpc.transport import BlockingRecordTransport
+from summerrpc.exporter import Exporter
+from summerrpc.extension.json_serializer import JsonSerializer
+
+from summerrpc_tests.runner_fixture import run_requests
+from summerrpc_tests.test_stub import FakeRegistry
+
+
+class TestTracer(unittest.TestCase):
+    def testPropagation(self):
+        sink = RingBufferSpanSink(capacity=2)
+        tracer = Tracer(sink)
+        client_span = tracer.start_client_span("Service", "method")
+        self.assertEqual(client_span.parent_id, None)
+
+        request = Request()
+        request.class_name = "Service"
+        request.method_name = "method"
+        request.meta = tracer.inject(client_span, None)
+        server_span = tracer.start_server_span(request, ("127.0.0.1", 80))
+        self.assertEqual(server_span.trace_id, client_span.trace_id)
+        self.assertEqual(server_span.parent_id, client_span.span_id)
+
+        # 服务端发起的嵌套调用继承当前span
+        previous = Tracer.activate(server_span)
+        try:
+            self.assertTrue(get_current_span() is server_span)
+            nested_span = tracer.start_client_span("Other", "method")
+        finally:
+            Tracer.deactivate(previous)
+        self.assertEqual(get_current_span(), None)
+        self.assertEqual(nested_span.trace_id, client_span.trace_id)
+        self.assertEqual(nested_span.parent_id, server_span.span_id)
+
+        for span in (nested_span, server_span, client_span):
+            tracer.finish(span)
+        # 环形缓冲区只保留最近的span
+        self.assertEqual(sink.spans(client_span.trace_id),
+                         [server_span, client_span])
+
+    def testSampling(self):
+        sink = RingBufferSpanSink()
+        tracer = Tracer(sink, sample_rate=0)
+        span = tracer.start_client_span("Service", "method")
+        self.assertEqual(tracer.inject(span, {"k": 1})["sampled"], False)
+        tracer.finish(span)
+        self.assertEqual(sink.spans(), [])
+
+    def testFileSpanSink(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "spans.log")
+            tracer = Tracer(FileSpanSink(path))
+            span = tracer.start_client_span("Service", "method",
+                                            ("127.0.0.1", 80))
+            tracer.finish(span, RuntimeError("boom"))
+            tracer.close()
+            with open(path) as f:
+                record = json.loads(f.readline())
+            self.assertEqual(record["name"], "Service.method")
+            self.assertEqual(record["remote"], "127.0.0.1:80")
+            self.assertEqual(record["error"], "RuntimeError: boom")
+        finally:
+            shutil.rmtree(directory)
+
+    def testFileSpanSinkWritesInBackground(self):
+        directory = tempfile.mkdtemp()
+        try:
+            sink = FileSpanSink(os.path.join(directory, "spans.log"),
+                                max_queue_size=1)
+            written = threading.Event()
+            release = threading.Event()
+            real_file = sink._file
+
+            class BlockingFile(object):
+                def writelines(self, lines):
+                    written.set()
+                    release.wait()
+                    real_file.writelines(lines)
+
+                def flush(self):
+                    real_file.flush()
+
+                def close(self):
+                    real_file.close()
+            sink._file = BlockingFile()
+
+            tracer = Tracer(sink)
+            tracer.finish(tracer.start_client_span("Service", "method"))
+            self.assertTrue(written.wait(2))
+            # 后台线程阻塞在写文件时，emit()不会被阻塞，队列满时丢弃span
+            for _ in range(2):
+                tracer.finish(tracer.start_client_span("Service", "method"))
+            self.assertEqual(sink.dropped, 1)
+            release.set()
+            tracer.close()
+            with open(os.path.join(directory, "spans.log")) as f:
+                self.assertEqual(len(f.readlines()), 2)
+        finally:
+            shutil.rmtree(directory)
+
+
+class Service(object):
+    def current_span(self):
+        span = get_current_span()
+        return None if span is None else span.span_id
+
+
+class RunnerInvoker(Invoker):
+    # 不经过网络，直接把请求交给Runner处理
+    def __init__(self, tracer):
+        self._exporter = Exporter().export(Service)
+        self._tracer = tracer
+
+    def invoke(self, request, connection_context, serializer,
+               write_timeout, read_timeout):
+        result = run_requests(self._exporter, [request],
+                              serializer=serializer, tracer=self._tracer)[0]
+        if result.exc is not None:
+            raise result.exc
+        return result.result
+
+
+class TestEndToEndTracing(unittest.TestCase):
+    def testReferToRunner(self):
+        sink = RingBufferSpanSink()
+        tracer = Tracer(sink)
+        stub = Stub() \
+            .set_cluster(RandomCluster(FakeRegistry([("127.0.0.1", 8001)]))) \
+            .set_protocol(Protocol().set_invoker(RunnerInvoker(tracer))) \
+            .set_transport(BlockingRecordTransport()) \
+            .set_serializer(JsonSerializer()) \
+            .set_tracer(tracer)
+        refer = stub.refer(Service, ReferArgument())
+        try:
+            current_span_id = refer.current_span()
+        finally:
+            refer.refer_close()
+
+        # 服务端的span先结束
+        server_span, client_span = sink.spans()
+        self.assertEqual(client_span.kind, client_span.CLIENT)
+        self.assertEqual(server_span.kind, server_span.SERVER)
+        self.assertEqual(server_span.trace_id, client_span.trace_id)
+        self.assertEqual(server_span.parent_id, client_span.span_id)
+        # 在线程池中执行的方法能获取到服务端的span
+        self.assertEqual(current_span_id, server_span.span_id)